@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import netaddr
+import plugins.configuration
+import plugins.audit
+
+""" audit log query endpoint for Blocky/4"""
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    try:
+        limit = int(formdata.get("limit", 50))
+        before = None
+        if formdata.get("before"):
+            timestamp, entry_id = formdata["before"].split(":", 1)
+            before = (int(timestamp), int(entry_id))
+    except (ValueError, TypeError, AttributeError):  # JSON bodies can hold numbers, lists and objects, not just strings
+        return {
+            "success": False,
+            "status": "invalid",
+            "message": "limit must be a number, and before must be a cursor of the format timestamp:id",
+        }
+    network = None
+    if formdata.get("ip"):
+        try:
+            network = netaddr.IPNetwork(formdata["ip"])
+        except (netaddr.core.AddrFormatError, ValueError, TypeError):
+            return {
+                "success": False,
+                "status": "invalid",
+                "message": "ip must be an IP address or network (CIDR)",
+            }
+    include_archive = formdata.get("archive", False) in [True, "true", "1"]
+
+    entries, next_cursor = plugins.audit.query(
+        state, limit=limit, before=before, network=network, include_archive=include_archive
+    )
+    return {
+        "entries": entries,
+        "next": next_cursor and f"{next_cursor[0]}:{next_cursor[1]}" or None,
+    }
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import asyncio
+import elasticsearch
+import netaddr
+import plugins.configuration
+import plugins.background
+import plugins.backtest
+import plugins.breaker
+import plugins.rules
+import time
+
+""" rule backtesting (dry-run) endpoint for Blocky/4"""
+
+MAX_RESULTS = 100  # Max number of IPs listed per category, per duration/limit combination
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    try:
+        rule = plugins.rules.parse_rule({"description": "Backtest", **formdata})
+        durations = formdata.get("durations") or [rule["duration"]]
+        assert isinstance(durations, list), "durations must be a list of durations, for instance [\"1h\", \"24h\"]"
+        for duration in durations:
+            plugins.rules.validate_duration(duration)
+        limits = formdata.get("limits") or [rule["limit"]]
+        assert isinstance(limits, list), "limits must be a list of limits, for instance [1000, 5000]"
+        limits = [plugins.rules.to_int(limit, "limits") for limit in limits]
+        assert all(limit > 0 for limit in limits), "limits must be greater than zero"
+        end = int(formdata.get("end") or time.time())
+        end -= end % 60  # Whole minutes, so repeated backtests can share cached searches
+        seconds = {duration: plugins.background.duration_to_seconds(duration) for duration in durations}
+        assert (
+            max(seconds.values()) <= plugins.backtest.MAX_BACKTEST_WINDOW
+        ), "Backtests cannot search more than 30 days back"
+    except (AssertionError, ValueError, TypeError) as e:
+        return {
+            "success": False,
+            "status": "assertion error",
+            "message": str(e),
+        }
+
+    filters = [x.strip() for x in rule["filters"].split("\n") if x.strip()]
+    # Longest first: its search can serve every shorter duration that is a whole number of its buckets, the
+    # others get a finer search of their own
+    windows = sorted(set(seconds.values()), reverse=True)
+    searches = {}
+    searched = 0
+    try:
+        for i, window in enumerate(windows):
+            searches[window], cached = await plugins.backtest.historical_series(
+                state, rule["aggtype"], filters, rule["prefix4"], rule["prefix6"], window, end, windows[i:]
+            )
+            searched += not cached
+    except plugins.breaker.CircuitOpenError as e:
+        return {"success": False, "status": "unavailable", "message": str(e)}
+    except (asyncio.exceptions.TimeoutError, elasticsearch.exceptions.TransportError) as e:
+        return {"success": False, "status": "failure", "message": f"Historical search failed: {e}"}
+
+    # Check each candidate against the allow/block lists only once, however many combinations we test.
+    # Not through the offender cache, a backtest's candidates would only push out those of the live rules
+    statuses = {}
+    results = []
+    for duration in durations:
+        result = searches[seconds[duration]]
+        client_totals = plugins.backtest.totals(result, seconds[duration])
+        for limit in limits:
+            outcome = {
+                "duration": duration,
+                "limit": limit,
+                "granularity": result["granularity"],
+                "would_block": [],
+                "allowed": [],
+                "already_blocked": [],
+            }
+            for client, value in client_totals:
+                if value < limit:
+                    break  # Sorted largest first, so we're done here
+                if client not in statuses:
+                    try:
+                        statuses[client] = plugins.background.offender_status(state, netaddr.IPNetwork(client))
+                    except (netaddr.core.AddrFormatError, ValueError):
+                        statuses[client] = "invalid"
+                status = statuses[client]
+                category = {None: "would_block", "allowed": "allowed", "blocked": "already_blocked"}.get(status)
+                if category:
+                    outcome[category].append((client, value))
+            for category in ["would_block", "allowed", "already_blocked"]:
+                outcome[f"total_{category}"] = len(outcome[category])
+                outcome[category] = outcome[category][:MAX_RESULTS]
+            results.append(outcome)
+
+    return {
+        "success": True,
+        "end": end,
+        "window": windows[0],
+        "granularity": searches[windows[0]]["granularity"],
+        "searches": searched,
+        "cached": not searched,
+        "results": results,
+    }
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
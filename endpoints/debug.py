@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import aiohttp.web
+import io
+import marshal
+import math
+import pstats
+import plugins.configuration
+import plugins.profiling
+
+""" profiling and debug endpoint for Blocky/4"""
+
+OUTPUT_FORMATS = ["text", "pstats", "collapsed"]
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    profiler = state.profiler
+    if not profiler.enabled:
+        return {"success": False, "status": "disabled", "message": "Debugging is not enabled in blocky4.yaml"}
+
+    try:
+        seconds = float(formdata.get("seconds") or 0)
+        assert math.isfinite(seconds) and 0 <= seconds <= plugins.profiling.MAX_PROFILE_SECONDS, (
+            f"seconds must be between 0 and {plugins.profiling.MAX_PROFILE_SECONDS}"
+        )
+        sweeps = int(formdata.get("sweeps") or 0)
+        assert sweeps >= 0, "sweeps must be zero or more"
+        output_format = formdata.get("format", "text")
+        assert output_format in OUTPUT_FORMATS, f"format must be one of: {', '.join(OUTPUT_FORMATS)}"
+        sort = formdata.get("sort", "cumulative")
+        assert isinstance(sort, str) and sort in pstats.Stats.sort_arg_dict_default, f"Unknown sort order {sort}"
+    except (AssertionError, ValueError, TypeError) as e:
+        return {
+            "success": False,
+            "status": "invalid",
+            "message": str(e) if isinstance(e, AssertionError) else "seconds and sweeps must be numbers",
+        }
+
+    # No profile requested, just show loop lag incidents and sweep timings
+    if not seconds and not sweeps:
+        return profiler.status()
+
+    if profiler.busy:
+        return {"success": False, "status": "busy", "message": "A profile is already being captured, try again later"}
+    profiler.busy = True
+    try:
+        if output_format == "collapsed":  # Sampled stacks, for flamegraphs
+            collapsed = await profiler.sample(seconds, sweeps)
+            return aiohttp.web.Response(text=collapsed, content_type="text/plain")
+        profile = await profiler.cprofile(seconds, sweeps)
+    finally:
+        profiler.busy = False
+    if output_format == "pstats":  # Binary, same as cProfile's dump_stats, for pstats/snakeviz
+        return aiohttp.web.Response(body=marshal.dumps(profile.stats), content_type="application/octet-stream")
+    report = io.StringIO()
+    pstats.Stats(profile, stream=report).sort_stats(sort).print_stats(100)
+    return aiohttp.web.Response(text=report.getvalue(), content_type="text/plain")
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
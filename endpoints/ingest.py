@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import asyncio
+import plugins.configuration
+
+""" log line ingestion endpoint for Blocky/4's stream detection"""
+
+MAX_INGEST_LINES = 50000  # Max number of log lines per request
+INGEST_CHUNK_SIZE = 1000  # Number of lines to feed to the stream engine at a time
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    if not state.stream:
+        return {"success": False, "status": "disabled", "message": "Stream detection is not enabled"}
+    lines = formdata.get("lines")
+    if not isinstance(lines, list):
+        return {"success": False, "status": "invalid", "message": "lines must be a list of JSON log lines"}
+
+    if len(lines) > MAX_INGEST_LINES:
+        return {
+            "success": False,
+            "status": "too large",
+            "message": f"Too many log lines, please send at most {MAX_INGEST_LINES} per request",
+        }
+
+    # Feed in chunks, so a large batch does not hold up everything else
+    used = 0
+    for i in range(0, len(lines), INGEST_CHUNK_SIZE):
+        used += state.stream.feed(lines[i : i + INGEST_CHUNK_SIZE])
+        await asyncio.sleep(0)
+    return {"success": True, "status": "ingested", "message": f"{used} of {len(lines)} log lines ingested"}
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
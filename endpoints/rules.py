@@ -17,41 +17,24 @@
 
 import ahapi
 import plugins.configuration
-import re
+import plugins.rules
 
 """ rules get/set endpoint for Blocky/4"""
 
 
-def validate_filter(filter):
-    """Ensures a search filter is valid"""
-    for entry in filter.split("\n"):
-        if entry:
-            k, o, v = entry.split(" ", 2)  # key, operator, value
-            if o.startswith("!"):  # exclude as search param?
-                o = o[1:]
-            if o == "=":
-                return True
-            elif o == "~=":
-                return True
-            elif o == "==":
-                return True
-            else:
-                raise TypeError(f"Unknown operator {o} in search filter: {entry}")
-
-
 async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
 
     # Fetching rules?
     if request.method == "GET":
-        rules = [x for x in state.sqlite.fetch("rules", limit=0)]
+        rules = state.store.rules()
         return rules
 
     # Removing a rule?
     if request.method == "DELETE":
         rule_id = formdata.get("rule", -1)
-        rule = state.sqlite.fetchone("rules", id=rule_id)
+        rule = state.store.rule(rule_id)
         if rule:
-            state.sqlite.delete("rules", id=rule_id)
+            state.store.delete_rule(rule_id)
             return {"success": True, "status": "deleted", "message": f"Rule #{rule_id} has been deleted."}
         else:
             return {"success": False, "status": "not found", "message": f"Rule #{rule_id} does not exist."}
@@ -59,34 +42,15 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
     # Adding a rule?
     if request.method == "PUT":
         try:
-            description = formdata.get("description")
-            assert description, "Please provide a description for your new rule"
-            aggtype = formdata.get("aggtype")
-            assert aggtype in ["requests", "bytes"], "aggtype must be either requests or bytes"
-            limit = int(formdata.get("limit"))
-            assert limit > 0, "limit must be greater than zero"
-            duration = formdata.get("duration")
-            assert re.match(r"^\d+[dhms]", duration), "duration must be of format 0-99[d/h/m/s], for instance 24h or 45m"
-            filters = formdata.get("filter", "")
-            try:
-                validate_filter(filters)
-            except TypeError as e:
-                raise AssertionError(e)
+            entry = plugins.rules.parse_rule(formdata)
         except AssertionError as e:
             return {
                 "success": False,
                 "status": "assertion error",
                 "message": str(e),
             }
-        entry = {
-            "description": description,
-            "aggtype": aggtype,
-            "limit": limit,
-            "duration": duration,
-            "filters": filters,
-        }
         # Check for duplicates first
-        entry_inserted = state.sqlite.fetchone("rules", **entry)
+        entry_inserted = state.store.find_rule(entry)
         if entry_inserted:
             return {
                 "success": False,
@@ -95,47 +59,27 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
             }
 
         # Insert and return the ID it got
-        state.sqlite.insert("rules", entry)
-        entry_inserted = state.sqlite.fetchone("rules", **entry)
-        return {"success": True, "status": "added", "message": f"Rule #{entry_inserted['id']} has been added"}
+        rule_id = state.store.add_rule(entry)
+        return {"success": True, "status": "added", "message": f"Rule #{rule_id} has been added"}
 
     # Patching a rule?
     if request.method == "PATCH":
         try:
-            rule_id = int(formdata.get("rule", -1))
-            description = formdata.get("description")
-            assert description, "Please provide a description for your new rule"
-            aggtype = formdata.get("aggtype")
-            assert aggtype in ["requests", "bytes"], "aggtype must be either requests or bytes"
-            limit = int(formdata.get("limit"))
-            assert limit > 0, "limit must be greater than zero"
-            duration = formdata.get("duration")
-            assert re.match(r"^\d+[dhms]", duration), "duration must be of format 0-99[d/h/m/s], for instance 24h or 45m"
-            filters = formdata.get("filter", "")
-            try:
-                validate_filter(filters)
-            except TypeError as e:
-                raise AssertionError(e)
+            rule_id = plugins.rules.to_int(formdata.get("rule", -1), "rule")
+            entry = plugins.rules.parse_rule(formdata)
         except AssertionError as e:
             return {
                 "success": False,
                 "status": "assertion error",
                 "message": str(e),
             }
-        entry = {
-            "description": description,
-            "aggtype": aggtype,
-            "limit": limit,
-            "duration": duration,
-            "filters": filters,
-        }
         # Check that rule exists
-        existing_entry = state.sqlite.fetchone("rules", id=rule_id)
+        existing_entry = state.store.rule(rule_id)
         if not existing_entry:
             return {"success": False, "status": "not found", "message": f"Rule #{rule_id} does not exist"}
 
         # Upsert rule
-        state.sqlite.upsert("rules", entry, id=rule_id)
+        state.store.update_rule(rule_id, entry)
         return {"success": True, "status": "modified", "message": f"Rule #{rule_id} has been modified"}
 
 
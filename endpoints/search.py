@@ -39,14 +39,10 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
     results = {"allow": [], "block": [], "iptables": []}
 
     # Search allow list
-    for entry in state.allow_list:
-        if entry.network in as_net or as_net in entry.network:
-            results["allow"].append(entry)
+    results["allow"].extend(state.allow_list.overlapping(as_net))
 
     # Search block list
-    for entry in state.block_list:
-        if entry.network in as_net or as_net in entry.network:
-            results["block"].append(entry)
+    results["block"].extend(state.block_list.overlapping(as_net))
 
     # Search iptables (max 50-ish records)
     now = time.time()
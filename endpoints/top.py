@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import asyncio
+import plugins.configuration
+import plugins.background
+import time
+
+""" live top clients endpoint for Blocky/4"""
+
+MIN_REFRESH_AGE = 10  # Results younger than this (in seconds) are never refreshed on demand
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    rule_id = formdata.get("rule")
+    refresh = formdata.get("refresh", False) in [True, "true", "1"]
+
+    if refresh:
+        now = time.time()
+        if rule_id:
+            rules = [x for x in [state.store.rule(rule_id)] if x]
+        else:
+            rules = state.store.rules()
+        searches = []
+        for rule in rules:
+            cached = state.sweep_results.get(rule["id"])
+            if not cached or cached["timestamp"] < now - MIN_REFRESH_AGE:
+                searches.append(plugins.background.top_clients(state, plugins.background.BanRule(rule)))
+        # All at once, so one slow rule does not hold up the others. The breaker limits how many searches run
+        await asyncio.gather(*searches)
+
+    results = sorted(state.sweep_results.values(), key=lambda x: x["rule"])
+    if rule_id:
+        results = [x for x in results if str(x["rule"]) == str(rule_id)]
+    return {
+        "rules": results,
+    }
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
@@ -22,13 +22,35 @@ import asyncio
 import yaml
 import plugins.configuration
 import plugins.background
+import plugins.audit
+import plugins.coordinator
+import plugins.snapshot
+import plugins.storage
+import plugins.stream
 import ahapi
 
 
 async def main(loop: asyncio.BaseEventLoop):
     yml = yaml.safe_load(open("blocky4.yaml", "r"))
     config = plugins.configuration.BlockyConfiguration(yml)
-    loop.create_task(plugins.background.run(config))
+    if config.profiler.enabled:
+        loop.create_task(config.profiler.monitor())
+    loop.create_task(plugins.storage.run(config))
+    loop.create_task(plugins.snapshot.run(config))
+    loop.create_task(plugins.coordinator.run_sync(config))
+
+    # Background workers only run on the active instance, i.e. the one holding the lease
+    workers = [
+        lambda: plugins.background.run(config),
+        lambda: plugins.audit.run_retention(config),
+        lambda: plugins.coordinator.run_pruning(config),
+    ]
+    if config.stream_enabled:
+        config.stream = plugins.stream.StreamEngine(config)
+        workers.append(config.stream.run)
+        if config.stream_tail:  # Standby instances keep counting too, so they can take over with warm counters
+            loop.create_task(config.stream.tail(config.stream_tail))
+    loop.create_task(config.coordinator.run(workers))
     httpserver = ahapi.simple(
         static_dir="webui",
         bind_ip=config.http_ip,
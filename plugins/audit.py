@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import time
+import typing
+import zlib
+import netaddr
+import plugins.configuration
+import plugins.storage
+
+""" Audit log retention and querying for Blocky/4 """
+
+ROLLUP_INTERVAL = 3600  # Look for audit entries to archive once an hour
+ROLLUP_BATCH_SIZE = 1000  # Number of audit entries compressed into each archive row
+MAX_QUERY_LIMIT = 500  # Never return more than this many entries per page
+
+AuditCursor = typing.Tuple[int, int]  # (timestamp, id) of the last entry on a page
+
+
+def rollup(config: "plugins.configuration.BlockyConfiguration", cutoff: int) -> int:
+    """Moves one batch of audit entries older than $cutoff into a compressed archive row.
+    Returns the number of entries archived, 0 if there was nothing left to archive."""
+    rows = config.store.oldest_audit_entries(cutoff, ROLLUP_BATCH_SIZE)
+    if not rows:
+        return 0
+    archive = {
+        "start_timestamp": rows[0]["timestamp"],
+        "start_id": rows[0]["id"],
+        "end_timestamp": rows[-1]["timestamp"],
+        "end_id": rows[-1]["id"],
+        "entries": len(rows),
+        "networks": plugins.storage.network_summary(row["ip"] for row in rows),
+        "data": zlib.compress(json.dumps(rows).encode("utf-8")),
+    }
+    config.store.archive_audit(archive, [row["id"] for row in rows])
+    return len(rows)
+
+
+async def run_retention(config: "plugins.configuration.BlockyConfiguration"):
+    """Archives audit entries past the retention period, in batches, forever"""
+    while True:
+        if config.audit_retention_days > 0:
+            cutoff = int(time.time()) - (config.audit_retention_days * 86400)
+            archived = 0
+            while True:
+                batch = rollup(config, cutoff)
+                if not batch:
+                    break
+                archived += batch
+                await asyncio.sleep(0)  # Let the HTTP server and sweeps have a go between batches
+            if archived:
+                print(f"Archived {archived} audit log entries older than {config.audit_retention_days} days")
+        await asyncio.sleep(ROLLUP_INTERVAL)
+
+
+def query(
+    config: "plugins.configuration.BlockyConfiguration",
+    limit: int = 50,
+    before: typing.Optional[AuditCursor] = None,
+    network: typing.Optional[netaddr.IPNetwork] = None,
+    include_archive: bool = False,
+) -> typing.Tuple[typing.List[dict], typing.Optional[AuditCursor]]:
+    """Fetches a page of audit log entries, newest first, using keyset pagination on (timestamp, id).
+    If $network is set, only entries for IPs within it or networks overlapping it are returned.
+    Returns the entries and the cursor to pass as $before for the next page (None if this was the last page)."""
+    limit = max(1, min(MAX_QUERY_LIMIT, limit))
+    entries = config.store.audit_entries(limit + 1, before, network)
+
+    # Continue into the archives if the live table ran out
+    if include_archive and len(entries) <= limit:
+        archive_before = (entries[-1]["timestamp"], entries[-1]["id"]) if entries else before
+        entries.extend(query_archive(config, limit + 1 - len(entries), archive_before, network))
+
+    if len(entries) > limit:
+        entries = entries[:limit]
+        return entries, (entries[-1]["timestamp"], entries[-1]["id"])
+    return entries, None
+
+
+def query_archive(
+    config: "plugins.configuration.BlockyConfiguration",
+    limit: int,
+    before: typing.Optional[AuditCursor] = None,
+    network: typing.Optional[netaddr.IPNetwork] = None,
+) -> typing.List[dict]:
+    """Fetches up to $limit archived audit entries older than $before, newest first, optionally only those
+    overlapping $network. Chunks that cannot hold any such entries are never decompressed."""
+    wanted = plugins.storage.network_range(network) if network is not None else None
+    entries = []
+    for chunk in config.store.audit_archive(before, network):
+        rows = json.loads(zlib.decompress(chunk["data"]))
+        for row in reversed(rows):
+            if before and (row["timestamp"], row["id"]) >= tuple(before):
+                continue
+            if wanted:
+                ip_range = plugins.storage.ip_range(row["ip"])
+                if not ip_range or ip_range[0] > wanted[1] or ip_range[1] < wanted[0]:
+                    continue
+            entries.append(row)
+            if len(entries) >= limit:
+                return entries
+    return entries
@@ -19,29 +19,48 @@
 # Background worker - finds bans and adds 'em, and such and things
 
 import asyncio
+import functools
 import elasticsearch_dsl
 import elasticsearch
 import typing
 import netaddr
 import time
+import plugins.breaker
 import plugins.configuration
 import plugins.lists
+import plugins.workers
 import datetime
+import random
+import re
 
 MAX_DB_DAYS = 3  # Only look backwards up to three days. No sense in involving every index in our search.
 CLIENT_IP_NAME = "client_ip"
 TIMESTAMP_NAME = "@timestamp"
+DEFAULT_TOP_HITS = 100  # Number of top clients to fetch per rule, when ES is not under pressure
+SCHEDULER_TICK = 5  # How often (in seconds) we check whether any rules are due to run
+MIN_RULE_INTERVAL = 15  # Never run a rule more often than every 15 seconds
+MAX_RULE_INTERVAL = 1800  # ...and never less often than every 30 minutes
+RULE_RUNS_PER_WINDOW = 48  # By default, evaluate a rule ~48 times per search window (24h -> every 30 minutes)
+RULE_INTERVAL_JITTER = 0.1  # Spread rule runs by +/- 10% so they don't all fire together
+OFFENDER_CACHE_SIZE = 100000  # Max number of allow/block list decisions to remember between sweeps
+PREFIX_ROLLUP_FACTOR = 10  # When rolling up prefixes ourselves, fetch 10x as many IPs to sum up
+MIN_PREFIX4 = 16  # Never aggregate (and block) anything larger than an IPv4 /16...
+MIN_PREFIX6 = 32  # ...or an IPv6 /32
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
 
 
 async def find_top_clients(
     config: plugins.configuration.BlockyConfiguration,
     aggtype: typing.Literal["bytes", "requests"] = "requests",
     duration: str = "12h",
-    no_hits: int = 100,
+    no_hits: int = DEFAULT_TOP_HITS,
     filters: typing.List[str] = [],
+    prefix4: int = 0,
+    prefix6: int = 0,
 ) -> typing.List[typing.Tuple[str, int]]:
     """Finds the top clients (IPs) in the database based on the parameters provided.
-    Searches for the top clients by either traffic volume (bytes) or requests."""
+    Searches for the top clients by either traffic volume (bytes) or requests.
+    If prefix lengths are given, clients are aggregated per network (e.g. /24 or /64) instead of per IP."""
     assert aggtype in ["bytes", "requests"], "Only by-bytes or by-requests aggregations are supported"
     if isinstance(filters, str):
         filters = [filters]
@@ -65,27 +84,17 @@ async def find_top_clients(
         return []
 
     # Add all search filters
-    for entry in filters:
-        if entry:
-            k, o, v = entry.split(" ", 2)  # key, operator, value
-            xq = q.query  # Default is to add as search param
-            if o.startswith("!"):  # exclude as search param?
-                o = o[1:]
-                xq = q.exclude
-            if o == "=":
-                q = xq("match", **{k: v})
-            elif o == "~=":
-                q = xq("regexp", **{k: v})
-            elif o == "==":
-                q = xq("term", **{k: v})
-            else:
-                raise TypeError(f"Unknown operator {o} in search filter: {entry}")
+    q = add_filters(q, filters)
+
+    # Aggregating per network? Use the ingest-time prefix field if it matches, otherwise roll up IPs ourselves
+    agg_field, agg_hits, rollup = aggregation_field(config, no_hits, prefix4, prefix6)
+
     if aggtype == "requests":
-        q.aggs.bucket("requests_per_ip", elasticsearch_dsl.A("terms", field=f"{CLIENT_IP_NAME}.keyword", size=no_hits))
+        q.aggs.bucket("requests_per_ip", elasticsearch_dsl.A("terms", field=agg_field, size=agg_hits))
     elif aggtype == "bytes":
         q.aggs.bucket(
             "requests_per_ip",
-            elasticsearch_dsl.A("terms", field=f"{CLIENT_IP_NAME}.keyword", size=no_hits, order={"bytes_sum": "desc"}),
+            elasticsearch_dsl.A("terms", field=agg_field, size=agg_hits, order={"bytes_sum": "desc"}),
         ).metric("bytes_sum", "sum", field="bytes")
 
     resp = await config.elasticsearch.search(index=threes, body=q.to_dict(), size=0, timeout="30s")
@@ -109,105 +118,389 @@ async def find_top_clients(
                     int(entry["doc_count"]),
                 )
             )
+    if rollup:
+        top_ips = rollup_prefixes(top_ips, prefix4, prefix6)[:no_hits]
     return top_ips
 
 
+def add_filters(q: elasticsearch_dsl.Search, filters: typing.List[str]) -> elasticsearch_dsl.Search:
+    """Adds rule search filters (key, operator, value) to an ES search"""
+    for entry in filters:
+        if entry:
+            k, o, v = entry.split(" ", 2)  # key, operator, value
+            xq = q.query  # Default is to add as search param
+            if o.startswith("!"):  # exclude as search param?
+                o = o[1:]
+                xq = q.exclude
+            if o == "=":
+                q = xq("match", **{k: v})
+            elif o == "~=":
+                q = xq("regexp", **{k: v})
+            elif o == "==":
+                q = xq("term", **{k: v})
+            else:
+                raise TypeError(f"Unknown operator {o} in search filter: {entry}")
+    return q
+
+
+def aggregation_field(
+    config: plugins.configuration.BlockyConfiguration, no_hits: int, prefix4: int = 0, prefix6: int = 0
+) -> typing.Tuple[str, int, bool]:
+    """Works out which ES field to aggregate clients on, how many buckets to fetch, and whether
+    we need to roll the buckets up into networks ourselves afterwards"""
+    if prefix4 or prefix6:
+        if config.prefix_field and [prefix4, prefix6] == config.prefix_field_lengths:
+            return config.prefix_field, no_hits, False
+        return f"{CLIENT_IP_NAME}.keyword", no_hits * PREFIX_ROLLUP_FACTOR, True
+    return f"{CLIENT_IP_NAME}.keyword", no_hits, False
+
+
+def rollup_prefixes(
+    top_ips: typing.List[typing.Tuple[str, int]], prefix4: int = 0, prefix6: int = 0
+) -> typing.List[typing.Tuple[str, int]]:
+    """Sums up per-IP results into per-network results, largest first.
+    A prefix length of 0 means that address family is not aggregated."""
+    networks = {}
+    for ip, value in top_ips:
+        key = network_key(ip, prefix4, prefix6)
+        if key:
+            networks[key] = networks.get(key, 0) + value
+    return sorted(networks.items(), key=lambda x: x[1], reverse=True)
+
+
+def network_key(ip: str, prefix4: int = 0, prefix6: int = 0) -> typing.Optional[str]:
+    """Returns the network (CIDR) an IP should be counted under, or the IP itself if that family is not aggregated.
+    Returns None if $ip is not an IP address at all."""
+    try:
+        address = netaddr.IPAddress(ip)
+    except (netaddr.core.AddrFormatError, ValueError):
+        return None  # Not an IP, can't block it anyway
+    prefix = prefix4 if address.version == 4 else prefix6
+    return prefix and str(netaddr.IPNetwork(f"{ip}/{prefix}").cidr) or ip
+
+
 class BanRule:
     def __init__(self, ruledict):
+        self.id = ruledict.get("id")
         self.description = ruledict["description"]
         self.aggtype = ruledict["aggtype"]
         self.limit = ruledict["limit"]
         self.duration = ruledict["duration"]
         self.filters = [x.strip() for x in ruledict["filters"].split("\n") if x.strip()]
+        self.interval = ruledict.get("interval") or default_interval(self.duration)
+        self.prefix4 = ruledict.get("prefix4") or 0
+        self.prefix6 = ruledict.get("prefix6") or 0
 
-    async def list_offenders(self, config: plugins.configuration.BlockyConfiguration):
-        """Find top clients by $metric, see if they cross the limit..."""
-        offenders = []
+    async def find_candidates(self, config: plugins.configuration.BlockyConfiguration):
+        """Find top clients by $metric, and keep the result around for the live view"""
         candidates = []
+        error = None
+        started = time.time()
         try:
-            candidates = await find_top_clients(config, aggtype=self.aggtype, duration=self.duration, filters=self.filters)
+            with config.profiler.span("search"):
+                candidates = await config.es_breaker.call(
+                    find_top_clients,
+                    config,
+                    aggtype=self.aggtype,
+                    duration=self.duration,
+                    no_hits=config.es_breaker.size(DEFAULT_TOP_HITS),
+                    filters=self.filters,
+                    prefix4=self.prefix4,
+                    prefix6=self.prefix6,
+                )
+        except plugins.breaker.CircuitOpenError as e:
+            error = str(e)
         except (asyncio.exceptions.TimeoutError, elasticsearch.exceptions.ConnectionTimeout, elasticsearch.exceptions.ConnectionError):
             print("Offender search timed out, retrying later!")
+            error = "Search timed out"
         except elasticsearch.exceptions.TransportError:
             print("Transport error (503?), retrying later")
+            error = "Transport error"
+        config.sweep_results[self.id] = {
+            "rule": self.id,
+            "description": self.description,
+            "aggtype": self.aggtype,
+            "limit": self.limit,
+            "duration": self.duration,
+            "timestamp": int(started),
+            "latency": round(time.time() - started, 3),
+            "error": error,
+            "top": candidates,
+        }
+        return candidates
+
+    async def list_offenders(self, config: plugins.configuration.BlockyConfiguration):
+        """Find top clients by $metric, see if they cross the limit..."""
+        offenders = []
+        candidates = await top_clients(config, self)
         for candidate in candidates:
             if candidate[1] >= self.limit:
                 offenders.append(candidate)
         return offenders
 
 
-async def run(config: plugins.configuration.BlockyConfiguration):
+async def top_clients(config: plugins.configuration.BlockyConfiguration, my_rule: BanRule):
+    """Finds the top clients for a rule, sharing a single search between all concurrent callers"""
+    inflight = config.sweep_inflight.get(my_rule.id)
+    if inflight is None:
+        inflight = asyncio.ensure_future(my_rule.find_candidates(config))
+        config.sweep_inflight[my_rule.id] = inflight
+        inflight.add_done_callback(lambda _: config.sweep_inflight.pop(my_rule.id, None))
+    # Shielded, so a viewer giving up on a refresh does not cancel the search for everyone else
+    return await asyncio.shield(inflight)
+
+
+def duration_to_seconds(duration: str) -> int:
+    """Converts an ES-style duration (24h, 45m etc) into seconds"""
+    match = re.match(r"^(\d+)([dhms])", duration)
+    assert match, f"Unknown duration format: {duration}"
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
 
-    # Search forever, sleep a little in between
+def default_interval(duration: str) -> int:
+    """Derives how often a rule should be evaluated from the size of its search window.
+    Short windows are evaluated often, long windows (whose results barely move) rarely."""
+    try:
+        interval = duration_to_seconds(duration) // RULE_RUNS_PER_WINDOW
+    except AssertionError:
+        interval = MIN_RULE_INTERVAL
+    return max(MIN_RULE_INTERVAL, min(MAX_RULE_INTERVAL, interval))
+
+
+def jittered(interval: int) -> float:
+    """Spreads an interval by +/- RULE_INTERVAL_JITTER, so rules do not all fire at the same time"""
+    return interval * random.uniform(1 - RULE_INTERVAL_JITTER, 1 + RULE_INTERVAL_JITTER)
+
+
+def expire_entries(config: plugins.configuration.BlockyConfiguration):
+    """Removes expired entries from the allow and block lists"""
+    now = int(time.time())
+    all_items = [item for item in config.store.list_entries()]
+    for item in all_items:
+        if item['expires'] == -1:
+            continue  # never expires
+        if item['expires'] < now:
+            print(f"Expiring {item['type']} rule for {item['ip']}")
+            if item['type'] == 'allow':
+                config.allow_list.remove(item['ip'])
+            elif item['type'] == 'block':
+                config.block_list.remove(item['ip'])
+                # Try adding a temporary whitelist entry to flush on hosts
+                try:
+                    config.allow_list.add(
+                        ip=item["ip"],
+                        timestamp=now,
+                        expires=now + 600,  # Expire this rule in 10 minutes
+                        reason="Temporary allow-listed by BLocky4 to unblock IP due to block expiring",
+                        host=plugins.configuration.DEFAULT_HOST_BLOCK,
+                        force=False
+                    )
+                except plugins.lists.BlockListException:
+                    pass  # If it conflicts, it should already be unblocked, so we don't care.
+            else:
+                print("I don't actually know items of type {item['type']}, ignoring...")
+
+
+async def run_expiry(config: plugins.configuration.BlockyConfiguration):
+    """Expires list entries on a timer of its own, independent of rule evaluation"""
     while True:
-        # Find expired rules
-        now = int(time.time())
-        all_items = [item for item in config.sqlite.fetch("lists", limit=0)]
-        for item in all_items:
-            if item['expires'] == -1:
-                continue  # never expires
-            if item['expires'] < now:
-                print(f"Expiring {item['type']} rule for {item['ip']}")
-                if item['type'] == 'allow':
-                    config.allow_list.remove(item['ip'])
-                elif item['type'] == 'block':
-                    config.block_list.remove(item['ip'])
-                    # Try adding a temporary whitelist entry to flush on hosts
-                    try:
-                        config.allow_list.add(
-                            ip=item["ip"],
-                            timestamp=now,
-                            expires=now + 600,  # Expire this rule in 10 minutes
-                            reason="Temporary allow-listed by BLocky4 to unblock IP due to block expiring",
-                            host=plugins.configuration.DEFAULT_HOST_BLOCK,
-                            force=False
-                        )
-                    except plugins.lists.BlockListException:
-                        pass  # If it conflicts, it should already be unblocked, so we don't care.
-                else:
-                    print("I don't actually know items of type {item['type']}, ignoring...")
-
-        all_rules = [item for item in config.sqlite.fetch("rules", limit=0)]
-        for rule in all_rules:
-            #  print(f"Running rule #{rule['id']}: {rule['description']}...")
-            my_rule = BanRule(rule)
-            off = await my_rule.list_offenders(config)
-            if off:
-                for offender in off:
-                    off_ip = offender[0]
-                    off_limit = offender[1]
-                    off_ip_na = netaddr.IPAddress(off_ip)
-                    ignore_ip = False
-                    for allowed_ip in config.allow_list:
-                        if (
-                            isinstance(allowed_ip.network, netaddr.IPNetwork)
-                            and off_ip_na in allowed_ip.network
-                            or isinstance(allowed_ip.network, netaddr.IPAddress)
-                            and off_ip_na == allowed_ip.network
-                        ):
-                            #  print(f"IP {off_ip} is on the allow list, ignoring...")
-                            ignore_ip = True
-                            break
-                    for blocked_ip in config.block_list:
-                        if (
-                            isinstance(blocked_ip.network, netaddr.IPNetwork)
-                            and off_ip_na in blocked_ip.network
-                            or isinstance(blocked_ip.network, netaddr.IPAddress)
-                            and off_ip_na == blocked_ip.network
-                        ):
-                            #  print(f"IP {off_ip} is already blocked, ignoring...")
-                            ignore_ip = True
-                            break
-                    if not ignore_ip:
-                        off_reason = f"{rule['description']} ({off_limit} >= {rule['limit']})"
-                        print(f"Found new offender, {off_ip}: {off_reason}")
-                        now = int(time.time())
-                        expires = now + config.default_expire_seconds
-                        config.block_list.add(
-                            ip=off_ip,
-                            timestamp=now,
-                            expires=expires,
-                            reason=off_reason,
-                            host=plugins.configuration.DEFAULT_HOST_BLOCK,
-                        )
-        await asyncio.sleep(15)
+        with config.profiler.span("expiry"):
+            expire_entries(config)
+        await asyncio.sleep(config.expiry_interval)
+
+
+async def process_rule(config: plugins.configuration.BlockyConfiguration, my_rule: BanRule):
+    """Runs a single rule and blocks any new offenders it finds"""
+    #  print(f"Running rule #{my_rule.id}: {my_rule.description}...")
+    off = await my_rule.list_offenders(config)
+    block_offenders(config, my_rule, off)
+
+
+def offender_status(config: plugins.configuration.BlockyConfiguration, off_network: netaddr.IPNetwork) -> typing.Optional[str]:
+    """Checks whether an offender (a single IP or a whole network) is covered by the allow list ("allowed") or
+    already blocked ("blocked"). Returns None if it is neither, and thus eligible for blocking."""
+    if config.allow_list.overlapping(off_network):
+        return "allowed"
+    for blocked_ip in config.block_list.overlapping(off_network):
+        if off_network in blocked_ip.network:
+            return "blocked"
+    return None
+
+
+def cached_offender_status(
+    config: plugins.configuration.BlockyConfiguration, offender: str
+) -> typing.Tuple[typing.Optional[str], bool]:
+    """Like offender_status, for an IP or CIDR string, but remembers decisions across sweeps for as long as the
+    lists have not changed in a way that could affect them. Only meant for live rule runs: the cache keeps the
+    OFFENDER_CACHE_SIZE most recently seen offenders. Returns the status and whether it came from the cache.
+    Raises netaddr.core.AddrFormatError or ValueError if the offender is not an IP or network."""
+    allow_list = config.allow_list
+    block_list = config.block_list
+    cached = config.offender_cache.get(offender)
+    if cached:
+        status, allow_additions, allow_removals, block_additions, block_removals = cached
+        if status == "allowed":  # Only removing allow entries can change this
+            valid = allow_removals == allow_list.removals
+        elif status == "blocked":  # Unless unblocked, or allowed after all
+            valid = block_removals == block_list.removals and allow_additions == allow_list.additions
+        else:  # Eligible until a new entry on either list covers it
+            valid = allow_additions == allow_list.additions and block_additions == block_list.additions
+        if valid:
+            config.offender_cache.move_to_end(offender)
+            return status, True
+    status = offender_status(config, netaddr.IPNetwork(offender))
+    config.offender_cache[offender] = (
+        status,
+        allow_list.additions,
+        allow_list.removals,
+        block_list.additions,
+        block_list.removals,
+    )
+    config.offender_cache.move_to_end(offender)  # Replaced entries are as fresh as new ones
+    while len(config.offender_cache) > OFFENDER_CACHE_SIZE:
+        config.offender_cache.popitem(last=False)  # Forget the least recently seen offender
+    return status, False
+
+
+def replaceable(entry: plugins.lists.IPEntry) -> bool:
+    """Whether a block list entry may be replaced by a block of a network covering it. Only temporary blocks
+    on all hosts that were added by a rule are. Permanent, host-specific and manual blocks are left alone."""
+    return (
+        entry.get("rule") is not None
+        and entry["expires"] != -1
+        and entry["host"] == plugins.configuration.DEFAULT_HOST_BLOCK
+    )
+
+
+def block_offenders(
+    config: plugins.configuration.BlockyConfiguration, my_rule: BanRule, off: typing.List[typing.Tuple[str, int]]
+):
+    """Blocks offenders found by a rule, unless they are allow-listed or already blocked"""
+    stats = config.offender_stats.get(my_rule.id)
+    if stats is None:
+        stats = config.offender_stats[my_rule.id] = {
+            "checked": 0,
+            "cache_hits": 0,
+            "invalid": 0,
+            "allowed": 0,
+            "already_blocked": 0,
+            "blocked": 0,
+            "replaced": 0,
+        }
+    for off_ip, off_limit in off or []:
+        try:
+            with config.profiler.span("check"):
+                status, cached = cached_offender_status(config, off_ip)
+            off_network = netaddr.IPNetwork(off_ip)
+        except (netaddr.core.AddrFormatError, ValueError, TypeError):
+            stats["invalid"] += 1  # Whatever the rule aggregated on, this is not an IP or network
+            continue
+        stats["checked"] += 1
+        stats["cache_hits"] += cached
+        if status == "allowed":
+            stats["allowed"] += 1
+        elif status == "blocked":
+            stats["already_blocked"] += 1
+        else:
+            off_reason = f"{my_rule.description} ({off_limit} >= {my_rule.limit})"
+            print(f"Found new offender, {off_ip}: {off_reason}")
+            now = int(time.time())
+            expires = now + config.default_expire_seconds
+            with config.profiler.span("block"):
+                # A network block replaces the temporary blocks earlier rule runs made within it, and sits
+                # alongside any others
+                is_network = off_network.size > 1
+                if is_network:
+                    for entry in config.block_list.overlapping(off_network):
+                        if entry.network in off_network and replaceable(entry):
+                            config.block_list.remove(entry)
+                            stats["replaced"] += 1
+                try:
+                    config.block_list.add(
+                        ip=off_ip,
+                        timestamp=now,
+                        expires=expires,
+                        reason=off_reason,
+                        host=plugins.configuration.DEFAULT_HOST_BLOCK,
+                        rule=my_rule.id,
+                        keep_blocks=is_network,
+                    )
+                    stats["blocked"] += 1
+                except plugins.lists.BlockListException as e:
+                    print(f"Could not block offender {off_ip}: {e}")
+
+
+async def run_schedule(
+    config: plugins.configuration.BlockyConfiguration,
+    fetch_rules: typing.Callable[[], typing.List[dict]],
+    process: typing.Callable[[BanRule], typing.Awaitable],
+):
+    """Runs each rule from $fetch_rules on its own schedule through $process, forever.
+    Rules that are due at the same time run concurrently. How many of their searches are sent to ES at once is
+    bounded by the circuit breaker, which allows fewer the more ES is struggling."""
+    # Each rule gets its own schedule: rule id -> (rule row, BanRule, next run)
+    schedule: typing.Dict[int, typing.Tuple[dict, BanRule, float]] = {}
+    running: typing.Set[int] = set()  # Rules being run right now, which are not started again until done
+    batches: typing.Set[asyncio.Task] = set()  # Keep a reference to running batches, or they may be collected
+
+    async def run_rule(my_rule: BanRule):
+        try:
+            with config.profiler.span("rule"):
+                await process(my_rule)
+        except Exception as e:  # One broken rule should not stop the others
+            print(f"Could not run rule #{my_rule.id}: {e!r}")
+        finally:
+            running.discard(my_rule.id)
+
+    async def run_batch(due: typing.List[BanRule]):
+        await asyncio.gather(*[run_rule(my_rule) for my_rule in due])
+        config.profiler.sweep_done()
+
+    # Check for due rules forever, sleep a little in between
+    try:
+        while True:
+            now = time.time()
+            all_rules = {rule["id"]: rule for rule in fetch_rules()}
+
+            # Forget deleted rules, (re)schedule new or modified ones with a random offset
+            for rule_id in list(schedule.keys()):
+                if rule_id not in all_rules:
+                    del schedule[rule_id]
+                    config.sweep_results.pop(rule_id, None)
+                    config.offender_stats.pop(rule_id, None)
+            for rule_id, rule in all_rules.items():
+                if rule_id not in schedule or schedule[rule_id][0] != rule:
+                    schedule[rule_id] = (rule, BanRule(rule), now + random.uniform(0, MIN_RULE_INTERVAL))
+
+            due = []
+            for rule_id, (rule, my_rule, next_run) in schedule.items():
+                if next_run <= now and rule_id not in running:
+                    due.append(my_rule)
+                    running.add(rule_id)
+                    schedule[rule_id] = (rule, my_rule, now + jittered(my_rule.interval * config.es_breaker.interval_factor()))
+            if due:
+                batch = asyncio.create_task(run_batch(due))
+                batches.add(batch)
+                batch.add_done_callback(batches.discard)
+            await asyncio.sleep(SCHEDULER_TICK)
+    finally:
+        for batch in batches:
+            batch.cancel()
+
+
+async def run(config: plugins.configuration.BlockyConfiguration):
+    """Runs the rules and expires list entries. If either fails, the other is stopped and the error raised,
+    so the coordinator notices and restarts both"""
+    if config.rule_workers:  # Searches run in worker processes, we only act on what they find
+        rules = plugins.workers.run(config)
+    else:
+        rules = run_schedule(config, config.store.rules, functools.partial(process_rule, config))
+    tasks = [asyncio.create_task(rules), asyncio.create_task(run_expiry(config))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:  # We might be stepping down as the active instance
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import math
+import typing
+import elasticsearch_dsl
+import plugins.background
+import plugins.configuration
+
+""" Rule backtesting against historical data, for Blocky/4 """
+
+BACKTEST_TOP_HITS = 1000  # Number of top clients to fetch for a backtest, at most
+BACKTEST_BUCKETS = 240  # Number of time buckets per client at most, so shorter durations can be derived from one search
+MIN_BACKTEST_BUCKETS = 24  # Never go coarser than this, though, when shrinking a search to fit in max_buckets
+MAX_BUCKETS_HEADROOM = 0.9  # Only use 90% of ES' search.max_buckets, it also counts some buckets we don't
+BACKTEST_CACHE_SIZE = 32  # Number of rule/end time combinations to keep historical aggregations around for
+MAX_BACKTEST_WINDOW = 86400 * 30  # Don't search more than 30 days back
+
+
+def index_names(config: "plugins.configuration.BlockyConfiguration", start: int, end: int) -> typing.List[str]:
+    """Returns the names of the daily indices covering the time span from $start to $end, if they exist"""
+    names = []
+    day = datetime.datetime.utcfromtimestamp(start).date()
+    last_day = datetime.datetime.utcfromtimestamp(end).date()
+    while day <= last_day:
+        name = day.strftime(config.index_pattern)
+        if name not in names:
+            names.append(name)
+        day += datetime.timedelta(days=1)
+    return names
+
+
+async def historical_indices(config: "plugins.configuration.BlockyConfiguration", start: int, end: int) -> typing.List[str]:
+    """Returns the names of existing indices covering the time span from $start to $end, looked up in one go"""
+    names = index_names(config, start, end)
+    existing = await config.es_breaker.call(
+        config.elasticsearch.indices.get,
+        index=",".join(names),
+        ignore_unavailable=True,
+        allow_no_indices=True,
+        filter_path="*.settings.index.provided_name",  # We only need the names, not every mapping
+    )
+    return [name for name in names if name in existing]
+
+
+def query_shape(max_buckets: int, top_hits: int) -> typing.Tuple[int, int]:
+    """Works out how many clients and time buckets per client a backtest can ask for, without the aggregation
+    exceeding $max_buckets: each client takes a bucket of its own, plus a time bucket for each interval, plus
+    one for the partial interval at the start. If $top_hits clients with BACKTEST_BUCKETS time buckets each do
+    not fit, both are shrunk by the same factor, and the time buckets no further than MIN_BACKTEST_BUCKETS.
+    Returns the number of clients and of time buckets."""
+    budget = int(max_buckets * MAX_BUCKETS_HEADROOM)
+    buckets = BACKTEST_BUCKETS
+    excess = top_hits * (buckets + 2) / budget
+    if excess > 1:
+        buckets = max(MIN_BACKTEST_BUCKETS, int(buckets / math.sqrt(excess)))
+    return max(1, min(top_hits, budget // (buckets + 2))), buckets
+
+
+def divisors(number: int) -> typing.List[int]:
+    """Returns every divisor of $number, smallest first"""
+    small = [divisor for divisor in range(1, math.isqrt(number) + 1) if number % divisor == 0]
+    return sorted(set(small + [number // divisor for divisor in small]))
+
+
+def bucket_size(window: int, buckets: int, durations: typing.Iterable[int] = ()) -> int:
+    """Picks the bucket size for a search over the last $window seconds, in at most $buckets time buckets.
+    Totals for a duration only count the buckets that start within it, so the buckets must add up to $window
+    exactly, and to as many of $durations as can be had. Whole minutes go first, then the finest size."""
+    durations = list(durations)
+    candidates = [size for size in divisors(window) if size >= window / buckets]
+    return min(
+        candidates,
+        key=lambda size: (sum(duration % size != 0 for duration in durations), size % 60 != 0, size),
+    )
+
+
+def historical_query(
+    config: "plugins.configuration.BlockyConfiguration",
+    aggtype: str,
+    filters: typing.List[str],
+    prefix4: int,
+    prefix6: int,
+    window: int,
+    end: int,
+    durations: typing.Iterable[int] = (),
+) -> typing.Tuple[elasticsearch_dsl.Search, int, bool]:
+    """Builds the search for historical_series. Returns the search, the bucket size in seconds and whether
+    clients need to be rolled up into networks afterwards."""
+    agg_field, agg_hits, rollup = plugins.background.aggregation_field(config, BACKTEST_TOP_HITS, prefix4, prefix6)
+    agg_hits, buckets = query_shape(config.es_max_buckets, agg_hits)
+    # Buckets are aligned to $end, so each duration they add up to covers whole buckets
+    granularity = bucket_size(window, buckets, durations)
+    start = end - window
+    q = elasticsearch_dsl.Search(using=config.elasticsearch)
+    q = q.filter(
+        "range", **{plugins.background.TIMESTAMP_NAME: {"gte": start * 1000, "lt": end * 1000, "format": "epoch_millis"}}
+    )
+    q = plugins.background.add_filters(q, filters)
+    if aggtype == "bytes":
+        clients = q.aggs.bucket(
+            "clients", elasticsearch_dsl.A("terms", field=agg_field, size=agg_hits, order={"bytes_sum": "desc"})
+        )
+        clients.metric("bytes_sum", "sum", field="bytes")
+    else:
+        clients = q.aggs.bucket("clients", elasticsearch_dsl.A("terms", field=agg_field, size=agg_hits))
+    over_time = clients.bucket(
+        "over_time",
+        "date_histogram",
+        field=plugins.background.TIMESTAMP_NAME,
+        fixed_interval=f"{granularity}s",
+        offset=f"+{end % granularity}s",
+        min_doc_count=1,
+    )
+    if aggtype == "bytes":
+        over_time.metric("bytes_sum", "sum", field="bytes")
+    return q, granularity, rollup
+
+
+async def historical_series(
+    config: "plugins.configuration.BlockyConfiguration",
+    aggtype: str,
+    filters: typing.List[str],
+    prefix4: int,
+    prefix6: int,
+    window: int,
+    end: int,
+    durations: typing.Iterable[int] = (),
+) -> typing.Tuple[dict, bool]:
+    """Fetches the top clients over the $window seconds before $end, bucketed over time, so totals for shorter
+    $durations ending at $end can be derived without searching again, as long as they are whole buckets.
+    Results are cached, and a cached search is reused for any window that is a whole number of its buckets.
+    Returns the aggregation and whether it came from the cache."""
+    cache_key = (aggtype, tuple(filters), prefix4, prefix6, end)
+    for cached in config.backtest_cache.get(cache_key, []):
+        if cached["window"] >= window and window % cached["granularity"] == 0:
+            config.backtest_cache.move_to_end(cache_key)
+            return cached, True
+
+    q, granularity, rollup = historical_query(config, aggtype, filters, prefix4, prefix6, window, end, durations)
+    start = end - window
+
+    series = {}
+    indices = await historical_indices(config, start, end)
+    if indices:
+        resp = await config.es_breaker.call(
+            config.elasticsearch.search, index=",".join(indices), body=q.to_dict(), size=0, timeout="30s"
+        )
+        for entry in resp.get("aggregations", {}).get("clients", {}).get("buckets", []):
+            client = entry["key"]
+            if rollup:
+                client = plugins.background.network_key(client, prefix4, prefix6)
+                if not client:
+                    continue
+            client_series = series.setdefault(client, {})
+            for bucket in entry["over_time"]["buckets"]:
+                value = int(bucket["bytes_sum"]["value"]) if aggtype == "bytes" else int(bucket["doc_count"])
+                timestamp = bucket["key"] // 1000
+                client_series[timestamp] = client_series.get(timestamp, 0) + value
+
+    result = {"window": window, "end": end, "granularity": granularity, "series": series}
+    config.backtest_cache.setdefault(cache_key, []).append(result)
+    config.backtest_cache.move_to_end(cache_key)
+    while len(config.backtest_cache) > BACKTEST_CACHE_SIZE:
+        config.backtest_cache.popitem(last=False)
+    return result, False
+
+
+def totals(result: dict, duration: int) -> typing.List[typing.Tuple[str, int]]:
+    """Sums up each client's buckets within the last $duration seconds of a historical aggregation, largest first.
+    $duration must be a whole number of its buckets, see historical_series."""
+    start = result["end"] - duration
+    client_totals = []
+    for client, client_series in result["series"].items():
+        total = sum(value for timestamp, value in client_series.items() if timestamp >= start)
+        if total:
+            client_totals.append((client, total))
+    return sorted(client_totals, key=lambda x: x[1], reverse=True)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import time
+import typing
+import elasticsearch
+
+""" Circuit breaker and adaptive query shaping for ElasticSearch queries """
+
+BREAKER_WINDOW = 20  # Number of recent queries to base the error rate on
+BREAKER_MIN_SAMPLES = 5  # Don't judge the error rate until we have at least this many queries
+BREAKER_ERROR_RATE = 0.5  # Open the circuit when half the recent queries fail...
+BREAKER_CONSECUTIVE_FAILURES = 3  # ...or when this many fail in a row
+BREAKER_COOLDOWN = 30  # Seconds to wait before probing ES again after opening the circuit
+BREAKER_MAX_COOLDOWN = 600  # Cooldown doubles on every failed probe, up to 10 minutes
+LATENCY_SMOOTHING = 0.3  # Weight of the newest query latency in the moving average
+
+# Pressure levels: (average latency in seconds, error rate) at or above which the level applies
+PRESSURE_THRESHOLDS = [
+    (0, 0),  # 0: normal
+    (5, 0.2),  # 1: ES is slow, back off a bit
+    (15, 0.4),  # 2: ES is struggling, back off a lot
+]
+PRESSURE_INTERVAL_FACTOR = [1, 2, 4]  # Rule intervals are multiplied by this
+PRESSURE_SIZE_DIVISOR = [1, 2, 4]  # Aggregation sizes are divided by this
+PRESSURE_MAX_CONCURRENCY = [None, 2, 1]  # Max concurrent queries (None = as configured)
+
+# Errors that count against ES health. Any other transport error (a bad query, a missing index) is our problem, not ES'
+ES_FAILURES = (asyncio.TimeoutError, elasticsearch.exceptions.ConnectionError)  # Includes ConnectionTimeout
+ES_FAILURE_STATUS = (429,)  # ...as do these HTTP status codes, as well as any 5xx
+
+
+def is_es_failure(e: BaseException) -> bool:
+    """Whether an exception raised by a query means ES is unavailable or overloaded"""
+    if isinstance(e, ES_FAILURES):
+        return True
+    if isinstance(e, elasticsearch.exceptions.TransportError):
+        status = e.status_code
+        return isinstance(status, int) and (status >= 500 or status in ES_FAILURE_STATUS)
+    return False
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, concurrency: int = 4):
+        self.max_concurrency = concurrency
+        self.state = "closed"  # closed (all good), open (no queries), half-open (a single probe query is allowed)
+        self.outcomes = collections.deque(maxlen=BREAKER_WINDOW)  # True for success, False for failure
+        self.consecutive_failures = 0
+        self.latency = 0.0  # Moving average of query latency, in seconds
+        self.open_until = 0.0
+        self.trips = 0  # Number of times we opened in a row, for the exponential cooldown
+        self.probing = False
+        self.inflight = 0
+        self.waiting = 0  # Queries waiting for a free slot
+        self.condition = asyncio.Condition()
+
+    @property
+    def error_rate(self) -> float:
+        if len(self.outcomes) < BREAKER_MIN_SAMPLES:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    @property
+    def pressure(self) -> int:
+        """How much ES is struggling, from 0 (not at all) to 2 (a lot)"""
+        level = 0
+        for i, (latency, error_rate) in enumerate(PRESSURE_THRESHOLDS):
+            if i and (self.latency >= latency or self.error_rate >= error_rate):
+                level = i
+        return level
+
+    @property
+    def concurrency(self) -> int:
+        limit = PRESSURE_MAX_CONCURRENCY[self.pressure]
+        return limit and min(limit, self.max_concurrency) or self.max_concurrency
+
+    def interval_factor(self) -> int:
+        """Rules should run this many times less often than usual"""
+        if self.state != "closed":
+            return PRESSURE_INTERVAL_FACTOR[-1]
+        return PRESSURE_INTERVAL_FACTOR[self.pressure]
+
+    def size(self, size: int) -> int:
+        """Shrinks an aggregation size according to the current pressure"""
+        return max(1, size // PRESSURE_SIZE_DIVISOR[self.pressure])
+
+    def allow(self) -> bool:
+        """Whether a query may be sent right now. Moves the circuit to half-open once the cooldown is over"""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.time() >= self.open_until:
+            self.state = "half-open"
+            self.probing = False
+        if self.state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def trip(self):
+        cooldown = min(BREAKER_MAX_COOLDOWN, BREAKER_COOLDOWN * (2 ** self.trips))
+        self.trips += 1
+        self.state = "open"
+        self.probing = False
+        self.open_until = time.time() + cooldown
+        print(f"ElasticSearch circuit breaker opened, pausing queries for {cooldown} seconds")
+
+    def record(self, success: bool, latency: float):
+        self.latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+        self.outcomes.append(success)
+        if success:
+            self.consecutive_failures = 0
+            if self.state == "half-open":
+                print("ElasticSearch circuit breaker closed, resuming queries")
+                self.state = "closed"
+                self.probing = False
+                self.trips = 0
+                self.outcomes.clear()
+        else:
+            self.consecutive_failures += 1
+            if self.state == "half-open":
+                self.trip()
+            elif self.state == "closed" and (
+                self.consecutive_failures >= BREAKER_CONSECUTIVE_FAILURES or self.error_rate >= BREAKER_ERROR_RATE
+            ):
+                self.trip()
+
+    async def call(self, func: typing.Callable[..., typing.Awaitable], *args, **kwargs):
+        """Runs an ES query through the breaker, waiting for a free slot if too many are already running.
+        Raises CircuitOpenError if the circuit is open."""
+        if not self.allow():
+            raise CircuitOpenError(f"ElasticSearch circuit breaker is {self.state}, not sending queries")
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(lambda: self.inflight < self.concurrency)
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+        started = time.time()
+        recorded = False
+        try:
+            result = await func(*args, **kwargs)
+            self.record(True, time.time() - started)
+            recorded = True
+            return result
+        except Exception as e:
+            if is_es_failure(e):
+                self.record(False, time.time() - started)
+                recorded = True
+            raise
+        finally:
+            if not recorded and self.state == "half-open":
+                self.probing = False  # Probe was cancelled or broke for other reasons, let someone else try
+            async with self.condition:
+                self.inflight -= 1
+                self.condition.notify_all()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "pressure": self.pressure,
+            "error_rate": round(self.error_rate, 3),
+            "latency": round(self.latency, 3),
+            "open_until": self.state != "closed" and int(self.open_until) or None,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "concurrency": self.concurrency,
+            "interval_factor": self.interval_factor(),
+        }
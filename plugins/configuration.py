@@ -18,15 +18,31 @@
 
 # Configuration objects for Blocky/4
 
-import asfpy.sqlite
+import collections
 import elasticsearch
-import plugins.db_create
+import os
+import socket
+import plugins.breaker
+import plugins.coordinator
 import plugins.lists
+import plugins.profiling
+import plugins.snapshot
+import plugins.storage
 
 
 DEFAULT_EXPIRE = 86400 * 30 * 4  # Default expiry of auto-bans = 4 months
 DEFAULT_INDEX_PATTERN = "loggy-%Y-%m-%d"
 DEFAULT_HOST_BLOCK = "*"  # Default hostname to block on. * means all hosts
+DEFAULT_EXPIRY_INTERVAL = 15  # Check for expired allow/block entries every 15 seconds
+DEFAULT_SNAPSHOT_INTERVAL = 60  # Snapshot the allow/block lists every minute, if they have changed
+DEFAULT_PREFIX_FIELD_LENGTHS = [24, 64]  # IPv4 and IPv6 prefix lengths of the ingest-time prefix field, if any
+DEFAULT_ES_CONCURRENCY = 4  # Max number of concurrent ES queries when ES is healthy
+DEFAULT_ES_MAX_BUCKETS = 65535  # Default search.max_buckets of ES 7.9 and up
+DEFAULT_LOOP_LAG_THRESHOLD = 0.1  # When debugging, record anything blocking the event loop for more than 100ms
+DEFAULT_AUDIT_RETENTION = 90  # Keep 90 days of audit log entries in the live table, archive the rest
+DEFAULT_STORAGE = "sqlite"  # Storage backend for lists, rules and the audit log
+DEFAULT_STORAGE_PATH = "blocky4.store"  # Base path of the files of the log storage backend
+DEFAULT_LEASE_TTL = 30  # A standby takes over the background workers 30 seconds after the active instance goes quiet
 
 # These IP blocks should always be allowed and never blocked, or else...
 DEFAULT_ALLOW_LIST = [
@@ -39,34 +55,66 @@ DEFAULT_ALLOW_LIST = [
 class BlockyConfiguration:
     def __init__(self, yml):
         self.database_filepath = yml.get("database", "blocky.sqlite")
-        self.sqlite = asfpy.sqlite.DB(self.database_filepath)
+        self.storage = yml.get("storage", DEFAULT_STORAGE)
+        self.storage_path = yml.get("storage_path", DEFAULT_STORAGE_PATH)
+        storage_options = {}
+        if self.storage == "log":
+            storage_options["fsync"] = yml.get("storage_fsync", plugins.storage.DEFAULT_LOG_FSYNC)
+        self.store = plugins.storage.open_store(
+            self.storage, self.storage == "sqlite" and self.database_filepath or self.storage_path, **storage_options
+        )
         self.default_expire_seconds = yml.get("default_expire", DEFAULT_EXPIRE)
         self.index_pattern = yml.get("index_pattern", DEFAULT_INDEX_PATTERN)
+        self.prefix_field = yml.get("prefix_field")  # ES field holding the client's network (CIDR), set at ingest
+        self.prefix_field_lengths = [int(x) for x in yml.get("prefix_field_lengths", DEFAULT_PREFIX_FIELD_LENGTHS)]
         self.elasticsearch_url = yml.get("elasticsearch_url")
         self.elasticsearch = elasticsearch.AsyncElasticsearch(hosts=[self.elasticsearch_url])
+        self.rule_workers = int(yml.get("rule_workers", 0))  # Number of worker processes to run rules in. 0 = run them here
+        self.worker_status = []  # What each rule worker is up to, if any
+        self.es_breaker = plugins.breaker.CircuitBreaker(concurrency=int(yml.get("es_concurrency", DEFAULT_ES_CONCURRENCY)))
+        self.es_max_buckets = int(yml.get("es_max_buckets", DEFAULT_ES_MAX_BUCKETS))  # ES' search.max_buckets setting
         self.http_ip = yml.get("bind_ip", "127.0.0.1")
         self.http_port = int(yml.get("bind_port", 8080))
         self.client_iptables = {}  # Uploaded iptables from blocky clients. Only kept in memory.
+        self.sweep_results = {}  # Last top clients result of each rule, by rule id. Only kept in memory.
+        self.sweep_inflight = {}  # Currently running top clients searches, by rule id
+        self.offender_cache = collections.OrderedDict()  # Allow/block list decisions for offenders, by IP/CIDR, least recently seen first
+        self.offender_stats = {}  # How many offenders each rule checked, skipped and blocked, by rule id
+        self.profiler = plugins.profiling.Profiler(
+            enabled=bool(yml.get("debug", False)),
+            lag_threshold=float(yml.get("loop_lag_threshold", DEFAULT_LOOP_LAG_THRESHOLD)),
+        )
+        self.backtest_cache = collections.OrderedDict()  # Historical aggregations for backtests, least recently used first
+        self.stream_enabled = bool(yml.get("stream_enabled", False))
+        self.stream_tail = yml.get("stream_tail")  # Optional log file (JSON lines) to feed to the stream detection
+        self.stream = None  # Streaming detection engine, set up at start-up if enabled
         self.pubsub_host = yml.get('pubsub_host')
         self.pubsub_user = yml.get('pubsub_user')
         self.pubsub_password = yml.get('pubsub_password')
+        self.expiry_interval = int(yml.get("expiry_interval", DEFAULT_EXPIRY_INTERVAL))
+        self.audit_retention_days = int(yml.get("audit_retention", DEFAULT_AUDIT_RETENTION))
+        self.snapshot_filepath = yml.get("list_snapshot", self.database_filepath + ".snapshot")
+        self.snapshot_interval = int(yml.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL))
+        self.snapshot_counter = None  # Change counter of the lists at the time of the last snapshot
+        self.instance_id = str(yml.get("instance_id") or f"{socket.gethostname()}:{os.getpid()}")
+        self.lease_ttl = int(yml.get("lease_ttl", DEFAULT_LEASE_TTL))
+        self.lists_synced = 0  # Last list change (from any instance) reflected in the in-memory lists
 
-        # Create table if not there yet
-        new_db = False
-        if not self.sqlite.table_exists("rules"):
-            print(f"Database file {self.database_filepath} is empty, initializing tables")
-            self.sqlite.run(plugins.db_create.CREATE_DB_RULES)
-            self.sqlite.run(plugins.db_create.CREATE_DB_LISTS)
-            self.sqlite.run(plugins.db_create.CREATE_DB_AUDIT)
-            print(f"Database file {self.database_filepath} has been successfully initialized")
-            new_db = True
-
-        # Init and fetch existing blocks and allows
-        self.block_list = plugins.lists.List(self, "block")
-        self.allow_list = plugins.lists.List(self, "allow")
+        # Init and fetch existing blocks and allows, from a snapshot if we have a current one.
+        # Changes made by other instances from here on are picked up through the list change log.
+        self.lists_synced = self.store.latest_list_change()
+        counter = self.store.lists_version()
+        snapshot = None
+        if self.store.list_snapshots:
+            snapshot = plugins.snapshot.read(self.snapshot_filepath, counter)
+        if snapshot:
+            print(f"Loading allow/block lists from snapshot {self.snapshot_filepath}")
+            self.snapshot_counter = counter
+        self.block_list = plugins.lists.List(self, "block", snapshot and snapshot["block"])
+        self.allow_list = plugins.lists.List(self, "allow", snapshot and snapshot["allow"])
 
         # Seed new DB with default allows if needed
-        if new_db:
+        if self.store.created:
             for entry in DEFAULT_ALLOW_LIST:
                 self.allow_list.add(
                     ip=entry,
@@ -76,6 +124,8 @@ class BlockyConfiguration:
                     host="*",
                 )
 
+        self.coordinator = plugins.coordinator.Coordinator(self)
+
     async def test_es(self):
         i = await self.elasticsearch.info()
         es_major = int(i["version"]["number"].split(".")[0])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+import typing
+import plugins.configuration
+import plugins.storage
+
+""" Active/standby coordination between Blocky/4 instances sharing a database """
+
+LEASE_NAME = "background"  # Name of the lease row the background workers are guarded by
+LEASE_RENEW_FRACTION = 3  # Renew the lease three times per lease period
+LIST_SYNC_INTERVAL = 2  # Pick up list changes made by other instances every 2 seconds
+CHANGELOG_RETENTION = 86400  # Keep a day's worth of list changes around
+CHANGELOG_PRUNE_INTERVAL = 3600  # Prune the list change log every hour
+
+
+class Coordinator:
+    """Holds (or waits for) the background worker lease. Only the instance holding the lease runs
+    the rule sweeps, expiry, audit retention and stream evaluation, so offenders are never handled twice."""
+
+    def __init__(self, config: "plugins.configuration.BlockyConfiguration"):
+        self.config = config
+        self.instance_id = config.instance_id
+        self.ttl = config.lease_ttl
+        self.leader = False
+        self.holder = None  # Instance currently holding the lease, as far as we know
+        self.lease_expires = 0.0  # When our own lease runs out, unless renewed
+        self.leader_since = None
+        self.workers: typing.List[typing.Callable[[], typing.Awaitable]] = []
+        self.tasks: typing.List[asyncio.Task] = []
+        self.restarts = 0  # Background workers restarted after they stopped on their own
+
+    def try_acquire(self) -> bool:
+        """Takes or renews the lease, if it is ours or has expired. Returns whether we hold it now"""
+        try:
+            row = self.config.store.acquire_lease(LEASE_NAME, self.instance_id, self.ttl)
+        except plugins.storage.STORAGE_ERRORS as e:  # Database busy, try again next time
+            print(f"Could not renew the background worker lease: {e}")
+            return False
+        self.holder = row and row["holder"]
+        if self.holder == self.instance_id:
+            self.lease_expires = row["expires"]
+            return True
+        return False
+
+    def release(self):
+        """Gives up the lease, so a standby can take over right away"""
+        self.config.store.release_lease(LEASE_NAME, self.instance_id)
+
+    def step_up(self, workers: typing.List[typing.Callable[[], typing.Awaitable]]):
+        print(f"Instance {self.instance_id} is now the active instance, starting background workers")
+        self.leader = True
+        self.leader_since = int(time.time())
+        sync_lists(self.config)  # Make sure we act on the latest lists
+        self.workers = workers
+        self.tasks = [asyncio.create_task(worker()) for worker in workers]
+
+    def revive(self):
+        """Restarts background workers that stopped on their own, for instance on a database error. Holding the
+        lease with a worker gone would leave its job undone on every instance."""
+        for i, task in enumerate(self.tasks):
+            if task.done():
+                error = None if task.cancelled() else task.exception()
+                print(f"Background worker {task.get_coro().__qualname__} stopped ({error!r}), restarting it")
+                self.tasks[i] = asyncio.create_task(self.workers[i]())
+                self.restarts += 1
+
+    def step_down(self):
+        print(f"Instance {self.instance_id} is no longer the active instance, stopping background workers")
+        self.leader = False
+        self.leader_since = None
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def run(self, workers: typing.List[typing.Callable[[], typing.Awaitable]]):
+        """Competes for the lease forever, running $workers for as long as we hold it"""
+        try:
+            while True:
+                if self.try_acquire():
+                    if not self.leader:
+                        self.step_up(workers)
+                    else:
+                        self.revive()
+                elif self.leader and (
+                    self.holder != self.instance_id
+                    or time.time() >= self.lease_expires - self.ttl / LEASE_RENEW_FRACTION
+                ):
+                    self.step_down()  # Someone else has taken over, or is about to
+                await asyncio.sleep(self.ttl / LEASE_RENEW_FRACTION)
+        finally:
+            if self.leader:
+                self.step_down()
+                self.release()
+
+    def status(self) -> dict:
+        return {
+            "instance": self.instance_id,
+            "leader": self.leader,
+            "leader_since": self.leader_since,
+            "holder": self.holder,
+            "lease_ttl": self.ttl,
+            "lists_synced": self.config.lists_synced,
+            "restarts": self.restarts,
+        }
+
+
+def sync_lists(config: "plugins.configuration.BlockyConfiguration"):
+    """Applies list changes made by other instances since we last looked, without reloading the lists.
+    Changes we made ourselves are already in memory, and are skipped."""
+    for change in config.store.list_changes(config.lists_synced):
+        if change["type"] == "block":
+            target = config.block_list
+        elif change["type"] == "allow":
+            target = config.allow_list
+        else:
+            target = None
+        if target is not None:
+            if change["op"] == "delete":
+                target.forget(change["row_id"])
+            else:
+                row = config.store.list_entry(change["row_id"])
+                if row and row["type"] == change["type"]:  # Skip rows that have since been removed or moved
+                    target.learn(row)
+        config.lists_synced = change["seq"]
+
+
+async def run_sync(config: "plugins.configuration.BlockyConfiguration"):
+    """Keeps the in-memory lists in step with the database, on every instance"""
+    while True:
+        await asyncio.sleep(LIST_SYNC_INTERVAL)
+        try:
+            sync_lists(config)
+        except plugins.storage.STORAGE_ERRORS as e:
+            print(f"Could not sync lists with the database, retrying: {e}")
+
+
+async def run_pruning(config: "plugins.configuration.BlockyConfiguration"):
+    """Trims the list change log. Only run by the active instance"""
+    while True:
+        try:
+            config.store.prune_list_changes(int(time.time()) - CHANGELOG_RETENTION)
+        except plugins.storage.STORAGE_ERRORS as e:
+            print(f"Could not prune the list change log: {e}")
+        await asyncio.sleep(CHANGELOG_PRUNE_INTERVAL)
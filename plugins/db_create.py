@@ -25,10 +25,107 @@ CREATE TABLE "rules" (
 	"aggtype"	TEXT NOT NULL,
 	"limit"	INTEGER NOT NULL,
 	"duration"	TEXT NOT NULL,
-	"filters"	TEXT
+	"filters"	TEXT,
+	"interval"	INTEGER,
+	"prefix4"	INTEGER,
+	"prefix6"	INTEGER
 );
 """
 
+CREATE_DB_AUDIT_ARCHIVE = """
+CREATE TABLE "auditlog_archive" (
+	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+	"start_timestamp"	INTEGER NOT NULL,
+	"start_id"	INTEGER NOT NULL,
+	"end_timestamp"	INTEGER NOT NULL,
+	"end_id"	INTEGER NOT NULL,
+	"entries"	INTEGER NOT NULL,
+	"networks"	TEXT,
+	"data"	BLOB NOT NULL
+);
+"""
+
+CREATE_DB_COUNTERS = """
+CREATE TABLE "counters" (
+	"name"	TEXT NOT NULL PRIMARY KEY,
+	"value"	INTEGER NOT NULL
+);
+"""
+
+CREATE_DB_LIST_CHANGES = """
+CREATE TABLE "list_changes" (
+	"seq"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+	"op"	TEXT NOT NULL,
+	"row_id"	INTEGER NOT NULL,
+	"type"	TEXT NOT NULL,
+	"timestamp"	INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+);
+"""
+
+CREATE_DB_LEASES = """
+CREATE TABLE "leases" (
+	"name"	TEXT NOT NULL PRIMARY KEY,
+	"holder"	TEXT NOT NULL,
+	"expires"	REAL NOT NULL
+);
+"""
+
+# Indexes are (re)created on every start-up, so they are all IF NOT EXISTS
+CREATE_DB_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS "auditlog_timestamp_id" ON "auditlog" ("timestamp", "id");',
+    'CREATE INDEX IF NOT EXISTS "auditlog_ip_start" ON "auditlog" ("ip_start");',
+    'CREATE INDEX IF NOT EXISTS "auditlog_archive_end" ON "auditlog_archive" ("end_timestamp", "end_id");',
+    'CREATE INDEX IF NOT EXISTS "list_changes_timestamp" ON "list_changes" ("timestamp");',
+    'DROP INDEX IF EXISTS "auditlog_ip";',  # Superseded by auditlog_ip_start
+]
+
+# Change counters, bumped by triggers on every modification. Also (re)created on every start-up.
+CREATE_DB_TRIGGERS = [
+    """INSERT OR IGNORE INTO "counters" ("name", "value") VALUES ('lists', 0);""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_insert_counter" AFTER INSERT ON "lists"
+       BEGIN UPDATE "counters" SET "value" = "value" + 1 WHERE "name" = 'lists'; END;""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_update_counter" AFTER UPDATE ON "lists"
+       BEGIN UPDATE "counters" SET "value" = "value" + 1 WHERE "name" = 'lists'; END;""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_delete_counter" AFTER DELETE ON "lists"
+       BEGIN UPDATE "counters" SET "value" = "value" + 1 WHERE "name" = 'lists'; END;""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_insert_changelog" AFTER INSERT ON "lists"
+       BEGIN INSERT INTO "list_changes" ("op", "row_id", "type") VALUES ('insert', NEW."id", NEW."type"); END;""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_update_changelog" AFTER UPDATE ON "lists"
+       BEGIN
+         INSERT INTO "list_changes" ("op", "row_id", "type") VALUES ('delete', OLD."id", OLD."type");
+         INSERT INTO "list_changes" ("op", "row_id", "type") VALUES ('insert', NEW."id", NEW."type");
+       END;""",
+    """CREATE TRIGGER IF NOT EXISTS "lists_delete_changelog" AFTER DELETE ON "lists"
+       BEGIN INSERT INTO "list_changes" ("op", "row_id", "type") VALUES ('delete', OLD."id", OLD."type"); END;""",
+]
+
+# Tables added after the initial release of Blocky/4: table -> statement
+UPGRADE_DB_TABLES = {
+    "auditlog_archive": CREATE_DB_AUDIT_ARCHIVE,
+    "counters": CREATE_DB_COUNTERS,
+    "list_changes": CREATE_DB_LIST_CHANGES,
+    "leases": CREATE_DB_LEASES,
+}
+
+# Upgrades for databases created by older versions of Blocky/4: table -> column -> statement
+UPGRADE_DB_COLUMNS = {
+    "auditlog": {
+        "ip_start": 'ALTER TABLE "auditlog" ADD COLUMN "ip_start" TEXT;',
+        "ip_end": 'ALTER TABLE "auditlog" ADD COLUMN "ip_end" TEXT;',
+    },
+    "auditlog_archive": {
+        "networks": 'ALTER TABLE "auditlog_archive" ADD COLUMN "networks" TEXT;',
+    },
+    "lists": {
+        "rule": 'ALTER TABLE "lists" ADD COLUMN "rule" INTEGER;',
+    },
+    "rules": {
+        "interval": 'ALTER TABLE "rules" ADD COLUMN "interval" INTEGER;',
+        "prefix4": 'ALTER TABLE "rules" ADD COLUMN "prefix4" INTEGER;',
+        "prefix6": 'ALTER TABLE "rules" ADD COLUMN "prefix6" INTEGER;',
+    },
+}
+
 CREATE_DB_LISTS = """
 CREATE TABLE "lists" (
 	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
@@ -37,7 +134,8 @@ CREATE TABLE "lists" (
 	"reason"	TEXT NOT NULL,
 	"timestamp"	INTEGER NOT NULL,
 	"expires"	INTEGER NOT NULL,
-	"host"	TEXT NOT NULL
+	"host"	TEXT NOT NULL,
+	"rule"	INTEGER
 );
 """
 
@@ -46,7 +144,9 @@ CREATE TABLE "auditlog" (
 	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
 	"ip"	TEXT NOT NULL,
 	"event"	TEXT NOT NULL,
-	"timestamp"	INTEGER NOT NULL
+	"timestamp"	INTEGER NOT NULL,
+	"ip_start"	TEXT,
+	"ip_end"	TEXT
 );
 """
 
@@ -15,6 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import itertools
 import netaddr
 import time
 import plugins.configuration
@@ -24,6 +26,16 @@ import asyncio
 
 """ Block- and Allow-list handlers """
 
+HYDRATE_CHUNK_SIZE = 500  # Number of snapshot records to hydrate per database query
+ADDRESS_BITS = {4: 32, 6: 128}  # Address width of each IP version
+
+
+def network_bounds(version: int, prefixlen: int, value: int) -> typing.Tuple[int, int]:
+    """Returns the first and last address of a network, as integers"""
+    host_bits = ADDRESS_BITS[version] - prefixlen
+    first = value >> host_bits << host_bits
+    return first, first | ((1 << host_bits) - 1)
+
 
 class BlockListException(BaseException):
     def __init__(self, string: str):
@@ -34,27 +46,182 @@ class BlockListException(BaseException):
 
 
 class IPEntry(dict):
-    def __init__(self, ip: str, timestamp: int, expires: int, reason: str = None, host: str = "*"):
-        dict.__init__(self, ip=ip, timestamp=timestamp, expires=expires, reason=reason, host=host)
-        self.network = netaddr.IPNetwork(ip)
+    def __init__(
+        self,
+        ip: str,
+        timestamp: int,
+        expires: int,
+        reason: str = None,
+        host: str = "*",
+        rowid: int = None,
+        network: netaddr.IPNetwork = None,
+        rule: int = None,
+    ):
+        dict.__init__(self, ip=ip, timestamp=timestamp, expires=expires, reason=reason, host=host, rule=rule)
+        self.network = network or netaddr.IPNetwork(ip)
+        self.rowid = rowid
 
 
 class List:
-    def __init__(self, state: "plugins.configuration.BlockyConfiguration", list_type: str = "block"):
+    def __init__(
+        self,
+        state: "plugins.configuration.BlockyConfiguration",
+        list_type: str = "block",
+        snapshot: typing.Optional[typing.List["plugins.snapshot.SnapshotRecord"]] = None,
+    ):
         self.type = list_type
         self.list = []
         self.state = state
+        self.pending = {}  # Snapshot records not yet hydrated into IPEntry objects, by row id
+        self.hydrated = {}  # Hydrated entries, by row id
+        self.rowids = set()  # Database row ids of every entry we have, hydrated or not
+        # Where every entry starts, as (IP version, first address) -> {row id: last address}, and those keys in
+        # order. Built the first time overlaps are checked, so start-up does not pay for it.
+        self.starts: typing.Dict[typing.Tuple[int, int], typing.Dict[int, int]] = {}
+        self.start_keys: typing.Optional[typing.List[typing.Tuple[int, int]]] = None
+        self.additions = 0  # Bumped whenever an entry is added, so decisions based on the list can be invalidated
+        self.removals = 0  # Bumped whenever an entry is removed
 
-        for entry in state.sqlite.fetch("lists", type=list_type, limit=0):
-            self.list.append(
-                IPEntry(
-                    ip=entry["ip"],
-                    timestamp=entry["timestamp"],
-                    expires=entry["expires"],
-                    reason=entry["reason"],
-                    host=entry.get("host", "*"),
-                )
+        # If we have a valid snapshot, we only fetch the full rows once someone needs them
+        if snapshot is not None:
+            self.pending = {record[0]: record for record in snapshot}
+            self.rowids.update(self.pending)
+            return
+
+        for entry in state.store.list_entries(list_type):
+            ip_entry = IPEntry(
+                ip=entry["ip"],
+                timestamp=entry["timestamp"],
+                expires=entry["expires"],
+                reason=entry["reason"],
+                host=entry.get("host", "*"),
+                rowid=entry["id"],
+                rule=entry.get("rule"),
             )
+            self.list.append(ip_entry)
+            self.hydrated[ip_entry.rowid] = ip_entry
+            self.rowids.add(entry["id"])
+
+    def hydrate(self, limit: int = 0):
+        """Turns up to $limit (or all, if 0) pending snapshot records into full IPEntry objects"""
+        hydrated = 0
+        while self.pending and not (limit and hydrated >= limit):
+            chunk = [self.pending.pop(rowid) for rowid in list(itertools.islice(self.pending, HYDRATE_CHUNK_SIZE))]
+            self.hydrate_records(chunk)
+            hydrated += len(chunk)
+
+    def hydrate_records(self, records: typing.List["plugins.snapshot.SnapshotRecord"]):
+        """Fetches the full rows for a set of snapshot records and adds them to the list"""
+        networks = {rowid: netaddr.IPNetwork((value, prefixlen), version) for rowid, version, prefixlen, value in records}
+        for entry in self.state.store.list_entries_by_id(networks.keys()):
+            ip_entry = IPEntry(
+                ip=entry["ip"],
+                timestamp=entry["timestamp"],
+                expires=entry["expires"],
+                reason=entry["reason"],
+                host=entry["host"] or "*",
+                rowid=entry["id"],
+                network=networks[entry["id"]],
+                rule=entry.get("rule"),
+            )
+            self.list.append(ip_entry)
+            self.hydrated[ip_entry.rowid] = ip_entry
+
+    def hydrate_matching(self, ip: str):
+        """Hydrates only the pending records for a specific IP/CIDR, so lookups do not need the whole list"""
+        if not self.pending:
+            return
+        network = netaddr.IPNetwork(ip)
+        key = (network.version, network.prefixlen, network.value)
+        matches = [self.pending.pop(rowid) for rowid, record in list(self.pending.items()) if record[1:] == key]
+        if matches:
+            self.hydrate_records(matches)
+
+    def index(self, rowid: int, version: int, prefixlen: int, value: int):
+        """Records where an entry starts and ends, if the index has been built"""
+        if self.start_keys is None:
+            return
+        first, last = network_bounds(version, prefixlen, value)
+        key = (version, first)
+        if key not in self.starts:
+            self.starts[key] = {}
+            bisect.insort(self.start_keys, key)
+        self.starts[key][rowid] = last
+
+    def unindex(self, rowid: int, version: int, prefixlen: int, value: int):
+        """Drops an entry from the index, if the index has been built"""
+        if self.start_keys is None:
+            return
+        key = (version, network_bounds(version, prefixlen, value)[0])
+        rows = self.starts.get(key, {})
+        rows.pop(rowid, None)
+        if not rows and key in self.starts:
+            del self.starts[key]
+            del self.start_keys[bisect.bisect_left(self.start_keys, key)]
+
+    def overlapping(self, network: netaddr.IPNetwork) -> typing.List[IPEntry]:
+        """Returns the entries that lie within $network or contain it. The list is searched as integer ranges, and
+        only the pending entries among the matches are hydrated."""
+        if self.start_keys is None:
+            for rowid, version, prefixlen, value in self.records():
+                first, last = network_bounds(version, prefixlen, value)
+                self.starts.setdefault((version, first), {})[rowid] = last
+            self.start_keys = sorted(self.starts)
+        version, first, last = network.version, network.first, network.last
+        # Networks either lie within each other or not at all. Those within $network start within it...
+        rowids = []
+        start = bisect.bisect_left(self.start_keys, (version, first))
+        end = bisect.bisect_right(self.start_keys, (version, last))
+        for key in self.start_keys[start:end]:
+            rowids.extend(self.starts[key])
+        # ...and those containing it start where one of its supernets does
+        supernet_firsts = {network_bounds(version, prefixlen, first)[0] for prefixlen in range(network.prefixlen)}
+        supernet_firsts.discard(first)  # Already found above
+        for supernet_first in supernet_firsts:
+            rows = self.starts.get((version, supernet_first), {})
+            rowids.extend(rowid for rowid, row_last in rows.items() if row_last >= last)
+        records = [self.pending.pop(rowid) for rowid in rowids if rowid in self.pending]
+        if records:
+            self.hydrate_records(records)
+        return [self.hydrated[rowid] for rowid in rowids if rowid in self.hydrated]
+
+    def learn(self, entry: dict):
+        """Adds a row that another instance wrote to the database, without writing it again"""
+        if entry["id"] in self.rowids:
+            return
+        ip_entry = IPEntry(
+            ip=entry["ip"],
+            timestamp=entry["timestamp"],
+            expires=entry["expires"],
+            reason=entry["reason"],
+            host=entry["host"] or "*",
+            rowid=entry["id"],
+            rule=entry.get("rule"),
+        )
+        self.list.append(ip_entry)
+        self.hydrated[ip_entry.rowid] = ip_entry
+        self.index(ip_entry.rowid, ip_entry.network.version, ip_entry.network.prefixlen, ip_entry.network.value)
+        self.rowids.add(entry["id"])
+        self.additions += 1
+
+    def forget(self, rowid: int):
+        """Drops an entry that another instance removed from the database"""
+        if rowid not in self.rowids:
+            return
+        self.rowids.discard(rowid)
+        self.removals += 1
+        if rowid in self.pending:
+            self.unindex(*self.pending.pop(rowid))
+        elif rowid in self.hydrated:
+            entry = self.hydrated.pop(rowid)
+            self.unindex(rowid, entry.network.version, entry.network.prefixlen, entry.network.value)
+            self.list = [entry for entry in self.list if entry.rowid != rowid]
+
+    def records(self) -> typing.Iterator["plugins.snapshot.SnapshotRecord"]:
+        """Yields the compact snapshot records for every entry in the list"""
+        for entry in self.list:
+            yield entry.rowid, entry.network.version, entry.network.prefixlen, entry.network.value
+        yield from self.pending.values()
 
     def add(
         self,
@@ -64,21 +231,25 @@ class List:
         reason: str = None,
         host: str = None,
         force: bool = False,
+        rule: int = None,
+        keep_blocks: bool = False,
     ) -> None:
-        """Add an IP or IP Range to the allow/block list"""
+        """Add an IP or IP Range to the allow/block list. Conflicting entries are refused, or removed if $force is set.
+        With $keep_blocks, overlapping block list entries are neither a conflict nor removed.
+        $rule is the id of the rule that added the entry, if it was not added by hand."""
         now = int(time.time())
         if not timestamp:
             timestamp = now
         if not host:
-            host = plugins.configuration.DEFAULT_BLOCK_HOST
+            host = plugins.configuration.DEFAULT_HOST_BLOCK
         if isinstance(ip, str):
-            entry = IPEntry(ip=ip, timestamp=timestamp, expires=expires, reason=reason, host=host)
+            entry = IPEntry(ip=ip, timestamp=timestamp, expires=expires, reason=reason, host=host, rule=rule)
         elif isinstance(ip, IPEntry):
             entry = ip
 
         # Check if IP address conflicts with an entry on the allow list
         to_remove = []
-        for network in self.state.allow_list:
+        for network in self.state.allow_list.overlapping(entry.network):
             if entry.network in network.network or network.network in entry.network:
                 if force:
                     to_remove.append(network)
@@ -89,15 +260,16 @@ class List:
                     )
 
         # Check if IP address conflicts with an entry on the block list
-        for network in self.state.block_list:
-            if entry.network in network.network or network.network in entry.network:
-                if force:
-                    to_remove.append(network)
-                else:
-                    raise BlockListException(
-                        f"IP entry {ip} conflicts with block list entry {network.network}. "
-                        "Please address this or use force=true to override."
-                    )
+        if not keep_blocks:
+            for network in self.state.block_list.overlapping(entry.network):
+                if entry.network in network.network or network.network in entry.network:
+                    if force:
+                        to_remove.append(network)
+                    else:
+                        raise BlockListException(
+                            f"IP entry {ip} conflicts with block list entry {network.network}. "
+                            "Please address this or use force=true to override."
+                        )
 
         # If force=true and a conflict was found, remove the conflicting entry
         for d_entry in to_remove:
@@ -106,15 +278,15 @@ class List:
 
         # Now add the block
         self.list.append(entry)
+        self.additions += 1
         entry["type"] = self.type
-        self.state.sqlite.insert(
-            "lists",
-            entry,
-        )
+        entry.rowid = self.state.store.add_list_entry(entry)
+        self.hydrated[entry.rowid] = entry
+        self.index(entry.rowid, entry.network.version, entry.network.prefixlen, entry.network.value)
+        self.rowids.add(entry.rowid)
 
         # Add to audit log
-        self.state.sqlite.insert(
-            "auditlog",
+        self.state.store.add_audit_entry(
             {"ip": ip, "timestamp": int(time.time()), "event": f"IP {ip} added to the {self.type} list: {reason}"},
         )
 
@@ -142,17 +314,21 @@ class List:
     def remove(self, entry: typing.Union[str, IPEntry]):
         """Removes an IP/CIDR from the list"""
         if isinstance(entry, str):  # We want an IPEntry object. If given just an IP, find the object
+            self.hydrate_matching(entry)
             for x_entry in self.list:
                 if x_entry["ip"] == entry:
                     entry = x_entry
                     break
         # Only try to remove if we have an entry in our list
         if entry and isinstance(entry, IPEntry) and entry in self.list:
-            self.state.sqlite.delete("lists", type=self.type, ip=entry['ip'])
+            self.state.store.remove_list_entries(self.type, entry["ip"])
             self.list.remove(entry)
+            self.hydrated.pop(entry.rowid, None)
+            self.unindex(entry.rowid, entry.network.version, entry.network.prefixlen, entry.network.value)
+            self.rowids.discard(entry.rowid)
+            self.removals += 1
             # Add to audit log
-            self.state.sqlite.insert(
-                "auditlog",
+            self.state.store.add_audit_entry(
                 {
                     "ip": entry["ip"],
                     "timestamp": int(time.time()),
@@ -161,5 +337,14 @@ class List:
             )
 
     def __iter__(self):
-        for entry in self.list:
-            yield entry
+        """Yields every entry, hydrating pending ones a chunk at a time as the iteration gets to them"""
+        i = 0
+        while i < len(self.list) or self.pending:
+            if i >= len(self.list):
+                self.hydrate(HYDRATE_CHUNK_SIZE)
+                continue
+            yield self.list[i]
+            i += 1
+
+    def __len__(self):
+        return len(self.list) + len(self.pending)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import contextlib
+import cProfile
+import os
+import sys
+import threading
+import time
+import traceback
+import typing
+
+""" Opt-in profiling and event loop lag instrumentation for Blocky/4 """
+
+LAG_CHECK_INTERVAL = 0.05  # The event loop is expected to check in every 50ms
+MAX_LAG_INCIDENTS = 50  # Number of slow callbacks to keep around
+SAMPLE_INTERVAL = 0.005  # Sample the event loop's stack every 5ms when running the sampling profiler
+MAX_PROFILE_SECONDS = 300  # Never profile for more than 5 minutes
+
+
+class Profiler:
+    def __init__(self, enabled: bool = False, lag_threshold: float = 0.1):
+        self.enabled = enabled
+        self.lag_threshold = lag_threshold
+        self.incidents = collections.deque(maxlen=MAX_LAG_INCIDENTS)
+        self.spans: typing.Dict[str, dict] = {}
+        self.sweeps = 0
+        self.busy = False  # Whether a profile is currently being captured
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+
+    @contextlib.contextmanager
+    def _span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            span = self.spans.get(stage)
+            if span is None:
+                span = self.spans[stage] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+            span["count"] += 1
+            span["total"] += elapsed
+            span["last"] = elapsed
+            span["max"] = max(span["max"], elapsed)
+
+    def span(self, stage: str) -> typing.ContextManager:
+        """Times a stage of the sweep, if profiling is enabled"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._span(stage)
+
+    def sweep_done(self):
+        self.sweeps += 1
+
+    async def monitor(self):
+        """Checks in with the watchdog thread regularly. If we don't, the event loop is being hogged"""
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watchdog, name="blocky4-loop-watchdog", daemon=True).start()
+        while True:
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(LAG_CHECK_INTERVAL)
+
+    def watchdog(self):
+        """Runs in its own thread, recording what the event loop is doing whenever it is late to check in"""
+        incident = None
+        while True:
+            time.sleep(LAG_CHECK_INTERVAL)
+            lag = time.monotonic() - self.last_tick - LAG_CHECK_INTERVAL
+            if lag >= self.lag_threshold:
+                if incident is None:  # Grab the stack while the culprit is still running
+                    frame = sys._current_frames().get(self.loop_thread_id)
+                    incident = {
+                        "timestamp": int(time.time()),
+                        "lag": round(lag, 3),
+                        "stack": frame and traceback.format_stack(frame) or [],
+                    }
+                    self.incidents.append(incident)
+                else:
+                    incident["lag"] = round(lag, 3)
+            else:
+                incident = None
+
+    async def wait(self, seconds: float = 0, sweeps: int = 0):
+        """Waits for $seconds, or until $sweeps more sweeps have completed (at most MAX_PROFILE_SECONDS)"""
+        deadline = time.monotonic() + min(seconds or MAX_PROFILE_SECONDS, MAX_PROFILE_SECONDS)
+        target = self.sweeps + sweeps
+        while time.monotonic() < deadline:
+            if sweeps and self.sweeps >= target:
+                break
+            await asyncio.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+
+    async def cprofile(self, seconds: float = 0, sweeps: int = 0) -> cProfile.Profile:
+        """Profiles everything running on the event loop with cProfile"""
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.wait(seconds, sweeps)
+        finally:
+            profiler.disable()
+        profiler.create_stats()
+        return profiler
+
+    async def sample(self, seconds: float = 0, sweeps: int = 0) -> str:
+        """Samples the event loop's stack from another thread, returning collapsed stacks
+        (one 'frame;frame;frame count' line per stack), as used by flamegraph.pl and speedscope"""
+        thread_id = threading.get_ident()
+        counts = collections.Counter()
+        stop = threading.Event()
+
+        def sampler():
+            while not stop.wait(SAMPLE_INTERVAL):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                counts[";".join(reversed(stack))] += 1
+
+        sampler_thread = threading.Thread(target=sampler, name="blocky4-sampler", daemon=True)
+        sampler_thread.start()
+        try:
+            await self.wait(seconds, sweeps)
+        finally:
+            stop.set()
+            sampler_thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+
+    def status(self) -> dict:
+        return {
+            "lag_threshold": self.lag_threshold,
+            "incidents": list(self.incidents),
+            "sweeps": self.sweeps,
+            "spans": {
+                stage: {
+                    "count": span["count"],
+                    "total": round(span["total"], 3),
+                    "average": round(span["total"] / span["count"], 4),
+                    "max": round(span["max"], 4),
+                    "last": round(span["last"], 4),
+                }
+                for stage, span in self.spans.items()
+            },
+        }
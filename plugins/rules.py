@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import plugins.background
+
+""" Ban rule validation for Blocky/4 """
+
+DURATION_FORMAT = r"^\d+[dhms]"
+FILTER_OPERATORS = ["=", "~=", "=="]  # match, regexp and term queries, see plugins.background.add_filters
+
+
+def validate_filter(filter: str):
+    """Ensures every line of a search filter is a valid key, operator, value triplet.
+    Raises AssertionError if not."""
+    assert isinstance(filter, str), "filter must be a string of search filters, one per line"
+    for entry in filter.split("\n"):
+        entry = entry.strip()
+        if entry:
+            parts = entry.split(" ", 2)  # key, operator, value
+            assert len(parts) == 3, f"Search filter must be of the format 'key operator value': {entry}"
+            o = parts[1]
+            if o.startswith("!"):  # exclude as search param?
+                o = o[1:]
+            assert o in FILTER_OPERATORS, f"Unknown operator {parts[1]} in search filter: {entry}"
+
+
+def validate_duration(duration: str):
+    assert isinstance(duration, str) and re.match(DURATION_FORMAT, duration), "duration must be of format 0-99[d/h/m/s], for instance 24h or 45m"
+
+
+def parse_rule(formdata: dict) -> dict:
+    """Validates a new or modified rule from form data, and returns it as a rules table entry.
+    The limit may also be given as a list of limits (as backtests do), the first of which is used.
+    Raises AssertionError if anything is amiss."""
+    description = formdata.get("description")
+    assert description, "Please provide a description for your new rule"
+    aggtype = formdata.get("aggtype")
+    assert aggtype in ["requests", "bytes"], "aggtype must be either requests or bytes"
+    limit = formdata.get("limit")
+    if limit is None and isinstance(formdata.get("limits"), list) and formdata["limits"]:
+        limit = formdata["limits"][0]
+    limit = to_int(limit, "limit")
+    assert limit > 0, "limit must be greater than zero"
+    duration = formdata.get("duration")
+    validate_duration(duration)
+    filters = formdata.get("filter", "")
+    validate_filter(filters)
+    interval = to_int(formdata.get("interval") or 0, "interval")  # 0 means derive from duration
+    assert interval == 0 or interval >= plugins.background.MIN_RULE_INTERVAL, f"interval must be at least {plugins.background.MIN_RULE_INTERVAL} seconds, or empty for automatic"
+    prefix4 = to_int(formdata.get("prefix4") or 0, "prefix4")  # 0 means per IP, no network aggregation
+    assert prefix4 == 0 or plugins.background.MIN_PREFIX4 <= prefix4 <= 32, f"prefix4 must be between {plugins.background.MIN_PREFIX4} and 32, or empty for per-IP"
+    prefix6 = to_int(formdata.get("prefix6") or 0, "prefix6")
+    assert prefix6 == 0 or plugins.background.MIN_PREFIX6 <= prefix6 <= 128, f"prefix6 must be between {plugins.background.MIN_PREFIX6} and 128, or empty for per-IP"
+    return {
+        "description": description,
+        "aggtype": aggtype,
+        "limit": limit,
+        "duration": duration,
+        "filters": filters,
+        "interval": interval,
+        "prefix4": prefix4,
+        "prefix6": prefix6,
+    }
+
+
+def to_int(value, name: str) -> int:
+    """Converts a form value to an integer, raising AssertionError if it is not one"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise AssertionError(f"{name} must be a whole number")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import struct
+import typing
+import plugins.configuration
+import plugins.coordinator
+
+""" Compact binary snapshots of the allow/block lists, for fast start-up """
+
+SNAPSHOT_MAGIC = b"BLKY4SNP"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<8sHQI")  # magic, format version, lists change counter, number of records
+SNAPSHOT_RECORD = struct.Struct("<qBBBxQQ")  # row id, list type, IP version, prefix length, value (high, low 64 bits)
+LIST_TYPES = ["block", "allow"]
+LOW_BITS = (1 << 64) - 1
+
+# A snapshot record: (row id, IP version, prefix length, integer value of the address)
+SnapshotRecord = typing.Tuple[int, int, int, int]
+
+
+def write(filepath: str, counter: int, lists: typing.Dict[str, typing.Iterable[SnapshotRecord]]):
+    """Writes a snapshot of the lists atomically (temp file + rename)"""
+    records = bytearray()
+    count = 0
+    for list_type, list_records in lists.items():
+        type_id = LIST_TYPES.index(list_type)
+        for rowid, version, prefixlen, value in list_records:
+            records += SNAPSHOT_RECORD.pack(rowid, type_id, version, prefixlen, value >> 64, value & LOW_BITS)
+            count += 1
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"  # Instances sharing a snapshot file each use their own
+    with open(tmp_filepath, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, counter, count))
+        f.write(records)
+    os.replace(tmp_filepath, filepath)
+
+
+def read(filepath: str, counter: int) -> typing.Optional[typing.Dict[str, typing.List[SnapshotRecord]]]:
+    """Reads a snapshot, if one exists and matches the current change counter. Returns None otherwise"""
+    try:
+        with open(filepath, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < SNAPSHOT_HEADER.size:
+        return None
+    magic, snapshot_format, snapshot_counter, count = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or snapshot_format != SNAPSHOT_FORMAT or snapshot_counter != counter:
+        return None
+    if len(data) != SNAPSHOT_HEADER.size + count * SNAPSHOT_RECORD.size:
+        return None
+    lists = {list_type: [] for list_type in LIST_TYPES}
+    for rowid, type_id, version, prefixlen, high, low in SNAPSHOT_RECORD.iter_unpack(
+        memoryview(data)[SNAPSHOT_HEADER.size :]
+    ):
+        lists[LIST_TYPES[type_id]].append((rowid, version, prefixlen, (high << 64) | low))
+    return lists
+
+
+def save(config: "plugins.configuration.BlockyConfiguration"):
+    """Snapshots the current in-memory lists, if they have changed since the last snapshot"""
+    # Read the counter first, then catch up with other instances' changes: the lists then hold at least every
+    # change the counter covers. Changes made in between make the snapshot stale, never wrong, as they bump the
+    # counter past the one it is saved with.
+    counter = config.store.lists_version()
+    plugins.coordinator.sync_lists(config)
+    if counter != config.snapshot_counter:
+        write(
+            config.snapshot_filepath,
+            counter,
+            {"block": config.block_list.records(), "allow": config.allow_list.records()},
+        )
+        config.snapshot_counter = counter
+
+
+async def run(config: "plugins.configuration.BlockyConfiguration"):
+    """Periodically snapshots the lists"""
+    while config.store.list_snapshots:
+        try:
+            save(config)
+        except OSError as e:
+            print(f"Could not write list snapshot to {config.snapshot_filepath}: {e}")
+        await asyncio.sleep(config.snapshot_interval)
@@ -0,0 +1,799 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import asyncio
+import base64
+import bisect
+import fcntl
+import glob
+import json
+import netaddr
+import os
+import sqlite3
+import time
+import typing
+import asfpy.sqlite
+import plugins.configuration
+import plugins.db_create
+
+""" Storage backends for the allow/block lists, rules and audit log of Blocky/4 """
+
+LOG_COMPACT_RECORDS = 50000  # Fold the append-only log into a new snapshot once it holds this many records...
+LOG_COMPACT_INTERVAL = 300  # ...or every 5 minutes, if anything was written at all
+MAINTENANCE_INTERVAL = 10  # Check whether the store needs any housekeeping every 10 seconds
+LOG_FSYNC_POLICIES = ("never", "interval", "always")  # When log writes are fsync'ed, see LogStore
+DEFAULT_LOG_FSYNC = "interval"
+
+# Errors a store may raise when the underlying storage is temporarily unavailable
+STORAGE_ERRORS = (sqlite3.OperationalError, OSError)
+
+AuditCursor = typing.Tuple[int, int]  # (timestamp, id) of an audit log entry
+IPRange = typing.Tuple[str, str]  # First and last address of a network, as 32 hex digits in the IPv6 address space
+AUDIT_FIELDS = ["id", "ip", "event", "timestamp"]  # Audit entry fields, as returned by the stores
+AUDIT_COLUMNS = ", ".join(f'"{field}"' for field in AUDIT_FIELDS)
+SUMMARY_PREFIXES = {4: 16, 6: 32}  # Archive chunks record which IPv4 /16s and IPv6 /32s their entries are in
+
+
+def network_range(network: netaddr.IPNetwork) -> IPRange:
+    """Returns the range of addresses in a network. IPv4 maps onto ::ffff:0:0/96, so both families compare alike,
+    and fixed-width hex sorts like the numbers themselves, which SQLite integers are too small for"""
+    if network.version == 4:
+        network = network.ipv6(ipv4_compatible=False)
+    return f"{network.first:032x}", f"{network.last:032x}"
+
+
+def supernet_starts(network: netaddr.IPNetwork) -> typing.List[str]:
+    """Returns where each of the networks containing $network starts, the way network_range notes it"""
+    return [
+        network_range(netaddr.IPNetwork((network.value, prefixlen), network.version).cidr)[0]
+        for prefixlen in range(network.prefixlen)
+    ]
+
+
+def ip_range(ip: str) -> typing.Optional[IPRange]:
+    """Returns the range of addresses an audit entry's IP or CIDR covers, or None if it is neither"""
+    try:
+        return network_range(netaddr.IPNetwork(str(ip)))
+    except (netaddr.core.AddrFormatError, ValueError, TypeError):
+        return None
+
+
+def with_ip_range(entry: dict) -> dict:
+    """Adds the address range to an audit entry, if it does not have one yet"""
+    if "ip_start" not in entry:
+        entry["ip_start"], entry["ip_end"] = ip_range(entry["ip"]) or (None, None)
+    return entry
+
+
+def network_summary(ips: typing.Iterable[str]) -> str:
+    """Sums up which networks a set of IPs/CIDRs is in, as a JSON list of non-overlapping ranges, lowest first.
+    Networks are widened to SUMMARY_PREFIXES, which keeps this short while still ruling out most chunks."""
+    ranges = []
+    for ip in ips:
+        try:
+            network = netaddr.IPNetwork(str(ip))
+        except (netaddr.core.AddrFormatError, ValueError, TypeError):
+            continue
+        prefixlen = min(network.prefixlen, SUMMARY_PREFIXES[network.version])
+        ranges.append(network_range(netaddr.IPNetwork((network.value, prefixlen), network.version).cidr))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return json.dumps(merged)
+
+
+def summary_overlaps(summary: typing.Optional[str], wanted: IPRange) -> bool:
+    """Whether any of the networks in a network summary overlap $wanted. Without a summary, we can't tell"""
+    if summary is None:
+        return True
+    ranges = json.loads(summary)
+    i = bisect.bisect_right([start for start, _ in ranges], wanted[1]) - 1
+    return i >= 0 and ranges[i][1] >= wanted[0]
+
+
+class StorageException(Exception):
+    pass
+
+
+class Store(abc.ABC):
+    """The interface every storage backend implements. Rows are plain dicts, and every row has an integer id"""
+
+    created = False  # Whether the store was empty when opened, and should be seeded with defaults
+    persistent = True  # Whether anything survives a restart
+    list_snapshots = False  # Whether row ids are stable enough to use compact list snapshots for start-up
+
+    # Allow/block list entries
+    @abc.abstractmethod
+    def list_entries(self, list_type: typing.Optional[str] = None) -> typing.List[dict]:
+        """Returns all entries of a list, or of all lists if $list_type is None"""
+
+    @abc.abstractmethod
+    def list_entries_by_id(self, rowids: typing.Iterable[int]) -> typing.List[dict]:
+        ...
+
+    @abc.abstractmethod
+    def list_entry(self, rowid: int) -> typing.Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    def add_list_entry(self, entry: dict) -> int:
+        """Stores a new list entry, returning its row id"""
+
+    @abc.abstractmethod
+    def remove_list_entries(self, list_type: str, ip: str):
+        ...
+
+    @abc.abstractmethod
+    def lists_version(self) -> int:
+        """Returns a counter that changes whenever any list entry is added, changed or removed"""
+
+    @abc.abstractmethod
+    def list_changes(self, since: int) -> typing.List[dict]:
+        """Returns the list changes (seq, op, row_id, type) made after change $since, oldest first"""
+
+    @abc.abstractmethod
+    def latest_list_change(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def prune_list_changes(self, cutoff: int):
+        """Forgets list changes made before $cutoff"""
+
+    # Rules
+    @abc.abstractmethod
+    def rules(self) -> typing.List[dict]:
+        ...
+
+    @abc.abstractmethod
+    def rule(self, rule_id: typing.Union[int, str]) -> typing.Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    def find_rule(self, rule: dict) -> typing.Optional[dict]:
+        """Returns an existing rule with exactly the same settings, if any"""
+
+    @abc.abstractmethod
+    def add_rule(self, rule: dict) -> int:
+        ...
+
+    @abc.abstractmethod
+    def update_rule(self, rule_id: int, rule: dict):
+        ...
+
+    @abc.abstractmethod
+    def delete_rule(self, rule_id: typing.Union[int, str]):
+        ...
+
+    # Audit log
+    @abc.abstractmethod
+    def add_audit_entry(self, entry: dict):
+        ...
+
+    @abc.abstractmethod
+    def audit_entries(
+        self, limit: int, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.List[dict]:
+        """Returns up to $limit live audit entries older than $before whose IP or network overlaps the network
+        $ip_filter, newest first"""
+
+    @abc.abstractmethod
+    def oldest_audit_entries(self, cutoff: int, limit: int) -> typing.List[dict]:
+        """Returns up to $limit live audit entries from before $cutoff, oldest first"""
+
+    @abc.abstractmethod
+    def archive_audit(self, archive: dict, ids: typing.List[int]):
+        """Atomically stores an archive chunk (with a network summary of its entries) and removes the live
+        entries it holds"""
+
+    @abc.abstractmethod
+    def audit_archive(
+        self, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.Iterator[dict]:
+        """Yields archive chunks that start before $before, newest first, skipping those whose network summary
+        shows they hold no entries overlapping $ip_filter"""
+
+    # Leases, for coordinating instances
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, holder: str, ttl: int) -> typing.Optional[dict]:
+        """Takes or renews a lease if it is free, expired or already ours. Returns the current lease (holder, expires)"""
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, holder: str):
+        ...
+
+    async def maintain(self):
+        """Periodic housekeeping, if the backend needs any"""
+        pass
+
+
+class SQLiteStore(Store):
+    """Stores everything in an SQLite database. Several instances may share the same database file."""
+
+    list_snapshots = True
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.db = asfpy.sqlite.DB(filepath)
+
+        # Create table if not there yet
+        if not self.db.table_exists("rules"):
+            print(f"Database file {filepath} is empty, initializing tables")
+            self.db.run(plugins.db_create.CREATE_DB_RULES)
+            self.db.run(plugins.db_create.CREATE_DB_LISTS)
+            self.db.run(plugins.db_create.CREATE_DB_AUDIT)
+            self.db.run(plugins.db_create.CREATE_DB_AUDIT_ARCHIVE)
+            self.db.run(plugins.db_create.CREATE_DB_COUNTERS)
+            self.db.run(plugins.db_create.CREATE_DB_LIST_CHANGES)
+            self.db.run(plugins.db_create.CREATE_DB_LEASES)
+            print(f"Database file {filepath} has been successfully initialized")
+            self.created = True
+
+        # Add any tables and columns that older databases lack
+        for table, statement in plugins.db_create.UPGRADE_DB_TABLES.items():
+            if not self.db.table_exists(table):
+                print(f"Adding missing table {table}")
+                self.db.runc(statement)
+        added_columns = []
+        for table, columns in plugins.db_create.UPGRADE_DB_COLUMNS.items():
+            existing_columns = [row["name"] for row in self.db.connector.execute(f'PRAGMA table_info("{table}")')]
+            for column, statement in columns.items():
+                if column not in existing_columns:
+                    print(f"Adding missing column {column} to table {table}")
+                    self.db.runc(statement)
+                    added_columns.append(f"{table}.{column}")
+        if "auditlog.ip_start" in added_columns:
+            self.fill_audit_ranges()
+        for statement in plugins.db_create.CREATE_DB_INDEXES + plugins.db_create.CREATE_DB_TRIGGERS:
+            self.db.runc(statement)
+
+    def fill_audit_ranges(self):
+        """Works out the address ranges of audit entries written before they were recorded"""
+        print("Indexing the address ranges of existing audit log entries")
+        rows = self.db.connector.execute('SELECT "id", "ip" FROM "auditlog"').fetchall()
+        db = self.db.connector
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                'UPDATE "auditlog" SET "ip_start" = ?, "ip_end" = ? WHERE "id" = ?',
+                [(*(ip_range(row["ip"]) or (None, None)), row["id"]) for row in rows],
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def list_entries(self, list_type: typing.Optional[str] = None) -> typing.List[dict]:
+        if list_type:
+            return list(self.db.fetch("lists", type=list_type, limit=0))
+        return list(self.db.fetch("lists", limit=0))
+
+    def list_entries_by_id(self, rowids: typing.Iterable[int]) -> typing.List[dict]:
+        rowids = list(rowids)
+        rows = self.db.connector.execute(f'SELECT * FROM "lists" WHERE "id" IN ({", ".join("?" * len(rowids))})', rowids)
+        return [dict(row) for row in rows]
+
+    def list_entry(self, rowid: int) -> typing.Optional[dict]:
+        return self.db.fetchone("lists", id=rowid)
+
+    def add_list_entry(self, entry: dict) -> int:
+        self.db.insert("lists", entry)
+        return self.db.cursor.lastrowid
+
+    def remove_list_entries(self, list_type: str, ip: str):
+        self.db.delete("lists", type=list_type, ip=ip)
+
+    def lists_version(self) -> int:
+        row = self.db.fetchone("counters", name="lists")
+        return row and row["value"] or 0
+
+    def list_changes(self, since: int) -> typing.List[dict]:
+        rows = self.db.connector.execute('SELECT * FROM "list_changes" WHERE "seq" > ? ORDER BY "seq"', (since,))
+        return [dict(row) for row in rows]
+
+    def latest_list_change(self) -> int:
+        row = self.db.connector.execute('SELECT MAX("seq") AS "seq" FROM "list_changes"').fetchone()
+        return row and row["seq"] or 0
+
+    def prune_list_changes(self, cutoff: int):
+        self.db.connector.execute('DELETE FROM "list_changes" WHERE "timestamp" < ?', (cutoff,))
+
+    def rules(self) -> typing.List[dict]:
+        return list(self.db.fetch("rules", limit=0))
+
+    def rule(self, rule_id: typing.Union[int, str]) -> typing.Optional[dict]:
+        return self.db.fetchone("rules", id=rule_id)
+
+    def find_rule(self, rule: dict) -> typing.Optional[dict]:
+        return self.db.fetchone("rules", **rule)
+
+    def add_rule(self, rule: dict) -> int:
+        self.db.insert("rules", rule)
+        return self.db.cursor.lastrowid
+
+    def update_rule(self, rule_id: int, rule: dict):
+        self.db.upsert("rules", dict(rule), id=rule_id)
+
+    def delete_rule(self, rule_id: typing.Union[int, str]):
+        self.db.delete("rules", id=rule_id)
+
+    def add_audit_entry(self, entry: dict):
+        ip_start, ip_end = ip_range(entry["ip"]) or (None, None)
+        self.db.insert("auditlog", dict(entry, ip_start=ip_start, ip_end=ip_end))
+
+    def audit_entries(
+        self, limit: int, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.List[dict]:
+        conditions = []
+        values = []
+        if before:
+            conditions.append('("timestamp", "id") < (?, ?)')
+            values.extend(before)
+        if ip_filter is not None:
+            # Networks either lie within one another or don't overlap at all, so an entry overlaps $ip_filter
+            # if it starts within it, or is one of its supernets. Both are lookups in the ip_start index.
+            start, end = network_range(ip_filter)
+            supernets = supernet_starts(ip_filter)
+            conditions.append(
+                f'("ip_start" BETWEEN ? AND ? OR ("ip_start" IN ({", ".join("?" * len(supernets))}) AND "ip_end" >= ?))'
+            )
+            values.extend([start, end, *supernets, end])
+        where = " AND ".join(conditions) or "1"
+        rows = self.db.connector.execute(
+            f'SELECT {AUDIT_COLUMNS} FROM "auditlog" WHERE {where} ORDER BY "timestamp" DESC, "id" DESC LIMIT ?',
+            (*values, limit),
+        )
+        return [dict(row) for row in rows]
+
+    def oldest_audit_entries(self, cutoff: int, limit: int) -> typing.List[dict]:
+        rows = self.db.connector.execute(
+            f'SELECT {AUDIT_COLUMNS} FROM "auditlog" WHERE "timestamp" < ? ORDER BY "timestamp", "id" LIMIT ?',
+            (cutoff, limit),
+        )
+        return [dict(row) for row in rows]
+
+    def archive_audit(self, archive: dict, ids: typing.List[int]):
+        # Archive and delete in one transaction, so a crash can never lose or duplicate entries
+        db = self.db.connector
+        db.execute("BEGIN")
+        try:
+            db.execute(
+                'INSERT INTO "auditlog_archive" '
+                '("start_timestamp", "start_id", "end_timestamp", "end_id", "entries", "networks", "data") '
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    archive["start_timestamp"],
+                    archive["start_id"],
+                    archive["end_timestamp"],
+                    archive["end_id"],
+                    archive["entries"],
+                    archive["networks"],
+                    archive["data"],
+                ),
+            )
+            db.executemany('DELETE FROM "auditlog" WHERE "id" = ?', [(entry_id,) for entry_id in ids])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def audit_archive(
+        self, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.Iterator[dict]:
+        # Go through the chunks without their data, and only load that for the chunks we need
+        columns = '"id", "start_timestamp", "start_id", "end_timestamp", "end_id", "entries", "networks"'
+        if before:
+            chunks = self.db.connector.execute(
+                f'SELECT {columns} FROM "auditlog_archive" WHERE ("start_timestamp", "start_id") < (?, ?) '
+                'ORDER BY "end_timestamp" DESC, "end_id" DESC',
+                before,
+            ).fetchall()
+        else:
+            chunks = self.db.connector.execute(
+                f'SELECT {columns} FROM "auditlog_archive" ORDER BY "end_timestamp" DESC, "end_id" DESC'
+            ).fetchall()
+        wanted = network_range(ip_filter) if ip_filter is not None else None
+        for chunk in chunks:
+            if wanted and not summary_overlaps(chunk["networks"], wanted):
+                continue
+            data = self.db.connector.execute('SELECT "data" FROM "auditlog_archive" WHERE "id" = ?', (chunk["id"],))
+            yield dict(chunk, data=data.fetchone()["data"])
+
+    def acquire_lease(self, name: str, holder: str, ttl: int) -> typing.Optional[dict]:
+        now = time.time()
+        self.db.connector.execute(
+            'INSERT INTO "leases" ("name", "holder", "expires") VALUES (?, ?, ?) '
+            'ON CONFLICT ("name") DO UPDATE SET "holder" = excluded."holder", "expires" = excluded."expires" '
+            'WHERE "leases"."holder" = excluded."holder" OR "leases"."expires" < ?',
+            (name, holder, now + ttl, now),
+        )
+        return self.db.fetchone("leases", name=name)
+
+    def release_lease(self, name: str, holder: str):
+        self.db.connector.execute('DELETE FROM "leases" WHERE "name" = ? AND "holder" = ?', (name, holder))
+
+
+class MemoryStore(Store):
+    """Keeps everything in memory, and forgets it all on restart. Meant for tests and benchmarks.
+    Every change goes through commit(), so subclasses can persist changes by overriding it."""
+
+    persistent = False
+
+    def __init__(self, filepath: str = None):
+        self.created = True
+        self.lists: typing.Dict[int, dict] = {}
+        self.rules_by_id: typing.Dict[int, dict] = {}
+        self.audit: typing.List[dict] = []  # Live audit entries, sorted by (timestamp, id)
+        self.audit_keys: typing.List[AuditCursor] = []  # The (timestamp, id) of each live audit entry, for bisecting
+        self.archive: typing.List[dict] = []  # Archive chunks, sorted by (end_timestamp, end_id)
+        self.archive_keys: typing.List[AuditCursor] = []
+        self.ids = {"lists": 0, "rules": 0, "auditlog": 0}  # Last id handed out, per table
+        self.version = 0
+        self.changes: typing.List[dict] = []  # List changes, for instances to sync from. Seq numbers are contiguous
+        self.leases: typing.Dict[str, dict] = {}
+
+    def next_id(self, table: str) -> int:
+        return self.ids[table] + 1
+
+    def commit(self, op: str, data: dict):
+        """Applies a change to the in-memory state"""
+        getattr(self, f"apply_{op}")(data)
+
+    def record_change(self, op: str, row: dict):
+        seq = self.changes and self.changes[-1]["seq"] + 1 or 1
+        self.changes.append({"seq": seq, "op": op, "row_id": row["id"], "type": row["type"], "timestamp": int(time.time())})
+        self.version += 1
+
+    def apply_list_add(self, data: dict):
+        row = dict(data["entry"], id=data["id"])
+        self.lists[row["id"]] = row
+        self.ids["lists"] = max(self.ids["lists"], row["id"])
+        self.record_change("insert", row)
+
+    def apply_list_remove(self, data: dict):
+        for rowid, row in list(self.lists.items()):
+            if row["type"] == data["type"] and row["ip"] == data["ip"]:
+                del self.lists[rowid]
+                self.record_change("delete", row)
+
+    def apply_rule_set(self, data: dict):
+        self.rules_by_id[data["id"]] = dict(data["rule"], id=data["id"])
+        self.ids["rules"] = max(self.ids["rules"], data["id"])
+
+    def apply_rule_delete(self, data: dict):
+        self.rules_by_id.pop(data["id"], None)
+
+    def apply_audit_add(self, data: dict):
+        entry = with_ip_range(data["entry"])
+        key = (entry["timestamp"], entry["id"])
+        position = bisect.bisect_left(self.audit_keys, key)
+        self.audit_keys.insert(position, key)
+        self.audit.insert(position, entry)
+        self.ids["auditlog"] = max(self.ids["auditlog"], entry["id"])
+
+    def apply_audit_archive(self, data: dict):
+        archive = data["archive"]
+        key = (archive["end_timestamp"], archive["end_id"])
+        position = bisect.bisect_left(self.archive_keys, key)
+        self.archive_keys.insert(position, key)
+        self.archive.insert(position, archive)
+        ids = set(data["ids"])
+        self.audit = [entry for entry in self.audit if entry["id"] not in ids]
+        self.audit_keys = [(entry["timestamp"], entry["id"]) for entry in self.audit]
+
+    def list_entries(self, list_type: typing.Optional[str] = None) -> typing.List[dict]:
+        return [dict(row) for row in self.lists.values() if not list_type or row["type"] == list_type]
+
+    def list_entries_by_id(self, rowids: typing.Iterable[int]) -> typing.List[dict]:
+        return [dict(self.lists[rowid]) for rowid in rowids if rowid in self.lists]
+
+    def list_entry(self, rowid: int) -> typing.Optional[dict]:
+        row = self.lists.get(rowid)
+        return row and dict(row)
+
+    def add_list_entry(self, entry: dict) -> int:
+        rowid = self.next_id("lists")
+        self.commit("list_add", {"id": rowid, "entry": dict(entry)})
+        return rowid
+
+    def remove_list_entries(self, list_type: str, ip: str):
+        self.commit("list_remove", {"type": list_type, "ip": ip})
+
+    def lists_version(self) -> int:
+        return self.version
+
+    def list_changes(self, since: int) -> typing.List[dict]:
+        if not self.changes:
+            return []
+        return [dict(change) for change in self.changes[max(0, since - self.changes[0]["seq"] + 1) :]]
+
+    def latest_list_change(self) -> int:
+        return self.changes and self.changes[-1]["seq"] or 0
+
+    def prune_list_changes(self, cutoff: int):
+        keep = 0
+        while keep < len(self.changes) and self.changes[keep]["timestamp"] < cutoff:
+            keep += 1
+        del self.changes[:keep]
+
+    def rules(self) -> typing.List[dict]:
+        return [dict(self.rules_by_id[rule_id]) for rule_id in sorted(self.rules_by_id)]
+
+    def rule(self, rule_id: typing.Union[int, str]) -> typing.Optional[dict]:
+        try:
+            rule = self.rules_by_id.get(int(rule_id))
+        except ValueError:
+            return None
+        return rule and dict(rule)
+
+    def find_rule(self, rule: dict) -> typing.Optional[dict]:
+        for existing in self.rules_by_id.values():
+            if all(existing.get(key) == value for key, value in rule.items()):
+                return dict(existing)
+        return None
+
+    def add_rule(self, rule: dict) -> int:
+        rule_id = self.next_id("rules")
+        self.commit("rule_set", {"id": rule_id, "rule": dict(rule)})
+        return rule_id
+
+    def update_rule(self, rule_id: int, rule: dict):
+        self.commit("rule_set", {"id": int(rule_id), "rule": dict(rule)})
+
+    def delete_rule(self, rule_id: typing.Union[int, str]):
+        if self.rule(rule_id):
+            self.commit("rule_delete", {"id": int(rule_id)})
+
+    def add_audit_entry(self, entry: dict):
+        self.commit("audit_add", {"entry": dict(entry, id=self.next_id("auditlog"))})
+
+    def audit_entries(
+        self, limit: int, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.List[dict]:
+        end = bisect.bisect_left(self.audit_keys, tuple(before)) if before else len(self.audit)
+        wanted = network_range(ip_filter) if ip_filter is not None else None
+        entries = []
+        for i in range(end - 1, -1, -1):
+            entry = self.audit[i]
+            if wanted and not (
+                entry["ip_start"] is not None and entry["ip_start"] <= wanted[1] and entry["ip_end"] >= wanted[0]
+            ):
+                continue
+            entries.append({field: entry[field] for field in AUDIT_FIELDS})
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def oldest_audit_entries(self, cutoff: int, limit: int) -> typing.List[dict]:
+        end = bisect.bisect_left(self.audit_keys, (cutoff, 0))
+        return [{field: entry[field] for field in AUDIT_FIELDS} for entry in self.audit[: min(end, limit)]]
+
+    def archive_audit(self, archive: dict, ids: typing.List[int]):
+        # Archive data is binary, keep it as text so it can be logged as JSON too
+        archive = dict(archive, data=base64.b64encode(archive["data"]).decode("ascii"))
+        self.commit("audit_archive", {"archive": archive, "ids": list(ids)})
+
+    def audit_archive(
+        self, before: typing.Optional[AuditCursor] = None, ip_filter: typing.Optional[netaddr.IPNetwork] = None
+    ) -> typing.Iterator[dict]:
+        wanted = network_range(ip_filter) if ip_filter is not None else None
+        for chunk in reversed(self.archive):
+            if before and (chunk["start_timestamp"], chunk["start_id"]) >= tuple(before):
+                continue
+            if wanted and not summary_overlaps(chunk.get("networks"), wanted):
+                continue
+            yield dict(chunk, data=base64.b64decode(chunk["data"]))
+
+    def acquire_lease(self, name: str, holder: str, ttl: int) -> typing.Optional[dict]:
+        now = time.time()
+        lease = self.leases.get(name)
+        if not lease or lease["holder"] == holder or lease["expires"] < now:
+            lease = self.leases[name] = {"name": name, "holder": holder, "expires": now + ttl}
+        return dict(lease)
+
+    def release_lease(self, name: str, holder: str):
+        if name in self.leases and self.leases[name]["holder"] == holder:
+            del self.leases[name]
+
+
+class LogStore(MemoryStore):
+    """Keeps everything in memory, appending every change to a log file as a JSON line, which is much cheaper
+    than updating indexed tables. The log is periodically folded into a full snapshot and started afresh.
+    Only one instance can use a log store at a time.
+
+    Every change is flushed to the OS right away, so it survives Blocky/4 crashing. Surviving a power loss or
+    kernel crash as well needs an fsync, and $fsync decides when that happens:
+      - never: leave it to the OS, which usually writes back within 30 seconds
+      - interval: fsync the log at every maintenance run, so at most 10 seconds of changes can be lost (default)
+      - always: fsync after every change. Nothing is lost, but writes get about as slow as SQLite's
+    Snapshots are always fsync'ed before the log they replace is removed.
+
+    Files used, for a storage path of $path:
+      - $path.lock: held locked while the store is open
+      - $path.snapshot: the state as of the start of log generation N (JSON, replaced atomically)
+      - $path.log.N: the changes made during generation N, one JSON line each
+    """
+
+    def __init__(self, filepath: str, fsync: str = DEFAULT_LOG_FSYNC):
+        MemoryStore.__init__(self)
+        if fsync not in LOG_FSYNC_POLICIES:
+            raise StorageException(f"Unknown fsync policy {fsync}, must be one of: {', '.join(LOG_FSYNC_POLICIES)}")
+        self.filepath = filepath
+        self.fsync = fsync
+        self.lock = open(f"{filepath}.lock", "w")
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise StorageException(f"Log store {filepath} is already in use by another instance")
+
+        # Load the latest snapshot, then replay every log generation it does not cover yet
+        self.generation = 0
+        self.created = True
+        try:
+            with open(f"{filepath}.snapshot", "r") as f:
+                self.load_snapshot(json.load(f))
+            self.created = False
+        except FileNotFoundError:
+            pass
+        complete = None
+        for generation, log_filepath in self.log_files():
+            if generation < self.generation:
+                os.unlink(log_filepath)  # Already part of the snapshot
+                continue
+            complete = self.replay(log_filepath)
+            self.created = False
+            self.generation = generation
+
+        self.log = open(self.log_filepath(self.generation), "a")
+        if complete is not None and self.log.tell() > complete:
+            # Cut off what a crash left of the last record, or whatever we write next would follow it, and be
+            # ignored on the next start-up along with it
+            self.log.truncate(complete)
+            os.fsync(self.log.fileno())
+        self.log_records = 0  # Changes logged since the last compaction
+        self.unsynced = False  # Whether the log has changes that have not been fsync'ed yet
+        self.compacted = time.time()
+        self.compacting = False
+
+    def log_filepath(self, generation: int) -> str:
+        return f"{self.filepath}.log.{generation}"
+
+    def log_files(self) -> typing.List[typing.Tuple[int, str]]:
+        logs = []
+        for log_filepath in glob.glob(glob.escape(self.filepath) + ".log.*"):
+            suffix = log_filepath.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                logs.append((int(suffix), log_filepath))
+        return sorted(logs)
+
+    def load_snapshot(self, snapshot: dict):
+        self.generation = snapshot["generation"]
+        self.ids = snapshot["ids"]
+        self.version = snapshot["version"]
+        self.lists = {row["id"]: row for row in snapshot["lists"]}
+        self.rules_by_id = {rule["id"]: rule for rule in snapshot["rules"]}
+        self.audit = [with_ip_range(entry) for entry in snapshot["audit"]]
+        self.audit_keys = [(entry["timestamp"], entry["id"]) for entry in self.audit]
+        self.archive = snapshot["archive"]
+        self.archive_keys = [(chunk["end_timestamp"], chunk["end_id"]) for chunk in self.archive]
+
+    def replay(self, log_filepath: str) -> int:
+        """Applies the changes in a log file. Returns how many bytes of it hold complete records"""
+        complete = 0
+        with open(log_filepath, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("No end of line")
+                    op, data = json.loads(line)
+                except ValueError:  # A line cut short by a crash. Nothing after it can have made it either
+                    print(f"Ignoring incomplete record at the end of {log_filepath}")
+                    break
+                MemoryStore.commit(self, op, data)
+                complete += len(line)
+        return complete
+
+    def commit(self, op: str, data: dict):
+        """Writes a change to the log, then applies it. See the class docstring for when the log is fsync'ed"""
+        self.log.write(json.dumps([op, data]) + "\n")
+        self.log.flush()
+        if self.fsync == "always":
+            os.fsync(self.log.fileno())
+        else:
+            self.unsynced = True
+        self.log_records += 1
+        MemoryStore.commit(self, op, data)
+
+    def snapshot(self) -> dict:
+        """Returns the current state, for writing a snapshot while changes keep coming in. Rows are never modified
+        once stored, only added, replaced or removed, so copying the containers is enough."""
+        return {
+            "generation": self.generation,
+            "ids": dict(self.ids),
+            "version": self.version,
+            "lists": list(self.lists.values()),
+            "rules": list(self.rules_by_id.values()),
+            "audit": list(self.audit),
+            "archive": list(self.archive),
+        }
+
+    def write_snapshot(self, snapshot: dict):
+        """Writes and fsyncs a snapshot, then moves it into place. Runs in a thread, off the event loop"""
+        tmp_filepath = f"{self.filepath}.snapshot.tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, f"{self.filepath}.snapshot")
+
+    async def compact(self):
+        """Starts a new log generation, and snapshots the current state as its starting point.
+        Changes made while the snapshot is being written go to the new log, which is replayed on top of it."""
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            old_log = self.log
+            old_filepath = self.log_filepath(self.generation)
+            self.generation += 1
+            self.log = open(self.log_filepath(self.generation), "a")
+            self.log_records = 0
+            self.compacted = time.time()
+            snapshot = self.snapshot()
+            old_log.close()
+            await asyncio.get_running_loop().run_in_executor(None, self.write_snapshot, snapshot)
+            # Only now is the old log redundant. If writing the snapshot failed, it is replayed on start-up instead
+            os.unlink(old_filepath)
+        finally:
+            self.compacting = False
+
+    async def maintain(self):
+        if self.unsynced and self.fsync == "interval":
+            self.unsynced = False
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.log.fileno())
+        if self.log_records >= LOG_COMPACT_RECORDS or (
+            self.log_records and time.time() - self.compacted >= LOG_COMPACT_INTERVAL
+        ):
+            await self.compact()
+
+
+# Storage backends, by the name used in blocky4.yaml
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStore,
+    "memory": MemoryStore,
+    "log": LogStore,
+}
+
+
+def open_store(backend: str, filepath: str, **options) -> Store:
+    """Opens a storage backend. Any $options are passed on to the backend, see its class for what it takes"""
+    if backend not in STORAGE_BACKENDS:
+        raise StorageException(f"Unknown storage backend {backend}, must be one of: {', '.join(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend](filepath, **options)
+
+
+async def run(config: "plugins.configuration.BlockyConfiguration"):
+    """Gives the store a chance to do its housekeeping, forever"""
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await config.store.maintain()
+        except STORAGE_ERRORS as e:
+            print(f"Storage maintenance failed, retrying: {e}")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import datetime
+import json
+import netaddr
+import os
+import re
+import time
+import typing
+import plugins.background
+import plugins.configuration
+
+""" Streaming offender detection for Blocky/4, fed directly with log lines instead of searching ElasticSearch """
+
+STREAM_SLOTS = 12  # Each rule window is split into 12 slots, which expire one at a time
+STREAM_SLOT_CAPACITY = 2000  # Max number of clients tracked per slot. Smallest counts are dropped beyond this
+STREAM_EVAL_INTERVAL = 5  # Check the stream counters for offenders every 5 seconds
+STREAM_RULE_SYNC_INTERVAL = 5  # Pick up rule changes every 5 seconds, also on instances only feeding the counters
+TAIL_POLL_INTERVAL = 1  # When tailing a log file, check for new lines every second
+TAIL_READ_SIZE = 1024 * 1024  # Read (about) 1MB of log lines at a time, yielding to other tasks in between
+EPOCH_MILLIS_THRESHOLD = 1e11  # Numeric timestamps above this are epoch milliseconds (1e11 seconds is in year 5138)
+
+
+def field_value(line: dict, key: str) -> typing.Any:
+    """Fetches a (possibly nested, dot-separated) field from a log line. keyword sub-fields map to the field itself"""
+    if key.endswith(".keyword"):
+        key = key[:-8]
+    if key in line:
+        return line[key]
+    value = line
+    for segment in key.split("."):
+        if not isinstance(value, dict) or segment not in value:
+            return None
+        value = value[segment]
+    return value
+
+
+class LogFilter:
+    """A rule search filter (key, operator, value), with the same semantics as the ES search filters"""
+
+    def __init__(self, entry: str):
+        self.key, operator, self.value = entry.split(" ", 2)  # key, operator, value
+        self.exclude = operator.startswith("!")
+        if self.exclude:
+            operator = operator[1:]
+        self.operator = operator
+        if operator == "=":  # Full-text match: any of the (lower-cased) words must be present
+            self.words = set(re.findall(r"\w+", self.value.lower()))
+        elif operator == "~=":  # Regexp: must match the entire value, like Lucene does
+            self.regex = re.compile(self.value)
+        elif operator != "==":
+            raise TypeError(f"Unknown operator {operator} in search filter: {entry}")
+
+    def matches(self, line: dict) -> bool:
+        value = field_value(line, self.key)
+        if value is None:
+            found = False
+        elif self.operator == "=":
+            found = bool(self.words.intersection(re.findall(r"\w+", str(value).lower())))
+        elif self.operator == "~=":
+            found = bool(self.regex.fullmatch(str(value)))
+        else:
+            found = str(value) == self.value
+        return found != self.exclude
+
+
+class WindowCounter:
+    """Approximate per-client totals over a sliding window, in bounded memory.
+    The window is split into slots, each holding at most STREAM_SLOT_CAPACITY clients. When a slot
+    overflows, its smallest counts are dropped, so totals can only ever be under-estimated."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.slot_seconds = max(1, window // STREAM_SLOTS)
+        self.slots: typing.Dict[int, typing.Dict[str, int]] = {}
+
+    def oldest_slot(self, now: float) -> int:
+        """Returns the number of the oldest slot still within the window at $now"""
+        return int((now - self.window) // self.slot_seconds) + 1
+
+    def expire(self, now: float):
+        """Drops the slots that have left the window"""
+        oldest_slot = self.oldest_slot(now)
+        for slot_no in [slot_no for slot_no in self.slots if slot_no < oldest_slot]:
+            del self.slots[slot_no]
+
+    def add(self, key: str, value: int, timestamp: float):
+        slot_no = int(timestamp // self.slot_seconds)
+        slot = self.slots.get(slot_no)
+        if slot is None:
+            # Expire slots as new ones come in, so memory stays bounded even if totals() is never called,
+            # as on instances that only count. Lines too old to count any more are skipped.
+            if self.slots and slot_no < max(self.slots) - STREAM_SLOTS:
+                return
+            self.expire(timestamp)
+            slot = self.slots[slot_no] = {}
+        slot[key] = slot.get(key, 0) + value
+        if len(slot) > STREAM_SLOT_CAPACITY * 2:  # Prune in bulk, so this is amortized O(1) per line
+            largest = sorted(slot.items(), key=lambda x: x[1], reverse=True)[:STREAM_SLOT_CAPACITY]
+            self.slots[slot_no] = dict(largest)
+
+    def totals(self, now: float) -> typing.Dict[str, int]:
+        """Drops expired slots and returns the totals for each client in the window"""
+        self.expire(now)
+        totals = {}
+        for slot_no in self.slots:
+            for key, value in self.slots[slot_no].items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class StreamRule:
+    def __init__(self, ruledict: dict):
+        self.ruledict = ruledict
+        self.rule = plugins.background.BanRule(ruledict)
+        self.filters = [LogFilter(x) for x in self.rule.filters]
+        self.counter = WindowCounter(plugins.background.duration_to_seconds(self.rule.duration))
+
+    def feed(self, line: dict, ip: str, timestamp: float):
+        for log_filter in self.filters:
+            if not log_filter.matches(line):
+                return
+        if self.rule.prefix4 or self.rule.prefix6:
+            ip = plugins.background.network_key(ip, self.rule.prefix4, self.rule.prefix6)
+            if not ip:
+                return
+        if self.rule.aggtype == "bytes":
+            try:
+                value = int(line.get("bytes") or 0)
+            except ValueError:
+                return
+        else:
+            value = 1
+        self.counter.add(ip, value, timestamp)
+
+    def offenders(self, now: float) -> typing.List[typing.Tuple[str, int]]:
+        offenders = []
+        for key, value in self.counter.totals(now).items():
+            if value >= self.rule.limit:
+                try:
+                    netaddr.IPNetwork(key)
+                except (netaddr.core.AddrFormatError, ValueError):
+                    continue  # Not an IP or network, can't block it anyway
+                offenders.append((key, value))
+        return offenders
+
+
+class StreamEngine:
+    """Keeps streaming counters for every rule, and blocks offenders as soon as they cross a limit"""
+
+    def __init__(self, config: "plugins.configuration.BlockyConfiguration"):
+        self.config = config
+        self.rules: typing.Dict[int, StreamRule] = {}
+        self.lines_ingested = 0
+        self.rules_synced = 0.0
+        self.sync_rules()
+
+    def sync_rules(self):
+        """Picks up new, modified and deleted rules. Modified rules start counting afresh"""
+        self.rules_synced = time.time()
+        all_rules = {rule["id"]: rule for rule in self.config.store.rules()}
+        for rule_id in list(self.rules.keys()):
+            if rule_id not in all_rules:
+                del self.rules[rule_id]
+        for rule_id, rule in all_rules.items():
+            if rule_id not in self.rules or self.rules[rule_id].ruledict != rule:
+                try:
+                    self.rules[rule_id] = StreamRule(rule)
+                except (AssertionError, TypeError, ValueError) as e:
+                    print(f"Rule #{rule_id} cannot be used for stream detection: {e}")
+
+    def feed(self, lines: typing.Iterable[typing.Union[str, dict]]) -> int:
+        """Feeds a batch of log lines (JSON objects or strings) to every rule. Returns the number of lines used"""
+        now = time.time()
+        if now - self.rules_synced >= STREAM_RULE_SYNC_INTERVAL:  # Standby instances never run(), but count
+            self.sync_rules()
+        used = 0
+        for line in lines:
+            if isinstance(line, str):
+                try:
+                    line = json.loads(line)
+                except ValueError:
+                    continue
+            if not isinstance(line, dict):
+                continue
+            ip = field_value(line, plugins.background.CLIENT_IP_NAME)
+            if not ip:
+                continue
+            timestamp = parse_timestamp(line.get(plugins.background.TIMESTAMP_NAME), now)
+            for stream_rule in self.rules.values():
+                stream_rule.feed(line, str(ip), timestamp)
+            used += 1
+        self.lines_ingested += used
+        return used
+
+    async def run(self):
+        """Evaluates the counters for offenders, forever"""
+        while True:
+            await asyncio.sleep(STREAM_EVAL_INTERVAL)
+            now = time.time()
+            for stream_rule in self.rules.values():
+                offenders = stream_rule.offenders(now)
+                if offenders:
+                    plugins.background.block_offenders(self.config, stream_rule.rule, offenders)
+            self.sync_rules()
+
+    async def tail(self, filepath: str):
+        """Follows a log file of JSON lines, like tail -F, feeding new lines to the engine"""
+        fp = None
+        inode = None
+        partial = ""  # A line that has not been completely written yet
+        while True:
+            try:
+                if fp is None:
+                    fp = open(filepath, "r")
+                    inode = os.fstat(fp.fileno()).st_ino
+                    fp.seek(0, os.SEEK_END)  # Only new lines; we don't know how old the existing ones are
+                    partial = ""
+                if os.fstat(fp.fileno()).st_size < fp.tell():  # Truncated in place (copytruncate), start over
+                    fp.seek(0)
+                    partial = ""
+                lines = fp.readlines(TAIL_READ_SIZE)
+                if lines:
+                    lines[0] = partial + lines[0]
+                    partial = "" if lines[-1].endswith("\n") else lines.pop()
+                    self.feed(lines)
+                    await asyncio.sleep(0)
+                    continue  # There may be more where that came from
+                elif os.stat(filepath).st_ino != inode:  # Log rotated, reopen from the start
+                    fp.close()
+                    fp = open(filepath, "r")
+                    inode = os.fstat(fp.fileno()).st_ino
+                    partial = ""
+                    continue
+            except OSError as e:
+                print(f"Could not read from {filepath}, retrying: {e}")
+                if fp:
+                    fp.close()
+                fp = None
+            await asyncio.sleep(TAIL_POLL_INTERVAL)
+
+
+def parse_timestamp(timestamp: typing.Any, now: float) -> float:
+    """Turns an ISO timestamp (or epoch seconds or milliseconds) into epoch seconds.
+    Missing, invalid or future timestamps become $now"""
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        epoch = timestamp
+        if epoch > EPOCH_MILLIS_THRESHOLD:
+            epoch /= 1000
+    elif isinstance(timestamp, str):
+        try:
+            parsed = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+            epoch = parsed.timestamp()
+        except ValueError:
+            return now
+    else:
+        return now
+    return min(epoch, now)
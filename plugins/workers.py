@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+import typing
+import elasticsearch
+import plugins.background
+import plugins.breaker
+import plugins.configuration
+import plugins.profiling
+
+""" Rule evaluation in worker processes, so searches and their results don't compete with the API for the main loop """
+
+RESULTS_POLL_INTERVAL = 0.25  # Check for offenders found by the workers four times a second
+WORKER_STOP_TIMEOUT = 1  # Seconds to wait for a worker to exit after terminating it, before killing it
+WORKER_STOP_POLL = 0.05  # How often to check whether a terminated worker has exited
+BREAKER_STATES = ["closed", "half-open", "open"]  # From best to worst, for summing up the workers' breakers
+
+
+class WorkerState:
+    """The parts of the configuration a rule worker needs for searching. The lists and storage
+    are never touched by workers, they belong to the main process."""
+
+    def __init__(self, settings: dict):
+        self.elasticsearch = elasticsearch.AsyncElasticsearch(hosts=[settings["elasticsearch_url"]])
+        self.es_breaker = plugins.breaker.CircuitBreaker(concurrency=settings["es_concurrency"])
+        self.index_pattern = settings["index_pattern"]
+        self.prefix_field = settings["prefix_field"]
+        self.prefix_field_lengths = settings["prefix_field_lengths"]
+        self.profiler = plugins.profiling.Profiler()
+        self.sweep_results = {}
+        self.sweep_inflight = {}
+        self.offender_stats = {}
+        self.rules: typing.List[dict] = []
+
+
+def worker_main(worker_no: int, settings: dict, commands: multiprocessing.Queue, results: multiprocessing.Queue):
+    """Entry point of a worker process"""
+    try:
+        asyncio.run(worker_loop(worker_no, settings, commands, results))
+    except KeyboardInterrupt:
+        pass
+
+
+async def worker_loop(worker_no: int, settings: dict, commands: multiprocessing.Queue, results: multiprocessing.Queue):
+    """Runs the rules assigned to this worker on their schedules, sending back results and offenders"""
+    state = WorkerState(settings)
+    parent_pid = os.getppid()
+
+    def fetch_rules() -> typing.List[dict]:
+        if os.getppid() != parent_pid:  # Main process is gone, so is our purpose
+            raise SystemExit(0)
+        while True:
+            try:
+                state.rules = commands.get_nowait()
+            except queue.Empty:
+                break
+        return state.rules
+
+    async def process(rule: "plugins.background.BanRule"):
+        offenders = await rule.list_offenders(state)
+        results.put(("sweep", worker_no, rule.id, state.sweep_results.get(rule.id), state.es_breaker.status()))
+        if offenders:
+            results.put(("offenders", worker_no, rule.id, offenders))
+
+    await plugins.background.run_schedule(state, fetch_rules, process)
+
+
+def partition(rules: typing.Iterable[dict], worker_count: int) -> typing.List[typing.List[dict]]:
+    """Splits rules between workers by id, so each rule always lands on the same worker"""
+    parts = [[] for _ in range(worker_count)]
+    for rule in sorted(rules, key=lambda x: x["id"]):
+        parts[hash(rule["id"]) % worker_count].append(rule)
+    return parts
+
+
+class Worker:
+    def __init__(self, worker_no: int, settings: dict, results: multiprocessing.Queue):
+        self.worker_no = worker_no
+        self.settings = settings
+        self.results = results
+        self.process = None
+        self.commands = None
+        self.rules = None  # Rules last sent to the worker
+        self.status = {}
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.commands = context.Queue()
+        self.process = context.Process(
+            target=worker_main,
+            args=(self.worker_no, self.settings, self.commands, self.results),
+            name=f"blocky4-rules-{self.worker_no}",
+            daemon=True,
+        )
+        self.process.start()
+        self.rules = None
+
+    def assign(self, rules: typing.List[dict]):
+        if rules != self.rules:
+            self.commands.put(rules)
+            self.rules = rules
+
+    async def stop(self):
+        """Terminates the worker, waiting for it to exit without blocking the event loop"""
+        if self.process and self.process.is_alive():
+            self.process.terminate()  # Workers keep no state worth saving
+            deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+            while self.process.is_alive():
+                if time.monotonic() >= deadline:
+                    print(f"Rule worker #{self.worker_no} did not exit, killing it")
+                    self.process.kill()
+                    break
+                await asyncio.sleep(WORKER_STOP_POLL)
+
+
+def worker_settings(config: "plugins.configuration.BlockyConfiguration") -> dict:
+    """The settings every worker gets. The workers share the instance's ES concurrency limit between them"""
+    return {
+        "elasticsearch_url": config.elasticsearch_url,
+        "es_concurrency": max(1, config.es_breaker.max_concurrency // max(1, config.rule_workers)),
+        "index_pattern": config.index_pattern,
+        "prefix_field": config.prefix_field,
+        "prefix_field_lengths": config.prefix_field_lengths,
+    }
+
+
+def breaker_status(config: "plugins.configuration.BlockyConfiguration") -> dict:
+    """Sums up the circuit breakers of the main process and of every rule worker: the worst state, pressure and
+    error rate of any of them, and the queries in flight in all of them. The concurrency is what the processes
+    running rules may use right now, out of the configured max_concurrency."""
+    worker_statuses = [worker["elasticsearch"] for worker in config.worker_status if worker.get("elasticsearch")]
+    statuses = [config.es_breaker.status()] + worker_statuses
+    rule_statuses = worker_statuses if config.worker_status else statuses
+    open_until = [status["open_until"] for status in statuses if status["open_until"]]
+    return {
+        "state": max((status["state"] for status in statuses), key=BREAKER_STATES.index),
+        "pressure": max(status["pressure"] for status in statuses),
+        "error_rate": max(status["error_rate"] for status in statuses),
+        "latency": max(status["latency"] for status in statuses),
+        "open_until": open_until and max(open_until) or None,
+        "inflight": sum(status["inflight"] for status in statuses),
+        "waiting": sum(status.get("waiting", 0) for status in statuses),
+        "concurrency": sum(status["concurrency"] for status in rule_statuses),
+        "max_concurrency": config.es_breaker.max_concurrency,
+        "interval_factor": max(status["interval_factor"] for status in statuses),
+        "processes": len(statuses),
+    }
+
+
+async def run(config: "plugins.configuration.BlockyConfiguration"):
+    """Spreads the rules over worker processes, and blocks the offenders they find, forever"""
+    settings = worker_settings(config)
+    results = multiprocessing.get_context("spawn").Queue()
+    workers = [Worker(worker_no, settings, results) for worker_no in range(config.rule_workers)]
+    rules: typing.Dict[int, typing.Tuple[dict, plugins.background.BanRule]] = {}
+    config.worker_status = [worker.status for worker in workers]
+    next_assignment = 0.0
+    try:
+        for worker in workers:
+            worker.start()
+        while True:
+            # Hand out any new or changed rules, and restart workers that died
+            if time.time() >= next_assignment:
+                all_rules = {rule["id"]: rule for rule in config.store.rules()}
+                for rule_id in list(rules.keys()):
+                    if rule_id not in all_rules:
+                        del rules[rule_id]
+                        config.sweep_results.pop(rule_id, None)
+                        config.offender_stats.pop(rule_id, None)
+                for rule_id, rule in all_rules.items():
+                    if rule_id not in rules or rules[rule_id][0] != rule:
+                        rules[rule_id] = (rule, plugins.background.BanRule(rule))
+                for worker, worker_rules in zip(workers, partition(all_rules.values(), len(workers))):
+                    if not worker.process.is_alive():
+                        print(f"Rule worker #{worker.worker_no} exited with code {worker.process.exitcode}, restarting")
+                        worker.start()
+                    worker.assign(worker_rules)
+                    worker.status.update(
+                        worker=worker.worker_no,
+                        pid=worker.process.pid,
+                        rules=[rule["id"] for rule in worker_rules],
+                    )
+                next_assignment = time.time() + plugins.background.SCHEDULER_TICK
+
+            # Act on whatever the workers found
+            while True:
+                try:
+                    message = results.get_nowait()
+                except queue.Empty:
+                    break
+                if message[2] not in rules:
+                    continue  # Rule was deleted in the meantime
+                if message[0] == "sweep":
+                    _, worker_no, rule_id, result, breaker_status = message
+                    if result:
+                        config.sweep_results[rule_id] = result
+                    workers[worker_no].status["elasticsearch"] = breaker_status
+                elif message[0] == "offenders":
+                    _, worker_no, rule_id, offenders = message
+                    plugins.background.block_offenders(config, rules[rule_id][1], offenders)
+            await asyncio.sleep(RESULTS_POLL_INTERVAL)
+    finally:
+        await asyncio.gather(*[worker.stop() for worker in workers])
+        config.worker_status = []
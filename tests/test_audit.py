@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import zlib
+import netaddr
+import pytest
+import asfpy.sqlite
+import endpoints.audit
+import plugins.audit
+import plugins.storage
+
+""" Tests for audit log querying and archival """
+
+ENTRIES = ["192.0.2.7", "192.0.2.0/24", "198.51.100.1", "10.0.0.0/8", "2001:db8::1", "2001:db8::/48", "not an ip"]
+
+
+@pytest.fixture(params=["sqlite", "memory", "log"])
+def config(request, tmp_path):
+    store = plugins.storage.open_store(request.param, str(tmp_path / f"blocky4.{request.param}"))
+    for i, ip in enumerate(ENTRIES):
+        store.add_audit_entry({"ip": ip, "timestamp": 1700000000 + i, "event": f"Event {i}"})
+    return type("Config", (), {"store": store})
+
+
+def find(config, ip: str, **kwargs) -> list:
+    entries, _ = plugins.audit.query(config, network=netaddr.IPNetwork(ip), **kwargs)
+    return sorted(entry["ip"] for entry in entries)
+
+
+def test_network_filter(config):
+    assert find(config, "192.0.2.7") == ["192.0.2.0/24", "192.0.2.7"]  # The IP, and the block it is in
+    assert find(config, "192.0.0.0/16") == ["192.0.2.0/24", "192.0.2.7"]  # Everything within the network
+    assert find(config, "192.0.2.70") == ["192.0.2.0/24"]
+    assert find(config, "10.20.30.40") == ["10.0.0.0/8"]
+    assert find(config, "2001:db8::/32") == ["2001:db8::/48", "2001:db8::1"]
+    assert find(config, "::ffff:198.51.100.1") == ["198.51.100.1"]
+    assert find(config, "203.0.113.0/24") == []
+    assert find(config, "192.0.2.7", before=(1700000001, 2)) == ["192.0.2.7"]
+
+
+def test_archive_skips_chunks(config, monkeypatch):
+    plugins.audit.rollup(config, 1700000000 + len(ENTRIES))
+    assert config.store.audit_entries(100) == []
+    chunk = next(config.store.audit_archive())
+    assert json.loads(chunk["networks"]) == [
+        list(plugins.storage.network_range(netaddr.IPNetwork(network)))
+        for network in ["10.0.0.0/8", "192.0.0.0/16", "198.51.0.0/16", "2001:db8::/32"]
+    ]
+
+    decompressed = []
+    decompress = zlib.decompress
+    monkeypatch.setattr(plugins.audit.zlib, "decompress", lambda data: decompressed.append(data) or decompress(data))
+    assert find(config, "192.0.2.7", include_archive=True) == ["192.0.2.0/24", "192.0.2.7"]
+    assert len(decompressed) == 1
+    assert find(config, "203.0.113.0/24", include_archive=True) == []
+    assert len(decompressed) == 1, "Chunk holds nothing in 203.0.113.0/24, and should not be decompressed"
+
+
+def test_sqlite_upgrade_fills_ranges(tmp_path):
+    filepath = str(tmp_path / "blocky4.sqlite")
+    db = asfpy.sqlite.DB(filepath)
+    db.runc(plugins.db_create.CREATE_DB_RULES)
+    db.runc(plugins.db_create.CREATE_DB_LISTS)
+    db.runc(
+        'CREATE TABLE "auditlog" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, "ip" TEXT NOT NULL, '
+        '"event" TEXT NOT NULL, "timestamp" INTEGER NOT NULL);'
+    )
+    for i, ip in enumerate(ENTRIES):
+        db.insert("auditlog", {"ip": ip, "timestamp": 1700000000 + i, "event": f"Event {i}"})
+    db.connector.commit()
+    db.connector.close()
+
+    config = type("Config", (), {"store": plugins.storage.SQLiteStore(filepath)})
+    assert find(config, "192.0.2.7") == ["192.0.2.0/24", "192.0.2.7"]
+    assert find(config, "2001:db8::1") == ["2001:db8::/48", "2001:db8::1"]
+
+
+@pytest.mark.parametrize(
+    "formdata", [{"before": 123}, {"before": ["1700000001:2"]}, {"before": "soon"}, {"limit": [5]}]
+)
+def test_endpoint_rejects_bad_cursors(config, formdata):
+    response = asyncio.run(endpoints.audit.process(config, None, formdata))
+    assert response["success"] is False
+    assert response["status"] == "invalid"
+
+
+def test_endpoint_pages(config):
+    response = asyncio.run(endpoints.audit.process(config, None, {"limit": 2, "before": "1700000003:4"}))
+    assert [entry["event"] for entry in response["entries"]] == ["Event 2", "Event 1"]
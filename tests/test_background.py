@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+import types
+import pytest
+import plugins.background
+import plugins.breaker
+import plugins.configuration
+import plugins.profiling
+
+""" Tests for blocking the offenders rules find """
+
+
+@pytest.fixture
+def config(tmp_path) -> plugins.configuration.BlockyConfiguration:
+    return plugins.configuration.BlockyConfiguration(
+        {"storage": "memory", "database": str(tmp_path / "blocky4.sqlite"), "elasticsearch_url": "http://localhost:9200/"}
+    )
+
+
+def make_rule(rule_id: int = 1) -> plugins.background.BanRule:
+    return plugins.background.BanRule(
+        {"id": rule_id, "description": "Too many requests", "aggtype": "requests", "limit": 100, "duration": "1h", "filters": ""}
+    )
+
+
+def blocked(config) -> dict:
+    return {entry["ip"]: entry for entry in config.block_list}
+
+
+def test_blocks_new_offenders(config):
+    plugins.background.block_offenders(config, make_rule(), [("192.0.2.1", 500), ("192.0.2.1", 500)])
+    assert blocked(config)["192.0.2.1"]["rule"] == 1
+    assert config.offender_stats[1]["blocked"] == 1
+    assert config.offender_stats[1]["already_blocked"] == 1
+
+
+def test_skips_allowed_and_invalid_offenders(config):
+    config.allow_list.add(ip="198.51.100.0/24", reason="friends", host="*")
+    offenders = [("not-an-ip", 500), ("198.51.100.7", 500), ("", 400), ("203.0.113.9", 300)]
+    plugins.background.block_offenders(config, make_rule(), offenders)
+    assert list(blocked(config)) == ["203.0.113.9"]
+    stats = config.offender_stats[1]
+    assert (stats["invalid"], stats["allowed"], stats["blocked"]) == (2, 1, 1)
+
+
+def test_network_block_replaces_only_rule_blocks(config):
+    now = int(time.time())
+    plugins.background.block_offenders(config, make_rule(), [("192.0.2.1", 500)])
+    config.block_list.add(ip="192.0.2.2", expires=-1, reason="permanent", host="*")
+    config.block_list.add(ip="192.0.2.3", expires=now + 3600, reason="by hand", host="*")
+    config.block_list.add(ip="192.0.2.4", expires=now + 3600, reason="one host", host="www1", rule=1)
+    plugins.background.block_offenders(config, make_rule(2), [("192.0.2.0/24", 5000)])
+    assert sorted(blocked(config)) == ["192.0.2.0/24", "192.0.2.2", "192.0.2.3", "192.0.2.4"]
+    assert config.offender_stats[2]["replaced"] == 1
+
+    # Covered by the network block now
+    plugins.background.block_offenders(config, make_rule(), [("192.0.2.5", 500)])
+    assert "192.0.2.5" not in blocked(config)
+
+
+def test_offender_cache_evicts_least_recently_seen(config, monkeypatch):
+    monkeypatch.setattr(plugins.background, "OFFENDER_CACHE_SIZE", 3)
+    for ip in ["192.0.2.1", "192.0.2.2", "192.0.2.3"]:
+        assert plugins.background.cached_offender_status(config, ip) == (None, False)
+    assert plugins.background.cached_offender_status(config, "192.0.2.1") == (None, True)
+    plugins.background.cached_offender_status(config, "192.0.2.4")  # Pushes out .2, which was seen least recently
+    assert list(config.offender_cache) == ["192.0.2.3", "192.0.2.1", "192.0.2.4"]
+
+
+def test_offender_cache_follows_list_changes(config):
+    assert plugins.background.cached_offender_status(config, "192.0.2.1") == (None, False)
+    config.block_list.add(ip="192.0.2.0/24", reason="test", host="*")
+    assert plugins.background.cached_offender_status(config, "192.0.2.1") == ("blocked", False)
+    assert plugins.background.cached_offender_status(config, "192.0.2.1") == ("blocked", True)
+    config.allow_list.add(ip="192.0.2.1", reason="test", host="*", force=True)
+    assert plugins.background.cached_offender_status(config, "192.0.2.1") == ("allowed", False)
+
+
+def test_due_rules_run_concurrently_within_breaker_limit(monkeypatch):
+    monkeypatch.setattr(plugins.background, "MIN_RULE_INTERVAL", 0)  # Everything is due right away
+    monkeypatch.setattr(plugins.background, "SCHEDULER_TICK", 0.01)
+    state = types.SimpleNamespace(
+        es_breaker=plugins.breaker.CircuitBreaker(concurrency=3),
+        profiler=plugins.profiling.Profiler(),
+        sweep_results={},
+        offender_stats={},
+    )
+    rules = [dict(make_rule(rule_id).__dict__, filters="", interval=3600) for rule_id in range(10)]
+    started = []
+    peak = 0
+
+    async def search():
+        nonlocal peak
+        peak = max(peak, state.es_breaker.inflight)
+        await asyncio.sleep(0.05)
+
+    async def process(my_rule):
+        started.append(my_rule.id)
+        await state.es_breaker.call(search)
+        if my_rule.id == 0:
+            raise ValueError("Broken rule")
+
+    async def run_for_a_while():
+        scheduler = asyncio.create_task(plugins.background.run_schedule(state, lambda: rules, process))
+        await asyncio.sleep(0.5)
+        scheduler.cancel()
+
+    asyncio.run(run_for_a_while())
+    assert sorted(started) == list(range(10)), "Every rule ran once, despite one of them failing"
+    assert peak == 3
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import collections
+import math
+import types
+import pytest
+import plugins.background
+import plugins.backtest
+import plugins.breaker
+
+""" Tests for backtest query construction """
+
+
+class FakeIndices:
+    def __init__(self, existing):
+        self.existing = existing
+        self.calls = []
+
+    async def get(self, index: str, **params):
+        self.calls.append((index, params))
+        return {name: {} for name in index.split(",") if name in self.existing}
+
+
+def make_config(max_buckets: int = 65535, prefix_field: str = None, existing=()) -> types.SimpleNamespace:
+    return types.SimpleNamespace(
+        elasticsearch=types.SimpleNamespace(indices=FakeIndices(existing)),
+        es_breaker=plugins.breaker.CircuitBreaker(),
+        es_max_buckets=max_buckets,
+        index_pattern="loggy-%Y-%m-%d",
+        prefix_field=prefix_field,
+        prefix_field_lengths=[24, 64],
+    )
+
+
+def total_buckets(query: dict, window: int) -> int:
+    """Worst case number of buckets an ES aggregation of this query returns"""
+    clients = query["aggs"]["clients"]
+    granularity = int(clients["aggs"]["over_time"]["date_histogram"]["fixed_interval"].rstrip("s"))
+    return clients["terms"]["size"] * (1 + math.ceil(window / granularity) + 1)
+
+
+@pytest.mark.parametrize("max_buckets", [10000, 65535])
+@pytest.mark.parametrize("aggtype", ["requests", "bytes"])
+@pytest.mark.parametrize("prefixes", [(0, 0), (24, 64), (16, 48)])
+@pytest.mark.parametrize("window", [60, 3600, 86400 - 60, 86400 * 7 + 1, plugins.backtest.MAX_BACKTEST_WINDOW])
+def test_query_stays_under_max_buckets(max_buckets, aggtype, prefixes, window):
+    config = make_config(max_buckets, prefix_field="client_prefix.keyword")
+    q, granularity, _ = plugins.backtest.historical_query(
+        config, aggtype, ["vhost == example.org"], prefixes[0], prefixes[1], window, 1700000040
+    )
+    query = q.to_dict()
+    assert total_buckets(query, window) <= max_buckets
+    assert window % granularity == 0, "Buckets must add up to the window exactly"
+    assert window // granularity <= plugins.backtest.BACKTEST_BUCKETS
+
+
+def test_query_shape_shrinks_clients_and_buckets_together():
+    clients, buckets = plugins.backtest.query_shape(10**9, 1000)
+    assert (clients, buckets) == (1000, plugins.backtest.BACKTEST_BUCKETS)  # Plenty of room
+    clients, buckets = plugins.backtest.query_shape(65535, 1000)
+    assert 1000 / clients == pytest.approx(plugins.backtest.BACKTEST_BUCKETS / buckets, rel=0.05)
+    clients, buckets = plugins.backtest.query_shape(10000, 10000)  # Rolling up IPs ourselves, on an older ES
+    assert buckets == plugins.backtest.MIN_BACKTEST_BUCKETS
+    assert clients * (buckets + 2) <= 10000
+
+
+def test_query_aligns_buckets_to_end():
+    end = 1700000040
+    q, granularity, rollup = plugins.backtest.historical_query(make_config(), "requests", [], 24, 0, 86400, end)
+    histogram = q.to_dict()["aggs"]["clients"]["aggs"]["over_time"]["date_histogram"]
+    assert histogram["offset"] == f"+{end % granularity}s"
+    assert rollup, "No prefix field configured, so IPs are rolled up afterwards"
+
+
+def test_historical_indices_single_lookup():
+    config = make_config(existing={"loggy-2023-11-13", "loggy-2023-11-14"})
+    end = 1700000000  # 2023-11-14 22:13 UTC
+    indices = asyncio.run(plugins.backtest.historical_indices(config, end - 86400 * 3, end))
+    assert indices == ["loggy-2023-11-13", "loggy-2023-11-14"]
+    assert len(config.elasticsearch.indices.calls) == 1
+    index, params = config.elasticsearch.indices.calls[0]
+    assert index == "loggy-2023-11-11,loggy-2023-11-12,loggy-2023-11-13,loggy-2023-11-14"
+    assert params["ignore_unavailable"]
+    assert list(config.es_breaker.outcomes) == [True], "Lookup goes through the circuit breaker"
+
+
+NOVEMBER = {f"loggy-2023-11-{day:02}" for day in range(1, 31)}
+
+
+class FakeSearch:
+    """Answers backtest searches from a list of (client, timestamp) requests, bucketed the way ES would"""
+
+    def __init__(self, requests):
+        self.requests = requests
+        self.searches = []
+
+    async def __call__(self, index: str, body: dict, **params):
+        histogram = body["aggs"]["clients"]["aggs"]["over_time"]["date_histogram"]
+        size = int(histogram["fixed_interval"].rstrip("s"))
+        offset = int(histogram["offset"].strip("+s"))
+        start, end = (body["query"]["bool"]["filter"][0]["range"]["@timestamp"][x] // 1000 for x in ("gte", "lt"))
+        self.searches.append(size)
+        clients = {}
+        for client, timestamp in self.requests:
+            if start <= timestamp < end:
+                key = (timestamp - offset) // size * size + offset
+                clients.setdefault(client, {}).setdefault(key, 0)
+                clients[client][key] += 1
+        buckets = []
+        for client, series in clients.items():
+            over_time = [{"key": key * 1000, "doc_count": count} for key, count in series.items()]
+            buckets.append({"key": client, "over_time": {"buckets": over_time}})
+        return {"aggregations": {"clients": {"buckets": buckets}}}
+
+
+@pytest.mark.parametrize("durations", [["1h", "7d"], ["45m", "24h"], ["7d", "24h", "1h", "45m"]])
+def test_mixed_durations_are_exact(durations):
+    end = 1700000040
+    config = make_config(existing=NOVEMBER, prefix_field="client_prefix.keyword")
+    config.elasticsearch.search = FakeSearch([("192.0.2.0/24", end - offset) for offset in range(1, 86400 * 7, 97)])
+    config.backtest_cache = collections.OrderedDict()
+    windows = sorted({plugins.background.duration_to_seconds(duration) for duration in durations}, reverse=True)
+    for i, window in enumerate(windows):
+        result, _ = asyncio.run(
+            plugins.backtest.historical_series(config, "requests", [], 24, 64, window, end, windows[i:])
+        )
+        expected = len([offset for offset in range(1, 86400 * 7, 97) if offset <= window])
+        assert plugins.backtest.totals(result, window) == [("192.0.2.0/24", expected)], window
+    assert len(config.elasticsearch.search.searches) <= len(windows)
+
+
+def test_cache_needs_matching_buckets():
+    end = 1700000040
+    config = make_config(existing=NOVEMBER, prefix_field="client_prefix.keyword")
+    config.elasticsearch.search = FakeSearch([])
+    config.backtest_cache = collections.OrderedDict()
+    week, day, hour = 86400 * 7, 86400, 3600
+    result, cached = asyncio.run(plugins.backtest.historical_series(config, "requests", [], 24, 64, week, end))
+    assert not cached
+    assert day % result["granularity"] == 0 and hour % result["granularity"] != 0
+    assert asyncio.run(plugins.backtest.historical_series(config, "requests", [], 24, 64, day, end))[1]
+    result, cached = asyncio.run(plugins.backtest.historical_series(config, "requests", [], 24, 64, hour, end))
+    assert not cached, "The week's buckets are too coarse for an hour"
+    assert asyncio.run(plugins.backtest.historical_series(config, "requests", [], 24, 64, hour, end))[1]
+    assert asyncio.run(plugins.backtest.historical_series(config, "requests", [], 24, 64, week, end))[1]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+import elasticsearch
+import pytest
+import plugins.breaker
+
+""" Tests for the ElasticSearch circuit breaker """
+
+
+async def succeed():
+    return "ok"
+
+
+def failing(exception: Exception):
+    async def query():
+        raise exception
+    return query
+
+
+def test_opens_after_consecutive_failures():
+    breaker = plugins.breaker.CircuitBreaker()
+    for _ in range(plugins.breaker.BREAKER_CONSECUTIVE_FAILURES - 1):
+        breaker.record(False, 0.1)
+    assert breaker.state == "closed"
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_probe_closes_or_reopens_with_longer_cooldown():
+    breaker = plugins.breaker.CircuitBreaker()
+    breaker.trip()
+    breaker.open_until = time.time() - 1  # Cooldown is over
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    assert not breaker.allow(), "Only a single probe at a time"
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+    assert breaker.open_until - time.time() > plugins.breaker.BREAKER_COOLDOWN  # Backed off further
+    breaker.open_until = time.time() - 1
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.trips == 0
+
+
+def test_pressure_shapes_queries():
+    breaker = plugins.breaker.CircuitBreaker(concurrency=4)
+    assert (breaker.pressure, breaker.concurrency, breaker.size(100)) == (0, 4, 100)
+    breaker.latency = plugins.breaker.PRESSURE_THRESHOLDS[2][0]
+    assert (breaker.pressure, breaker.concurrency, breaker.size(100)) == (2, 1, 25)
+    assert breaker.interval_factor() == plugins.breaker.PRESSURE_INTERVAL_FACTOR[2]
+
+
+@pytest.mark.parametrize(
+    "exception",
+    [
+        asyncio.TimeoutError(),
+        elasticsearch.exceptions.ConnectionError("N/A", "refused", None),
+        elasticsearch.exceptions.ConnectionTimeout("TIMEOUT", "timed out", None),
+        elasticsearch.exceptions.TransportError(503, "unavailable", {}),
+        elasticsearch.exceptions.TransportError(429, "too many requests", {}),
+    ],
+)
+def test_server_errors_count_as_failures(exception):
+    breaker = plugins.breaker.CircuitBreaker()
+    with pytest.raises(type(exception)):
+        asyncio.run(breaker.call(failing(exception)))
+    assert list(breaker.outcomes) == [False]
+    assert breaker.consecutive_failures == 1
+
+
+@pytest.mark.parametrize(
+    "exception",
+    [
+        elasticsearch.exceptions.RequestError(400, "parsing_exception", {}),
+        elasticsearch.exceptions.NotFoundError(404, "index_not_found_exception", {}),
+        ValueError("not an ES problem"),
+    ],
+)
+def test_client_errors_are_not_counted(exception):
+    breaker = plugins.breaker.CircuitBreaker()
+    for _ in range(plugins.breaker.BREAKER_CONSECUTIVE_FAILURES + 1):
+        with pytest.raises(type(exception)):
+            asyncio.run(breaker.call(failing(exception)))
+    assert breaker.state == "closed"
+    assert not breaker.outcomes
+    assert breaker.inflight == 0
+
+
+def test_client_error_frees_the_probe():
+    breaker = plugins.breaker.CircuitBreaker()
+    breaker.trip()
+    breaker.open_until = time.time() - 1
+    with pytest.raises(elasticsearch.exceptions.RequestError):
+        asyncio.run(breaker.call(failing(elasticsearch.exceptions.RequestError(400, "bad", {}))))
+    assert breaker.state == "half-open"
+    assert asyncio.run(breaker.call(succeed)) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_concurrency_limit_binds():
+    breaker = plugins.breaker.CircuitBreaker(concurrency=4)
+    peak = {"inflight": 0, "waiting": 0}
+
+    async def query():
+        peak["inflight"] = max(peak["inflight"], breaker.inflight)
+        peak["waiting"] = max(peak["waiting"], breaker.waiting)
+        await asyncio.sleep(0.01)
+
+    async def run_queries():
+        breaker.latency = 60.0  # ES is very slow, so fewer queries at once
+        await asyncio.gather(*[breaker.call(query) for _ in range(10)])
+
+    asyncio.run(run_queries())
+    # Pressure eases as the fast queries bring the average latency down, but never allows all four at once
+    assert peak["inflight"] <= plugins.breaker.PRESSURE_MAX_CONCURRENCY[1] < breaker.max_concurrency
+    assert peak["waiting"] > 0
+    assert (breaker.inflight, breaker.waiting) == (0, 0)
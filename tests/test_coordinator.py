@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import sqlite3
+import pytest
+import plugins.configuration
+import plugins.coordinator
+import plugins.snapshot
+import plugins.storage
+
+""" Tests for coordinating instances that share a database """
+
+
+def instance(tmp_path, name: str) -> plugins.configuration.BlockyConfiguration:
+    return plugins.configuration.BlockyConfiguration(
+        {
+            "database": str(tmp_path / "blocky4.sqlite"),
+            "elasticsearch_url": "http://localhost:9200/",
+            "instance_id": name,
+            "lease_ttl": 30,
+        }
+    )
+
+
+@pytest.fixture
+def instances(tmp_path):
+    return instance(tmp_path, "one"), instance(tmp_path, "two")
+
+
+def test_lease_is_held_by_one_instance(instances):
+    one, two = instances
+    assert one.coordinator.try_acquire()
+    assert one.coordinator.try_acquire(), "Renewing our own lease"
+    assert not two.coordinator.try_acquire()
+    assert two.coordinator.holder == "one"
+    one.coordinator.release()
+    assert two.coordinator.try_acquire()
+    assert not one.coordinator.try_acquire()
+
+
+def test_expired_lease_is_taken_over(instances, monkeypatch):
+    one, two = instances
+    assert one.coordinator.try_acquire()
+    expires = one.coordinator.lease_expires
+    monkeypatch.setattr(plugins.storage.time, "time", lambda: expires + 1)
+    assert two.coordinator.try_acquire()
+    assert not one.coordinator.try_acquire()
+    assert one.coordinator.holder == "two"
+
+
+def test_changes_are_replayed_on_other_instances(instances):
+    one, two = instances
+    one.block_list.add(ip="192.0.2.1", reason="test")
+    one.allow_list.add(ip="198.51.100.0/24", reason="test")
+    plugins.coordinator.sync_lists(two)
+    assert [entry["ip"] for entry in two.block_list] == ["192.0.2.1"]
+    assert "198.51.100.0/24" in [entry["ip"] for entry in two.allow_list]
+
+    one.block_list.remove("192.0.2.1")
+    plugins.coordinator.sync_lists(two)
+    assert not list(two.block_list)
+    assert two.lists_synced == one.store.latest_list_change()
+
+
+def test_snapshot_never_misses_changes(instances, tmp_path, monkeypatch):
+    one, two = instances
+    sync_lists = plugins.coordinator.sync_lists
+
+    def sync_then_change(config):
+        sync_lists(config)
+        two.block_list.add(ip="192.0.2.2", reason="Added by another instance while we were snapshotting")
+
+    monkeypatch.setattr(plugins.coordinator, "sync_lists", sync_then_change)
+    plugins.snapshot.save(one)
+    monkeypatch.undo()
+    assert "192.0.2.2" in [entry["ip"] for entry in instance(tmp_path, "three").block_list]
+
+
+def test_dead_workers_are_restarted(instances):
+    one, _ = instances
+    started = []
+
+    async def flaky():
+        started.append("flaky")
+        if len(started) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        await asyncio.sleep(3600)
+
+    async def steady():
+        started.append("steady")
+        await asyncio.sleep(3600)
+
+    async def lead():
+        one.coordinator.step_up([flaky, steady])
+        await asyncio.sleep(0)
+        one.coordinator.revive()
+        await asyncio.sleep(0)
+        one.coordinator.revive()
+        tasks = list(one.coordinator.tasks)
+        one.coordinator.step_down()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(lead())
+    assert sorted(started) == ["flaky", "flaky", "steady"]
+    assert one.coordinator.status()["restarts"] == 1
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import random
+import netaddr
+import pytest
+import plugins.background
+import plugins.configuration
+import plugins.snapshot
+import plugins.storage
+
+""" Tests for the allow/block lists, loaded from a snapshot and hydrated on demand """
+
+BLOCKS = 20000  # Block list entries in the test database
+
+
+def load(tmp_path) -> plugins.configuration.BlockyConfiguration:
+    return plugins.configuration.BlockyConfiguration(
+        {"database": str(tmp_path / "blocky4.sqlite"), "elasticsearch_url": "http://localhost:9200/"}
+    )
+
+
+def fill(config: plugins.configuration.BlockyConfiguration):
+    """Adds BLOCKS /29 networks and single IPv6 addresses to the block list, the way a busy instance would have"""
+    rows = []
+    for i in range(BLOCKS):
+        if i % 2:
+            ip = f"198.{18 + i // 16384}.{i // 64 % 256}.{i // 2 % 32 * 8}/29"
+        else:
+            ip = f"2001:db8::{i >> 16:x}:{i & 0xffff:x}"
+        rows.append(("block", ip, "test", 1700000000, -1, "*", 1))
+    db = config.store.db.connector
+    db.execute("BEGIN")
+    db.executemany(
+        'INSERT INTO "lists" ("type", "ip", "reason", "timestamp", "expires", "host", "rule") VALUES (?, ?, ?, ?, ?, ?, ?)',
+        rows,
+    )
+    db.execute("COMMIT")
+
+
+@pytest.fixture
+def config(tmp_path) -> plugins.configuration.BlockyConfiguration:
+    fill(load(tmp_path))
+    plugins.snapshot.save(load(tmp_path))
+    config = load(tmp_path)
+    assert len(config.block_list.pending) == BLOCKS, "Lists should be loaded from the snapshot"
+    return config
+
+
+def test_overlap_checks_stay_lazy(config):
+    network = netaddr.IPNetwork
+    assert plugins.background.offender_status(config, network("198.18.0.20")) == "blocked"
+    assert plugins.background.offender_status(config, network("10.0.3.4")) == "allowed"
+    assert plugins.background.offender_status(config, network("198.51.100.1")) is None
+    assert plugins.background.offender_status(config, network("2001:db8::2")) == "blocked"
+    assert plugins.background.offender_status(config, network("2001:db8::1:0")) is None
+    assert len(config.block_list.hydrated) == 2, "Only the entries that matched should be hydrated"
+
+    config.block_list.add(ip="198.18.0.0/24", reason="test", keep_blocks=True)
+    assert len(config.block_list.hydrated) == 3
+    with pytest.raises(plugins.lists.BlockListException):
+        config.allow_list.add(ip="198.18.0.33", reason="test")
+    assert len(config.block_list.hydrated) == 4, "Conflicts with the /24, and the /29 within it"
+
+
+def test_overlapping_matches_netaddr(config):
+    block_list = config.block_list
+    block_list.overlapping(netaddr.IPNetwork("192.0.2.0/24"))  # Builds the index, changes below must keep it current
+    block_list.add(ip="198.18.0.0/16", reason="test", keep_blocks=True)
+    block_list.add(ip="2001:db8::/120", reason="test", keep_blocks=True)
+    block_list.remove("198.18.0.16/29")
+    block_list.forget(next(iter(block_list.pending)))
+    block_list.learn(dict(config.store.list_entry(block_list.rowids.pop()), id=BLOCKS + 100, ip="198.18.7.0/25"))
+
+    entries = list(block_list)
+    assert not block_list.pending
+    searches = ["198.18.0.0/16", "198.18.0.0/15", "198.18.0.16/29", "198.18.7.66", "198.18.4.0/23", "198.51.100.1"]
+    searches += ["2001:db8::/120", "2001:db8::ff", "2001:db8::100", "2001:db8::/32", "::/0", "0.0.0.0/0"]
+    rng = random.Random(28)
+    searches += [f"198.18.{rng.randrange(256)}.{rng.randrange(256)}/{rng.randrange(16, 33)}" for _ in range(50)]
+    for search in searches:
+        network = netaddr.IPNetwork(search)
+        expected = [entry.rowid for entry in entries if entry.network in network or network in entry.network]
+        assert sorted(entry.rowid for entry in block_list.overlapping(network)) == sorted(expected), search
+
+
+def test_iteration_is_lazy(config):
+    iterator = iter(config.block_list)
+    next(iterator)
+    assert len(config.block_list.hydrated) == plugins.lists.HYDRATE_CHUNK_SIZE
+    assert len(list(config.block_list)) == BLOCKS
+    assert not config.block_list.pending
+
+
+def test_snapshot_skips_reading_rows(tmp_path, monkeypatch):
+    """Start-up from a snapshot must not read the lists from the database, loading them is what makes it slow"""
+    rows_read = []
+
+    def counted(method):
+        def read(self, *args):
+            entries = method(self, *args)
+            rows_read.extend(entries)
+            return entries
+
+        return read
+
+    for name in ("list_entries", "list_entries_by_id"):
+        monkeypatch.setattr(plugins.storage.SQLiteStore, name, counted(getattr(plugins.storage.SQLiteStore, name)))
+
+    fill(load(tmp_path))
+    rows_read.clear()
+    load(tmp_path)
+    assert len(rows_read) >= BLOCKS, "Without a snapshot, every row is read"
+
+    plugins.snapshot.save(load(tmp_path))
+    rows_read.clear()
+    config = load(tmp_path)
+    assert len(config.block_list.pending) == BLOCKS
+    assert rows_read == [], "With a current snapshot, no rows are read until they are needed"
\ No newline at end of file
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+import types
+import pytest
+import plugins.profiling
+import endpoints.debug
+
+""" Tests for the profiler, the event loop lag watchdog and the debug endpoint """
+
+
+def test_spans_are_recorded():
+    profiler = plugins.profiling.Profiler(enabled=True)
+    for delay in (0.01, 0.03):
+        with profiler.span("sweep"):
+            time.sleep(delay)
+    with profiler.span("expiry"):
+        pass
+    spans = profiler.status()["spans"]
+    assert spans["sweep"]["count"] == 2
+    assert spans["sweep"]["max"] >= 0.03
+    assert spans["sweep"]["last"] == spans["sweep"]["max"]
+    assert spans["sweep"]["average"] == pytest.approx(spans["sweep"]["total"] / 2, abs=0.001)
+    assert spans["expiry"]["count"] == 1
+
+
+def test_span_records_failures():
+    profiler = plugins.profiling.Profiler(enabled=True)
+    with pytest.raises(RuntimeError):
+        with profiler.span("sweep"):
+            raise RuntimeError("sweep failed")
+    assert profiler.status()["spans"]["sweep"]["count"] == 1
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = plugins.profiling.Profiler()
+    with profiler.span("sweep"):
+        time.sleep(0.01)
+    assert profiler.spans == {}
+    assert profiler.status()["spans"] == {}
+
+
+def watch(profiler: plugins.profiling.Profiler, block: float) -> list:
+    """Runs the lag monitor while something hogs the event loop for $block seconds"""
+
+    def hog():
+        time.sleep(block)
+
+    async def run():
+        monitor = asyncio.create_task(profiler.monitor())
+        await asyncio.sleep(plugins.profiling.LAG_CHECK_INTERVAL * 2)
+        hog()
+        await asyncio.sleep(plugins.profiling.LAG_CHECK_INTERVAL * 2)
+        monitor.cancel()
+        return list(profiler.incidents)
+
+    return asyncio.run(run())
+
+
+def test_lag_above_threshold_is_recorded():
+    profiler = plugins.profiling.Profiler(enabled=True, lag_threshold=0.1)
+    incidents = watch(profiler, 0.4)
+    assert len(incidents) == 1, "One incident for one hog, however long it lasts"
+    assert incidents[0]["lag"] >= 0.1
+    assert any("hog" in line for line in incidents[0]["stack"]), "The stack shows what was hogging the loop"
+
+
+def test_lag_below_threshold_is_ignored():
+    profiler = plugins.profiling.Profiler(enabled=True, lag_threshold=0.2)
+    assert watch(profiler, 0.02) == []
+
+
+def debug(profiler: plugins.profiling.Profiler, formdata: dict):
+    return asyncio.run(endpoints.debug.process(types.SimpleNamespace(profiler=profiler), None, formdata))
+
+
+def test_debug_endpoint_disabled():
+    response = debug(plugins.profiling.Profiler(), {"seconds": "1"})
+    assert response["success"] is False
+    assert response["status"] == "disabled"
+
+
+@pytest.mark.parametrize(
+    "formdata",
+    [
+        {"seconds": "nan"},
+        {"seconds": "inf"},
+        {"seconds": "-1"},
+        {"seconds": str(plugins.profiling.MAX_PROFILE_SECONDS + 1)},
+        {"seconds": "soon"},
+        {"sweeps": "-1"},
+        {"sweeps": "1.5"},
+        {"seconds": "1", "format": "svg"},
+        {"seconds": "1", "sort": "nonsense"},
+        {"seconds": "1", "sort": ["time"]},
+    ],
+)
+def test_debug_endpoint_validation(formdata):
+    response = debug(plugins.profiling.Profiler(enabled=True), formdata)
+    assert response["success"] is False
+    assert response["status"] == "invalid"
+
+
+def test_debug_endpoint_status():
+    profiler = plugins.profiling.Profiler(enabled=True, lag_threshold=0.25)
+    with profiler.span("sweep"):
+        pass
+    profiler.sweep_done()
+    response = debug(profiler, {})
+    assert response["lag_threshold"] == 0.25
+    assert response["sweeps"] == 1
+    assert response["spans"]["sweep"]["count"] == 1
+
+
+def test_debug_endpoint_busy():
+    profiler = plugins.profiling.Profiler(enabled=True)
+    profiler.busy = True
+    assert debug(profiler, {"seconds": "1"})["status"] == "busy"
+
+
+@pytest.mark.parametrize("output_format", endpoints.debug.OUTPUT_FORMATS)
+def test_debug_endpoint_profiles(output_format):
+    profiler = plugins.profiling.Profiler(enabled=True)
+    response = debug(profiler, {"seconds": "0.1", "format": output_format})
+    assert response.status == 200
+    assert response.body
+    assert profiler.busy is False
+
+
+def test_profile_until_sweeps_done():
+    profiler = plugins.profiling.Profiler(enabled=True)
+
+    async def sweeps():
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            profiler.sweep_done()
+
+    async def run():
+        sweeper = asyncio.create_task(sweeps())
+        started = time.monotonic()
+        await profiler.wait(sweeps=2)
+        took = time.monotonic() - started
+        await sweeper
+        return took
+
+    assert asyncio.run(run()) < 1, "Stops after the sweeps, not at the time limit"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+import plugins.rules
+
+""" Tests for ban rule validation """
+
+RULE = {"description": "Too many requests", "aggtype": "requests", "limit": "1000", "duration": "1h"}
+
+
+def test_parse_rule():
+    rule = plugins.rules.parse_rule(dict(RULE, filter="request_uri = /foo\nvhost !== example.org"))
+    assert rule["limit"] == 1000
+    assert (rule["interval"], rule["prefix4"], rule["prefix6"]) == (0, 0, 0)
+
+
+def test_limit_from_limits():
+    formdata = dict(RULE, limits=[500, 2000])
+    del formdata["limit"]
+    assert plugins.rules.parse_rule(formdata)["limit"] == 500
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        "vhost == example.org\nrequest_uri",  # Every line is checked, not just the first
+        "vhost example.org",
+        "vhost !~ example.org",
+        "vhost <> example.org\nrequest_uri = /foo",
+        ["vhost == example.org"],
+    ],
+)
+def test_invalid_filters(filter):
+    with pytest.raises(AssertionError):
+        plugins.rules.validate_filter(filter)
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"limit": "lots"},
+        {"limit": None},
+        {"limit": 0},
+        {"interval": "often"},
+        {"prefix4": "24bits"},
+        {"prefix4": 8},
+        {"duration": 3600},
+        {"aggtype": "hits"},
+    ],
+)
+def test_invalid_rules(changes):
+    with pytest.raises(AssertionError):
+        plugins.rules.parse_rule(dict(RULE, **changes))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import os
+import pytest
+import plugins.storage
+
+""" Tests for the log storage backend """
+
+
+def block(ip: str, timestamp: int = 1700000000) -> dict:
+    return {"ip": ip, "timestamp": timestamp, "expires": -1, "reason": "test", "host": "*", "type": "block"}
+
+
+def open_store(tmp_path, **options) -> plugins.storage.LogStore:
+    return plugins.storage.LogStore(str(tmp_path / "blocky4.store"), **options)
+
+
+def close(store: plugins.storage.LogStore):
+    store.log.close()
+    store.lock.close()  # Releases the lock, as if the process had exited
+
+
+def state(store: plugins.storage.Store) -> tuple:
+    return (
+        sorted((row["id"], row["ip"]) for row in store.list_entries()),
+        store.rules(),
+        [entry["ip"] for entry in store.audit_entries(100)],
+        store.lists_version(),
+    )
+
+
+def fill(store: plugins.storage.Store):
+    for i in range(10):
+        store.add_list_entry(block(f"192.0.2.{i}"))
+        store.add_audit_entry({"ip": f"192.0.2.{i}", "timestamp": 1700000000 + i, "event": "Blocked"})
+    store.remove_list_entries("block", "192.0.2.3")
+    rule_id = store.add_rule({"description": "test", "limit": 10})
+    store.update_rule(rule_id, {"description": "test, updated", "limit": 20})
+
+
+def test_replays_log_on_open(tmp_path):
+    store = open_store(tmp_path)
+    assert store.created
+    fill(store)
+    expected = state(store)
+    close(store)
+
+    reopened = open_store(tmp_path)
+    assert not reopened.created
+    assert state(reopened) == expected
+    assert reopened.add_list_entry(block("192.0.2.100")) == 11  # Ids carry on where they left off
+
+
+def test_compaction_replaces_log_with_snapshot(tmp_path):
+    store = open_store(tmp_path)
+    fill(store)
+    asyncio.run(store.compact())
+    assert os.path.exists(tmp_path / "blocky4.store.snapshot")
+    assert [generation for generation, _ in store.log_files()] == [1]
+    store.add_list_entry(block("198.51.100.1"))  # Lands in the new log generation
+    expected = state(store)
+    close(store)
+
+    assert state(open_store(tmp_path)) == expected
+
+
+def test_changes_during_compaction_are_kept(tmp_path):
+    store = open_store(tmp_path)
+    fill(store)
+
+    async def compact_while_writing():
+        compaction = asyncio.create_task(store.compact())
+        await asyncio.sleep(0)  # Snapshot taken, now being written in a thread
+        store.add_list_entry(block("198.51.100.2"))
+        store.remove_list_entries("block", "192.0.2.4")
+        await compaction
+
+    asyncio.run(compact_while_writing())
+    expected = state(store)
+    close(store)
+    assert state(open_store(tmp_path)) == expected
+
+
+def test_failed_snapshot_keeps_old_log(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    fill(store)
+    expected = state(store)
+
+    def broken_disk(snapshot):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(store, "write_snapshot", broken_disk)
+    with pytest.raises(OSError):
+        asyncio.run(store.compact())
+    assert not store.compacting
+    close(store)
+    assert state(open_store(tmp_path)) == expected
+
+
+def test_incomplete_record_is_ignored(tmp_path):
+    store = open_store(tmp_path)
+    fill(store)
+    expected = state(store)
+    store.log.write('["list_add", {"id": 99, "entr')  # Crashed halfway through a write
+    close(store)
+    assert state(open_store(tmp_path)) == expected
+
+
+def test_writes_after_incomplete_record_are_kept(tmp_path):
+    store = open_store(tmp_path)
+    fill(store)
+    store.log.write('["list_add", {"id": 99, "entr')  # Crashed halfway through a write
+    close(store)
+
+    recovered = open_store(tmp_path)
+    recovered.add_list_entry(block("198.51.100.3"))
+    expected = state(recovered)
+    close(recovered)
+    reopened = open_store(tmp_path)
+    assert state(reopened) == expected
+    assert (11, "198.51.100.3") in state(reopened)[0]
+
+
+def test_single_instance_only(tmp_path):
+    store = open_store(tmp_path)
+    with pytest.raises(plugins.storage.StorageException):
+        open_store(tmp_path)
+    close(store)
+    close(open_store(tmp_path))
+
+
+def test_fsync_policy(tmp_path, monkeypatch):
+    with pytest.raises(plugins.storage.StorageException):
+        open_store(tmp_path, fsync="sometimes")
+
+    synced = []
+    monkeypatch.setattr(plugins.storage.os, "fsync", synced.append)
+    store = open_store(tmp_path, fsync="interval")
+    store.add_list_entry(block("192.0.2.1"))
+    store.add_list_entry(block("192.0.2.2"))
+    assert not synced
+    asyncio.run(store.maintain())
+    assert synced == [store.log.fileno()]
+    asyncio.run(store.maintain())
+    assert len(synced) == 1, "Nothing new to sync"
+    close(store)
+
+    synced.clear()
+    store = open_store(tmp_path, fsync="always")
+    store.add_list_entry(block("192.0.2.3"))
+    assert synced == [store.log.fileno()]
+    close(store)
+
+
+def test_matches_memory_store(tmp_path):
+    log_store = open_store(tmp_path)
+    memory_store = plugins.storage.MemoryStore()
+    fill(log_store)
+    fill(memory_store)
+    assert state(log_store) == state(memory_store)
+    close(log_store)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import types
+import pytest
+import plugins.stream
+
+""" Tests for the streaming offender detection """
+
+NOW = 1700000000.0
+
+
+def test_window_counter_sums_and_expires():
+    counter = plugins.stream.WindowCounter(3600)
+    counter.add("192.0.2.1", 1, NOW - 3000)
+    counter.add("192.0.2.1", 2, NOW - 10)
+    counter.add("192.0.2.2", 5, NOW)
+    assert counter.totals(NOW) == {"192.0.2.1": 3, "192.0.2.2": 5}
+    assert counter.totals(NOW + 1000) == {"192.0.2.1": 2, "192.0.2.2": 5}  # Oldest slot has expired
+    assert counter.totals(NOW + 3600) == {}
+    assert not counter.slots
+
+
+def test_window_counter_is_bounded(monkeypatch):
+    monkeypatch.setattr(plugins.stream, "STREAM_SLOT_CAPACITY", 10)
+    counter = plugins.stream.WindowCounter(60)
+    counter.add("heavy", 1000, NOW)
+    for i in range(100):
+        counter.add(f"192.0.2.{i}", 1, NOW)
+    assert len(counter.slots[int(NOW // counter.slot_seconds)]) <= 20
+    assert counter.totals(NOW)["heavy"] == 1000, "Largest counts survive pruning"
+
+
+def test_window_counter_expires_without_totals():
+    counter = plugins.stream.WindowCounter(3600)
+    for minute in range(3 * 24 * 60):  # Three days of traffic on an instance that never evaluates the counters
+        counter.add(f"192.0.2.{minute % 250}", 1, NOW + minute * 60)
+    assert len(counter.slots) <= plugins.stream.STREAM_SLOTS + 1
+    counter.add("198.51.100.1", 1, NOW)  # Long gone from the window
+    assert "198.51.100.1" not in counter.totals(NOW + 3 * 86400)
+
+
+@pytest.mark.parametrize(
+    "entry, line, expected",
+    [
+        ("request_uri = /wp-login.php", {"request_uri": "/blog/wp-login.php"}, True),
+        ("request_uri = foo", {"request_uri": "/bar"}, False),
+        ("vhost == example.org", {"vhost": "example.org"}, True),
+        ("vhost !== example.org", {"vhost": "example.org"}, False),
+        ("vhost.keyword == example.org", {"vhost": "example.org"}, True),
+        ("useragent ~= .*bot.*", {"useragent": "somebot/1.0"}, True),
+        ("useragent ~= bot", {"useragent": "somebot/1.0"}, False),  # Regexps match the whole value
+        ("geo.country == NL", {"geo": {"country": "NL"}}, True),
+        ("geo.country !== NL", {}, True),
+    ],
+)
+def test_log_filter(entry, line, expected):
+    assert plugins.stream.LogFilter(entry).matches(line) is expected
+
+
+@pytest.mark.parametrize(
+    "timestamp, expected",
+    [
+        (NOW - 60, NOW - 60),
+        ((NOW - 60) * 1000, NOW - 60),  # Epoch milliseconds
+        ("2023-11-14T22:11:40Z", NOW - 100),
+        ("2023-11-14T22:11:40", NOW - 100),
+        (NOW + 60, NOW),  # Future
+        ("yesterday", NOW),
+        (None, NOW),
+        (True, NOW),
+    ],
+)
+def test_parse_timestamp(timestamp, expected):
+    assert plugins.stream.parse_timestamp(timestamp, NOW) == pytest.approx(expected, abs=0.001)
+
+
+def make_engine(rules=()) -> plugins.stream.StreamEngine:
+    config = types.SimpleNamespace(store=types.SimpleNamespace(rules=lambda: list(rules)))
+    return plugins.stream.StreamEngine(config)
+
+
+RULE = {
+    "id": 1,
+    "description": "Login hammering",
+    "aggtype": "requests",
+    "limit": 3,
+    "duration": "1h",
+    "filters": "request_uri = wp-login.php",
+    "interval": 0,
+    "prefix4": 24,
+    "prefix6": 0,
+}
+
+
+def test_engine_finds_offenders():
+    engine = make_engine([RULE])
+    lines = [{"client_ip": f"192.0.2.{i}", "request_uri": "/wp-login.php"} for i in range(3)]
+    lines.append({"client_ip": "192.0.2.9", "request_uri": "/index.html"})
+    lines.append({"client_ip": "not-an-ip", "request_uri": "/wp-login.php"})
+    lines.append(json.dumps({"client_ip": "198.51.100.1", "request_uri": "/wp-login.php"}))
+    lines.append("not json")
+    assert engine.feed(lines) == 6
+    assert engine.rules[1].offenders(plugins.stream.time.time()) == [("192.0.2.0/24", 3)]
+
+
+def test_tail_follows_copytruncate(tmp_path, monkeypatch):
+    monkeypatch.setattr(plugins.stream, "TAIL_POLL_INTERVAL", 0.01)
+    logfile = tmp_path / "access.json"
+    logfile.write_text(json.dumps({"client_ip": "192.0.2.200"}) + "\n")  # Existing lines are skipped
+    engine = make_engine()
+    fed = []
+    engine.feed = lambda lines: fed.extend(json.loads(line)["client_ip"] for line in lines)
+
+    def write(ip: str, mode: str = "a", end: str = "\n"):
+        with open(logfile, mode) as f:
+            f.write(json.dumps({"client_ip": ip}) + end)
+
+    async def follow():
+        tail = asyncio.create_task(engine.tail(str(logfile)))
+        await asyncio.sleep(0.05)
+        write("192.0.2.1")
+        write("192.0.2.2", end="")  # Not completely written yet
+        await asyncio.sleep(0.05)
+        assert fed == ["192.0.2.1"]
+        with open(logfile, "a") as f:
+            f.write("\n")
+        await asyncio.sleep(0.05)
+        write("192.0.2.3", mode="w")  # Copied away and truncated, then written to again
+        await asyncio.sleep(0.05)
+        tail.cancel()
+
+    asyncio.run(follow())
+    assert fed == ["192.0.2.1", "192.0.2.2", "192.0.2.3"]
+
+
+def test_feed_picks_up_rule_changes(monkeypatch):
+    rules = []
+    engine = make_engine()
+    engine.config.store.rules = lambda: list(rules)
+    rules.append(RULE)
+    line = {"client_ip": "192.0.2.1", "request_uri": "/wp-login.php"}
+    engine.feed([line])
+    assert not engine.rules, "Rules are not looked up for every batch"
+    later = engine.rules_synced + plugins.stream.STREAM_RULE_SYNC_INTERVAL
+    monkeypatch.setattr(plugins.stream.time, "time", lambda: later)
+    engine.feed([line])
+    assert engine.rules[1].counter.totals(later) == {"192.0.2.0/24": 1}
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import pytest
+import plugins.background
+import plugins.configuration
+import endpoints.top
+
+""" Tests for the live top clients view """
+
+SEARCH_TIME = 0.05
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch) -> plugins.configuration.BlockyConfiguration:
+    config = plugins.configuration.BlockyConfiguration(
+        {"storage": "memory", "database": str(tmp_path / "blocky4.sqlite"), "elasticsearch_url": "http://localhost:9200/"}
+    )
+    config.searches = []
+    config.peak = 0
+
+    async def find_top_clients(config, aggtype, duration, no_hits, filters, prefix4, prefix6):
+        config.searches.append(duration)
+        config.peak = max(config.peak, config.es_breaker.inflight)
+        await asyncio.sleep(SEARCH_TIME)
+        return [("192.0.2.1", 100)]
+
+    monkeypatch.setattr(plugins.background, "find_top_clients", find_top_clients)
+    return config
+
+
+def add_rule(config, duration: str = "1h") -> int:
+    return config.store.add_rule(
+        {"description": "test", "aggtype": "requests", "limit": 10, "duration": duration, "filters": ""}
+    )
+
+
+def test_concurrent_viewers_share_one_search(config):
+    rule_id = add_rule(config)
+
+    async def viewers():
+        return await asyncio.gather(
+            *[endpoints.top.process(config, None, {"rule": rule_id, "refresh": "true"}) for _ in range(5)]
+        )
+
+    for response in asyncio.run(viewers()):
+        assert response["rules"][0]["top"] == [("192.0.2.1", 100)]
+    assert config.searches == ["1h"]
+    asyncio.run(endpoints.top.process(config, None, {"rule": rule_id, "refresh": "true"}))
+    assert config.searches == ["1h"], "Fresh results are not refreshed again"
+
+
+def test_rules_refresh_concurrently(config):
+    for duration in ["1h", "2h", "3h", "4h"]:
+        add_rule(config, duration)
+
+    response = asyncio.run(endpoints.top.process(config, None, {"refresh": "true"}))
+    assert len(response["rules"]) == 4
+    assert sorted(config.searches) == ["1h", "2h", "3h", "4h"]
+    assert config.peak == config.es_breaker.max_concurrency == 4, "Searches for all rules run at the same time"
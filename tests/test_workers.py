@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import multiprocessing
+import time
+import types
+import plugins.breaker
+import plugins.workers
+
+""" Tests for running rules in worker processes """
+
+
+def rule_ids(parts) -> list:
+    return [[rule["id"] for rule in part] for part in parts]
+
+
+def test_partition_is_complete_and_stable():
+    rules = [{"id": rule_id} for rule_id in [7, 3, 12, 1, 8]]
+    parts = plugins.workers.partition(rules, 3)
+    assert len(parts) == 3
+    assert sorted(sum(rule_ids(parts), [])) == [1, 3, 7, 8, 12]
+    assert rule_ids(parts) == rule_ids(plugins.workers.partition(reversed(rules), 3)), "Order does not matter"
+
+    # Adding or removing rules does not move the others to another worker
+    more = plugins.workers.partition(rules[1:] + [{"id": 20}, {"id": 21}], 3)
+    for before, after in zip(rule_ids(parts), rule_ids(more)):
+        assert set(before) - {7} <= set(after)
+
+
+def test_partition_with_fewer_rules_than_workers():
+    assert rule_ids(plugins.workers.partition([{"id": 4}], 3)) == [[], [4], []]
+    assert plugins.workers.partition([], 2) == [[], []]
+
+
+def test_stop_does_not_block():
+    worker = plugins.workers.Worker(0, {}, None)
+    worker.process = multiprocessing.get_context("spawn").Process(target=time.sleep, args=(60,), daemon=True)
+    worker.process.start()
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.001)
+
+    async def stop():
+        task = asyncio.create_task(ticker())
+        await worker.stop()
+        task.cancel()
+
+    asyncio.run(stop())
+    assert not worker.process.is_alive()
+    assert ticks > 1, "Event loop kept running while waiting for the worker to exit"
+
+
+def test_workers_share_concurrency():
+    config = types.SimpleNamespace(
+        es_breaker=plugins.breaker.CircuitBreaker(concurrency=8),
+        rule_workers=3,
+        elasticsearch_url="http://localhost:9200/",
+        index_pattern="loggy-%Y-%m-%d",
+        prefix_field=None,
+        prefix_field_lengths=[24, 64],
+    )
+    assert plugins.workers.worker_settings(config)["es_concurrency"] == 2
+    config.rule_workers = 16
+    assert plugins.workers.worker_settings(config)["es_concurrency"] == 1, "Every worker gets to search"
+
+
+def test_breaker_status_sums_up_workers():
+    config = types.SimpleNamespace(es_breaker=plugins.breaker.CircuitBreaker(concurrency=4), worker_status=[])
+    assert plugins.workers.breaker_status(config)["state"] == "closed"
+
+    struggling = plugins.breaker.CircuitBreaker(concurrency=2)
+    struggling.latency = 20.0
+    broken = plugins.breaker.CircuitBreaker(concurrency=2)
+    broken.trip()
+    config.worker_status = [
+        {"worker": 0, "elasticsearch": struggling.status()},
+        {"worker": 1, "elasticsearch": broken.status()},
+        {"worker": 2},  # Has not reported in yet
+    ]
+    status = plugins.workers.breaker_status(config)
+    assert status["state"] == "open"
+    assert status["pressure"] == 2
+    assert status["open_until"] == broken.status()["open_until"]
+    assert status["concurrency"] == 1 + 2, "Rule searches run in the workers only"
+    assert status["max_concurrency"] == 4
+    assert status["processes"] == 3
@@ -107,6 +107,12 @@ async function prime_frontpage() {
     let block_count = all.total_block.pretty();
     let h1 = _h1(`Recent activity (${block_count} blocks in total)`);
     main.appendChild(h1);
+    let status = await GET("status");
+    if (status.elasticsearch.state !== 'closed' || status.elasticsearch.pressure > 0) {
+        let es_warning = _p(`ElasticSearch is under pressure (circuit ${status.elasticsearch.state}, average query time ${status.elasticsearch.latency} seconds). Rules are running ${status.elasticsearch.interval_factor}x less often than usual.`);
+        es_warning.style.color = "red";
+        main.appendChild(es_warning);
+    }
     all.block.sort((a,b) => b.timestamp - a.timestamp);  // sort desc by timestamp
 
 
@@ -376,6 +382,30 @@ function rule_tr(rule) {
     t_time.appendChild(x_time);
     tr.appendChild(t_time);
 
+    // Interval
+    let t_interval = _td();
+    let x_interval = document.createElement('input');
+    x_interval.setAttribute('type', 'number');
+    x_interval.setAttribute('id', `interval_${rule.id}`);
+    x_interval.style.width = "95%";
+    x_interval.placeholder = "auto";
+    if (rule.interval) x_interval.value = rule.interval;
+    t_interval.appendChild(x_interval);
+    tr.appendChild(t_interval);
+
+    // Network aggregation (IPv4 / IPv6 prefix lengths)
+    let t_prefix = _td();
+    for (let family of ['4', '6']) {
+        let x_prefix = document.createElement('input');
+        x_prefix.setAttribute('type', 'number');
+        x_prefix.setAttribute('id', `prefix${family}_${rule.id}`);
+        x_prefix.style.width = "45%";
+        x_prefix.placeholder = family === '4' ? "/32" : "/128";
+        if (rule[`prefix${family}`]) x_prefix.value = rule[`prefix${family}`];
+        t_prefix.appendChild(x_prefix);
+    }
+    tr.appendChild(t_prefix);
+
     // Filters
     let t_filters = _td();
     let x_filters = document.createElement('textarea');
@@ -391,6 +421,12 @@ function rule_tr(rule) {
     tr.appendChild(t_actions);
 
 
+    let x_test = document.createElement('button');
+    x_test.innerText = 'Test';
+    x_test.style.marginRight = '16px';
+    x_test.addEventListener('click', () => test_rule(rule));
+    t_actions.appendChild(x_test);
+
     if (rule.description) {
         let x_save = document.createElement('button');
         x_save.innerText = 'Save';
@@ -418,15 +454,37 @@ function fetch_rule_data(rule) {
     let agg = document.getElementById(`agg_${rule.id}`).value;
     let limit = parseInt(document.getElementById(`limit_${rule.id}`).value);
     let duration = document.getElementById(`time_${rule.id}`).value;
+    let interval = parseInt(document.getElementById(`interval_${rule.id}`).value) || null;
+    let prefix4 = parseInt(document.getElementById(`prefix4_${rule.id}`).value) || null;
+    let prefix6 = parseInt(document.getElementById(`prefix6_${rule.id}`).value) || null;
     let filters = document.getElementById(`filters_${rule.id}`).value.trim();
     return {
         description: desc,
         aggtype: agg,
         limit: limit,
         duration: duration,
+        interval: interval,
+        prefix4: prefix4,
+        prefix6: prefix6,
         filter: filters
     }
 }
+async function test_rule(rule) {
+    let test_rule = fetch_rule_data(rule);
+    let result = await POST('backtest', test_rule);
+    if (result.success !== true) {
+        alert(result.message);
+        return;
+    }
+    let outcome = result.results[0];
+    let text = `Over the past ${outcome.duration}, this rule would block ${outcome.total_would_block} new IPs/networks`;
+    text += ` (${outcome.total_allowed} more are on the allow list, ${outcome.total_already_blocked} are already blocked).`;
+    if (outcome.would_block.length) {
+        text += "\n\nTop new blocks:\n" + outcome.would_block.slice(0, 10).map(([ip, value]) => `${ip}: ${value.pretty()}`).join("\n");
+    }
+    alert(text);
+}
+
 async function delete_rule(rule) {
     if (confirm("Are you sure you wish to delete this rule?")) {
         let result = await DELETE('rules', {rule: rule.id});
@@ -464,6 +522,8 @@ async function prime_rules(target, state) {
     btheader.appendChild(_th('Aggregation Type', 160));
     btheader.appendChild(_th('Limit', 140));
     btheader.appendChild(_th('Timespan', 80));
+    btheader.appendChild(_th('Interval (s)', 80));
+    btheader.appendChild(_th('Per network (v4/v6)', 120));
     btheader.appendChild(_th('Filters', 360));
     btheader.appendChild(_th('Actions', 150));
     t.appendChild(btheader);
@@ -478,14 +538,14 @@ async function prime_rules(target, state) {
     let tr = _tr();
     let td = _td();
     td.appendChild(_hr());
-    td.colSpan = 6;
+    td.colSpan = 8;
     tr.appendChild(td);
     t.appendChild(tr);
 
     let new_rule = rule_tr({id: 9999, duration: "24h", limit: 100});
     t.appendChild(new_rule);
 
-    let p = _p("Filters support regular Lucene match (foo = bar), exact terms match (foo == bar), regexp (foo ~= ba[rz]). All matches can be negated with !, such as !=, !==, !~= etc")
+    let p = _p("Filters support regular Lucene match (foo = bar), exact terms match (foo == bar), regexp (foo ~= ba[rz]). All matches can be negated with !, such as !=, !==, !~= etc. Leave the interval empty to have it derived from the timespan. Set IPv4/IPv6 prefix lengths (e.g. 24 and 64) to aggregate and block whole networks instead of single IPs.")
     main.appendChild(p);
 
 }
@@ -769,12 +829,131 @@ async function prime_block() {
 
 
 
+function top_table(result) {
+    let div = document.createElement('div');
+    let title = _h2(`Rule #${result.rule}: ${result.description} (${result.aggtype} >= ${result.limit.pretty()} over ${result.duration})`);
+    div.appendChild(title);
+    let status = result.error ? `Last search failed: ${result.error}` : `Top ${result.top.length} clients`;
+    div.appendChild(_p(`${status}, ${moment(result.timestamp*1000.0).fromNow()} (search took ${result.latency} seconds).`));
+
+    let refresh = document.createElement('button');
+    refresh.innerText = "Refresh";
+    refresh.addEventListener('click', async () => {
+        refresh.disabled = true;
+        let results = await GET(`top?refresh=true&rule=${result.rule}`);
+        if (results.rules.length) div.replaceWith(top_table(results.rules[0]));
+        else refresh.disabled = false;
+    });
+    div.appendChild(refresh);
+
+    let t = _table();
+    t.style.tableLayout = 'fixed';
+    let theader = _tr();
+    theader.appendChild(_th('Source IP', 300));
+    theader.appendChild(_th(result.aggtype === 'bytes' ? 'Bytes' : 'Requests', 160));
+    theader.appendChild(_th('Share of limit', 160));
+    t.appendChild(theader);
+    for (const [ip, count] of result.top.slice(0, 25)) {
+        let tr = _tr();
+        let td_ip = _td(ip);
+        td_ip.style.fontFamily = "monospace";
+        if (ip.length > 16) td_ip.style.fontSize = "0.8rem";
+        let td_count = _td(count.pretty());
+        let td_share = _td((100 * count / result.limit).pretty(1) + "%");
+        if (count >= result.limit) td_share.style.color = "red";
+        tr.appendChild(td_ip);
+        tr.appendChild(td_count);
+        tr.appendChild(td_share);
+        t.appendChild(tr);
+    }
+    div.appendChild(t);
+    return div;
+}
+
+
+async function prime_top(target, state) {
+    let main = document.getElementById('main');
+    main.innerHTML = "";
+    main.appendChild(_h1("Top clients, as last seen by each rule"));
+    let results = await GET('top');
+    for (const result of results.rules) {
+        main.appendChild(top_table(result));
+        main.appendChild(_hr());
+    }
+    if (results.rules.length === 0) {
+        main.appendChild(_p("No rules have been run yet..."));
+    }
+}
+
+
+async function load_log(log_table, cursor, prefix) {
+    let url = 'audit?archive=true';
+    if (cursor) url += `&before=${cursor}`;
+    if (prefix) url += `&ip=${encodeURIComponent(prefix)}`;
+    let log = await GET(url);
+    if (!log.entries) {
+        alert(log.message);
+        return null;
+    }
+    for (const entry of log.entries) {
+        let tr = _tr();
+        let td_ip = _td(entry.ip);
+        td_ip.style.fontFamily = "monospace";
+        if (entry.ip.length > 16) td_ip.style.fontSize = "0.8rem";
+        let td_when = _td(moment(entry.timestamp*1000.0).fromNow());
+        let td_event = _td(entry.event);
+        tr.appendChild(td_ip);
+        tr.appendChild(td_when);
+        tr.appendChild(td_event);
+        log_table.appendChild(tr);
+    }
+    return log.next;
+}
+
+
+async function prime_log(target, state) {
+    let main = document.getElementById('main');
+    main.innerHTML = "";
+    main.appendChild(_h1("Activity log"));
+
+    let prefix_input = document.createElement('input');
+    prefix_input.placeholder = "Filter by IP or network, e.g. 10.0.0.0/16 or 2001:db8::/32";
+    prefix_input.style.width = "300px";
+    prefix_input.value = target ? target : "";
+    prefix_input.addEventListener('keyup', (e) => { if (e.keyCode === 13) {
+        window.history.pushState({}, '', `?log:${prefix_input.value}`);
+        prime_log(prefix_input.value, true);
+    }});
+    main.appendChild(prefix_input);
+
+    let log_table = _table();
+    log_table.style.tableLayout = 'fixed';
+    main.appendChild(log_table);
+    let theader = _tr();
+    theader.appendChild(_th('Source IP', 300));
+    theader.appendChild(_th('When', 120));
+    theader.appendChild(_th('Event', 600));
+    log_table.appendChild(theader);
+
+    let more = document.createElement('button');
+    more.innerText = "Load more";
+    let cursor = await load_log(log_table, null, target);
+    more.addEventListener('click', async () => {
+        cursor = await load_log(log_table, cursor, target);
+        if (!cursor) main.removeChild(more);
+    });
+    if (cursor) main.appendChild(more);
+}
+
+
 let actions = {
     frontpage: prime_frontpage,
     allow: prime_allow,
     add: prime_block,
     search: prime_search,
-    rules: prime_rules
+    rules: prime_rules,
+    log: prime_log,
+    top: prime_top
 };
 
 